@@ -0,0 +1,30 @@
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+USER_CACHE_KEY = 'accounts:user:{}'
+USER_CACHE_TIMEOUT = 60 * 15
+
+
+def invalidate_cached_user(user_id):
+    """
+    Drop a user from the cache so the next request reloads it from the database.
+    """
+    cache.delete(USER_CACHE_KEY.format(user_id))
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend that serves the per-request user lookup from the cache.
+
+    AuthenticationMiddleware calls get_user() on every authenticated request;
+    with the session also cached this makes the auth preamble free of queries.
+    Cached users are invalidated on save/delete and on logout (see accounts/signals.py).
+    """
+    def get_user(self, user_id):
+        key = USER_CACHE_KEY.format(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(key, user, USER_CACHE_TIMEOUT)
+        return user
@@ -0,0 +1,158 @@
+"""
+Cached verification of Google Sign-In ID tokens.
+
+id_token.verify_oauth2_token() downloads Google's signing certificates on
+every call. This module keeps them in the shared cache for as long as the
+upstream Cache-Control max-age allows, refreshes them in the background
+shortly before they expire and verifies tokens locally against the cached keys.
+"""
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+GOOGLE_ISSUERS = ['accounts.google.com', 'https://accounts.google.com']
+
+CERTS_CACHE_KEY = 'accounts:google_certs:{}'
+REFRESH_LOCK_KEY = 'accounts:google_certs_refresh:{}'
+ROTATION_CHECK_KEY = 'accounts:google_certs_rotation:{}'
+
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+
+def parse_max_age(cache_control, default):
+    """
+    Get the max-age directive of a Cache-Control header, in seconds.
+    """
+    match = MAX_AGE_RE.search(cache_control or '')
+    return int(match.group(1)) if match else default
+
+
+class GoogleCertCache:
+    """
+    Google's public signing certificates, shared by every worker through the cache.
+
+    Parameters:
+        certs_url (str): URL of the certificates (overridable for tests).
+        refresh_margin (int): Seconds before expiry at which a background refresh starts.
+        default_max_age (int): Lifetime used when the response has no max-age.
+        timeout (int): HTTP timeout in seconds.
+    """
+    def __init__(self, certs_url=None, refresh_margin=300, default_max_age=3600, timeout=5):
+        self._certs_url = certs_url
+        self.refresh_margin = refresh_margin
+        self.default_max_age = default_max_age
+        self.timeout = timeout
+        self._refresh_thread = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def certs_url(self):
+        return self._certs_url or getattr(settings, 'GOOGLE_OAUTH_CERTS_URL', GOOGLE_CERTS_URL)
+
+    @property
+    def cache_key(self):
+        return CERTS_CACHE_KEY.format(self.certs_url)
+
+    def get_certs(self):
+        """
+        Return the certificates as {key id: PEM certificate}.
+
+        Only blocks on the network when nothing usable is cached. If that
+        refresh fails, keys past their max-age are served while they are still cached.
+        """
+        entry = cache.get(self.cache_key)
+        now = time.time()
+        if entry is None or entry['expires_at'] <= now:
+            try:
+                return self.refresh()['certs']
+            except Exception as e:
+                if entry is None:
+                    raise
+                logger.warning(f'Refreshing the Google certificates failed, serving expired ones: {e}')
+                return entry['certs']
+
+        if entry['expires_at'] - now <= self.refresh_margin:
+            self.refresh_in_background()
+        return entry['certs']
+
+    def refresh(self):
+        """
+        Download the certificates and store them for the upstream max-age.
+        """
+        import requests
+
+        response = requests.get(self.certs_url, timeout=self.timeout)
+        response.raise_for_status()
+
+        max_age = parse_max_age(response.headers.get('Cache-Control'), self.default_max_age)
+        entry = {'certs': response.json(), 'expires_at': time.time() + max_age}
+        # Kept one refresh margin past max-age, as a fallback while Google cannot be reached
+        cache.set(self.cache_key, entry, max_age + self.refresh_margin)
+        return entry
+
+    def refresh_in_background(self):
+        """
+        Refresh the certificates in a daemon thread.
+
+        A cache lock makes sure only one worker across the deployment refreshes at a time.
+        """
+        with self._thread_lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            if not cache.add(REFRESH_LOCK_KEY.format(self.certs_url), True, self.refresh_margin):
+                return
+            self._refresh_thread = threading.Thread(target=self._background_refresh, daemon=True)
+            self._refresh_thread.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning(f"Background refresh of Google certificates failed: {e}")
+        finally:
+            cache.delete(REFRESH_LOCK_KEY.format(self.certs_url))
+
+
+google_cert_cache = GoogleCertCache()
+
+
+def verify_google_id_token(token, audience, cert_cache=None):
+    """
+    Verify a Google ID token against the cached signing certificates.
+
+    Parameters:
+        token (str): The encoded ID token.
+        audience (str): The expected audience (our OAuth client ID).
+        cert_cache (GoogleCertCache): Certificate cache, defaults to the shared one.
+
+    Returns:
+        dict: The decoded token payload.
+
+    Raises:
+        ValueError: If the token is invalid, expired or not issued by Google.
+    """
+    if not token:
+        raise ValueError('No ID token provided.')
+
+    # Only the Google sign-in callback needs these, keep them out of worker start-up
+    from google.auth import jwt
+
+    cert_cache = cert_cache or google_cert_cache
+    certs = cert_cache.get_certs()
+
+    key_id = jwt.decode_header(token).get('kid')
+    if key_id is not None and key_id not in certs and cache.add(ROTATION_CHECK_KEY.format(cert_cache.certs_url), True, 60):
+        # Google may have rotated its keys before our copy expired (checked at most once a minute)
+        certs = cert_cache.refresh()['certs']
+
+    payload = jwt.decode(token, certs=certs, audience=audience)
+    if payload.get('iss') not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer. 'iss' should be one of the following: {GOOGLE_ISSUERS}")
+    return payload
@@ -0,0 +1,26 @@
+"""
+API permissions mirroring the admin_required / admin_or_standard_user_required decorators.
+
+They only read attributes that ClaimsTokenUser serves from the token, so
+authorization costs no database query.
+"""
+from rest_framework.permissions import BasePermission
+
+from .models import UserRole
+
+
+class IsAdminRole(BasePermission):
+    def has_permission(self, request, view):
+        return getattr(request.user, 'role', None) == UserRole.ADMIN
+
+
+class IsAdminOrStandardUser(BasePermission):
+    def has_permission(self, request, view):
+        return getattr(request.user, 'role', None) in [UserRole.ADMIN, UserRole.STANDARD_USER]
+
+
+class HasActiveSubscription(BasePermission):
+    message = 'An active subscription is required.'
+
+    def has_permission(self, request, view):
+        return bool(getattr(request.user, 'subscription_active', False))
@@ -59,3 +59,117 @@ class UserViewsTestCase(TestCase):
         self.client.login(username=self.username, password=self.password)
         response = self.client.get(self.home_url)
         self.assertEqual(response.status_code, 200)  # Home page should be accessible
+
+    def test_authenticated_request_costs_no_queries(self):
+        """
+        Test that the session and the user are served from the cache.
+
+        With the database session backend and ModelBackend this request costs
+        two queries (session + user); it should now cost none.
+        """
+        self.client.login(username=self.username, password=self.password)
+        self.client.get(self.home_url)  # Warm the user cache
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.home_url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_cached_user_invalidated_on_save(self):
+        """
+        Test that changing a user is visible on the next request.
+        """
+        self.client.login(username=self.username, password=self.password)
+        self.client.get(self.home_url)
+
+        self.user.role = 'Admin'
+        self.user.save()
+        response = self.client.get(self.home_url)
+        self.assertEqual(response.wsgi_request.user.role, 'Admin')
+
+
+class GoogleCertCacheTestCase(TestCase):
+    """
+    Google Sign-In against a local stand-in certificate endpoint and self-signed tokens.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import datetime
+        import json
+        import threading
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import NameOID
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'test')])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (
+            x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(1).not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256())
+        )
+        cls.private_key = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+        certs_body = json.dumps({'test-key': cert.public_bytes(serialization.Encoding.PEM).decode()}).encode()
+
+        cls.requests_served = 0
+
+        class CertsHandler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                cls.requests_served += 1
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'application/json')
+                handler.send_header('Cache-Control', 'public, max-age=600, must-revalidate')
+                handler.end_headers()
+                handler.wfile.write(certs_body)
+
+            def log_message(handler, *args):
+                pass
+
+        cls.server = HTTPServer(('127.0.0.1', 0), CertsHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.certs_url = f'http://127.0.0.1:{cls.server.server_port}/certs'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def make_token(self, **claims):
+        import time
+        from google.auth import crypt, jwt
+
+        now = int(time.time())
+        payload = {
+            'iss': 'https://accounts.google.com', 'aud': 'test-client-id', 'iat': now, 'exp': now + 300,
+            'email': 'google@example.com', 'given_name': 'Google', 'family_name': 'User',
+        }
+        payload.update(claims)
+        signer = crypt.RSASigner.from_string(self.private_key, key_id='test-key')
+        return jwt.encode(signer, payload).decode()
+
+    def test_google_complete_fetches_certs_once(self):
+        """
+        Test that repeated Google logins reuse the cached certificates.
+        Should create the user and hit the certificate endpoint only once.
+        """
+        from django.core.cache import cache
+        from django.test import override_settings
+        from .google_certs import google_cert_cache
+
+        with override_settings(GOOGLE_OAUTH_CERTS_URL=self.certs_url, GOOGLE_OAUTH_CLIENT_ID='test-client-id'):
+            cache.delete(google_cert_cache.cache_key)
+            for _ in range(3):
+                response = self.client.post(reverse('google-complete'), {'credential': self.make_token()})
+                self.assertEqual(response.status_code, 302)
+
+            response = self.client.post(reverse('google-complete'), {'credential': self.make_token(iss='evil.example.com')})
+            self.assertEqual(response.status_code, 403)
+
+        self.assertEqual(self.requests_served, 1)
+        self.assertTrue(CustomUser.objects.filter(email='google@example.com').exists())
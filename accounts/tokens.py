@@ -0,0 +1,82 @@
+"""
+Stateless JWT authentication for API clients.
+
+Tokens carry the claims needed for authorization (role, subscription status
+and parent account), so API requests are authorized without loading the user.
+Claims are refreshed from the database whenever the access token is refreshed,
+which bounds their staleness to ACCESS_TOKEN_LIFETIME.
+"""
+from django.contrib.auth import get_user_model
+from django.utils.functional import cached_property
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+
+
+def add_user_claims(token, user):
+    """
+    Add the authorization claims of a user to a token.
+
+    Parameters:
+        token (Token): The token to update.
+        user (CustomUser): The user the token is issued for.
+    """
+    from vm_management.models import Subscription  # vm_management.models imports accounts.models
+
+    subscription = Subscription.objects.filter(user=user).first()
+    token['role'] = user.role
+    token['subscription_active'] = bool(subscription and subscription.active)
+    token['parent_account_id'] = subscription.parent_account_id if subscription else None
+    return token
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        return add_user_claims(super().get_token(user), user)
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    def validate(self, attrs):
+        """
+        Reload the user's claims before issuing a new access token.
+
+        This is the only database access in the token lifecycle after login.
+        """
+        refresh = self.token_class(attrs['refresh'])
+        user = get_user_model().objects.filter(
+            **{api_settings.USER_ID_FIELD: refresh[api_settings.USER_ID_CLAIM]}
+        ).first()
+        if user is None or not user.is_active:
+            raise AuthenticationFailed('User not found or inactive.', code='user_inactive')
+
+        add_user_claims(refresh, user)
+        return super().validate({**attrs, 'refresh': str(refresh)})
+
+
+class ClaimsTokenUser(TokenUser):
+    """
+    Stateless user backed by a validated token and its authorization claims.
+    """
+    @cached_property
+    def role(self):
+        return self.token.get('role')
+
+    @cached_property
+    def subscription_active(self):
+        return self.token.get('subscription_active', False)
+
+    @cached_property
+    def parent_account_id(self):
+        return self.token.get('parent_account_id')
+
+
+class ClaimsJWTAuthentication(JWTStatelessUserAuthentication):
+    """
+    Authenticate API requests from the token alone, without a users table query.
+    """
+    def get_user(self, validated_token):
+        super().get_user(validated_token)  # Validates the user id claim
+        return ClaimsTokenUser(validated_token)
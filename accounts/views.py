@@ -1,13 +1,10 @@
-import os
 from django.http import HttpRequest, HttpResponse, JsonResponse
 from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login as auth_login
 from django.contrib.auth.decorators import login_required
-import requests
 from .forms import CustomUserCreationForm, LoginForm
 from .models import UserRole
 from django.views.decorators.csrf import csrf_exempt
-from google.oauth2 import id_token
 # from google.auth.transport import requests
 from django.conf import settings
 from django.urls import reverse
@@ -17,9 +14,9 @@ from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from django.contrib.auth import get_user_model
 from django.contrib.auth import login as auth_login
-from google.auth.transport import requests as google_requests
 from django.contrib.auth import logout as auth_logout
 from functools import wraps
+from .google_certs import verify_google_id_token
 
 def admin_required(view_func):
     """
@@ -122,10 +119,8 @@ def google_complete(request):
     token = request.POST.get('credential')
 
     try:
-        # Verify the token using the correct 'Request' from google.auth.transport
-        user_data = id_token.verify_oauth2_token(
-            token, google_requests.Request(), settings.GOOGLE_OAUTH_CLIENT_ID
-        )
+        # Verify the token locally against Google's cached signing certificates
+        user_data = verify_google_id_token(token, settings.GOOGLE_OAUTH_CLIENT_ID)
         email = user_data.get('email')
         first_name = user_data.get('given_name')
         last_name = user_data.get('family_name')
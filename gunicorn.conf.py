@@ -0,0 +1,37 @@
+"""
+Gunicorn configuration.
+
+The application is loaded once in the master before forking (preload_app),
+so every worker shares the imported code and URL configuration with the
+master copy-on-write instead of importing it again. Set GUNICORN_PRELOAD=0
+to load the application in each worker, e.g. for code reloading.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'uvicorn.workers.UvicornWorker'
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+
+    # Import every view module now rather than on each worker's first request
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+
+    # Keep the garbage collector from touching (and so copying) the preloaded objects in the workers
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+
+    # Never share a connection opened in the master with the workers
+    from django.db import connections
+    connections.close_all()
@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
 import os
+import sys
+from datetime import timedelta
 from pathlib import Path
 from dotenv import load_dotenv, find_dotenv
 
@@ -36,6 +38,11 @@ ALLOWED_HOSTS = ['*']
 
 AUTH_USER_MODEL = 'accounts.CustomUser'
 
+# Serve the per-request user lookup from the cache (see accounts/backends.py)
+AUTHENTICATION_BACKENDS = [
+    'accounts.backends.CachedModelBackend',
+]
+
 
 # Application definition
 
@@ -55,19 +62,26 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    # Server-Timing header and /metrics histograms (see vm_management/metrics.py)
+    'vm_management.middleware.metrics_middleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Admin-only ?_profile=1 / X-Profile: 1 request profiling (see vm_management/profiling.py)
+    'vm_management.middleware.profiling_middleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # 503 + Retry-After when a hypervisor host is busy or unreachable (see admission.py and resilience.py)
+    'vm_management.middleware.HypervisorErrorMiddleware',
 ]
 
 ROOT_URLCONF = 'hynfratech_assessment.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates that records render time in the request metrics
+        'BACKEND': 'vm_management.metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -83,6 +97,17 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'hynfratech_assessment.wsgi.application'
 
+ASGI_APPLICATION = 'hynfratech_assessment.asgi.application'
+
+# Route create/start/stop/backup/details to the async views (vm_management/async_views.py).
+# Only worth it under an ASGI server, see the Dockerfile.
+ASYNC_HYPERVISOR_VIEWS = os.environ.get('ASYNC_HYPERVISOR_VIEWS', '0') == '1'
+
+# 'auto' runs vboxmanage as a local process when HOST_IP is this machine, vboxmanage is installed and the app runs as HOST_USER,
+# over SSH otherwise; 'ssh' and 'local' force either; 'fake' only simulates its latency (see vm_management/hypervisor.py)
+HYPERVISOR_BACKEND = os.environ.get('HYPERVISOR_BACKEND', 'auto')
+HYPERVISOR_FAKE_LATENCY_SCALE = float(os.environ.get('HYPERVISOR_FAKE_LATENCY_SCALE', 1))
+
 
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
@@ -98,6 +123,66 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Shared by every worker: page version stamps (vm_management/versioning.py)
+# and rendered template fragments (vm_management/fragment_cache.py) live here.
+# Redis when REDIS_URL is set, otherwise a file based cache shared by the
+# workers on one host.
+
+REDIS_URL = os.environ.get('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('CACHE_LOCATION', '/var/tmp/hynfratech_cache'),
+            'OPTIONS': {
+                # The default of 300 entries culls metrics and fragments long before they expire
+                'MAX_ENTRIES': 20000,
+            },
+        }
+    }
+
+# Metric counters (see vm_management/metrics.py) get a cache of their own that never culls:
+# culled counters would reset, and series would vanish, on /metrics. On Redis, keep a
+# maxmemory-policy that spares keys without an expiry (noeviction or volatile-*).
+if REDIS_URL:
+    CACHES['metrics'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'metrics',
+        'TIMEOUT': None,
+    }
+else:
+    CACHES['metrics'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('METRICS_CACHE_LOCATION', '/var/tmp/hynfratech_metrics'),
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': sys.maxsize,
+        },
+    }
+
+# Cached list rows are invalidated by version, the timeout only bounds memory use
+FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Bearer token the Prometheus scraper sends to /metrics (Authorization: Bearer <token>); /metrics answers 403 when unset
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Sessions
+# Write-through cache in front of the database: reads are served from the
+# cache, so authenticated requests normally cost no session query.
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -144,6 +229,25 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'accounts/static/accounts'),
 ]
 
+# collectstatic produces hashed, gzip and brotli precompressed files plus a manifest;
+# WhiteNoise serves the hashed names with immutable far-future caching (see hynfratech_assessment/storage.py)
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'hynfratech_assessment.storage.StaticFilesStorage',
+    },
+}
+
+# Per-file budgets in bytes over the size sent on the wire (manage.py static_budget)
+STATIC_ASSET_BUDGETS = {
+    '*.css': 20 * 1024,
+    '*.js': 100 * 1024,
+    '*.png': 100 * 1024,
+    '*.jpg': 300 * 1024,
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -173,6 +277,76 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 #     },
 # }
 
+# One JSON line per hypervisor command slower than HYPERVISOR_SLOW_COMMAND_SECONDS
+# (see vm_management/hypervisor_stats.py), on stderr or in HYPERVISOR_SLOW_LOG_FILE
+HYPERVISOR_SLOW_COMMAND_SECONDS = float(os.environ.get('HYPERVISOR_SLOW_COMMAND_SECONDS', 5))
+HYPERVISOR_SLOW_LOG_FILE = os.environ.get('HYPERVISOR_SLOW_LOG_FILE')
+
+# Seconds an operation on a VM waits for another one on the same VM to finish (see vm_management/locks.py)
+VM_LOCK_TIMEOUT = float(os.environ.get('VM_LOCK_TIMEOUT', 10))
+
+# Admission of hypervisor commands per host and worker process (see vm_management/admission.py);
+# HYPERVISOR_MAX_HEAVY_COMMANDS also caps the heavy commands of all workers together
+HYPERVISOR_MAX_CONCURRENT_COMMANDS = int(os.environ.get('HYPERVISOR_MAX_CONCURRENT_COMMANDS', 8))
+HYPERVISOR_MAX_HEAVY_COMMANDS = int(os.environ.get('HYPERVISOR_MAX_HEAVY_COMMANDS', 2))
+HYPERVISOR_MAX_QUEUED_COMMANDS = int(os.environ.get('HYPERVISOR_MAX_QUEUED_COMMANDS', 100))
+HYPERVISOR_MAX_QUEUED_PER_TENANT = int(os.environ.get('HYPERVISOR_MAX_QUEUED_PER_TENANT', 10))
+HYPERVISOR_QUEUE_TIMEOUT = float(os.environ.get('HYPERVISOR_QUEUE_TIMEOUT', 30))
+
+# Timeouts, read retries and circuit breaking of hypervisor commands (see vm_management/resilience.py)
+HYPERVISOR_CONNECT_TIMEOUT = float(os.environ.get('HYPERVISOR_CONNECT_TIMEOUT', 5))
+HYPERVISOR_COMMAND_TIMEOUT = float(os.environ.get('HYPERVISOR_COMMAND_TIMEOUT', 60))
+HYPERVISOR_HEAVY_COMMAND_TIMEOUT = float(os.environ.get('HYPERVISOR_HEAVY_COMMAND_TIMEOUT', 1800))
+HYPERVISOR_READ_RETRIES = int(os.environ.get('HYPERVISOR_READ_RETRIES', 2))
+HYPERVISOR_BREAKER_FAILURES = int(os.environ.get('HYPERVISOR_BREAKER_FAILURES', 5))
+HYPERVISOR_BREAKER_RESET_SECONDS = float(os.environ.get('HYPERVISOR_BREAKER_RESET_SECONDS', 30))
+
+# Agent on the VirtualBox host answering the bulk reads in one request (see vm_management/agent.py);
+# {host} is replaced by the host, e.g. 'https://{host}:8765/rpc'. Empty to use vboxmanage over SSH.
+HYPERVISOR_AGENT_URL = os.environ.get('HYPERVISOR_AGENT_URL', '')
+HYPERVISOR_AGENT_SECRET = os.environ.get('HYPERVISOR_AGENT_SECRET', '')
+HYPERVISOR_AGENT_TIMEOUT = float(os.environ.get('HYPERVISOR_AGENT_TIMEOUT', 30))
+
+# Pre-provisioned VMs handed out by create_vm, refilled by refill_warm_pool (see vm_management/warm_pool.py).
+# WARM_POOL_TEMPLATE names the template VM of each disk size; it needs a snapshot to clone from.
+WARM_POOL_TEMPLATE = os.environ.get('WARM_POOL_TEMPLATE', 'template-{disk_size}')
+WARM_POOL_TEMPLATE_SNAPSHOT = os.environ.get('WARM_POOL_TEMPLATE_SNAPSHOT', 'base')
+WARM_POOL_SHAPES = os.environ.get('WARM_POOL_SHAPES', '1:256:1024')  # cpu:memory:disk_size, comma-separated
+WARM_POOL_MIN_PER_SHAPE = int(os.environ.get('WARM_POOL_MIN_PER_SHAPE', 1))
+WARM_POOL_MAX_PER_SHAPE = int(os.environ.get('WARM_POOL_MAX_PER_SHAPE', 5))
+WARM_POOL_DEMAND_WINDOW = int(os.environ.get('WARM_POOL_DEMAND_WINDOW', 3600))
+WARM_POOL_COVER_SECONDS = int(os.environ.get('WARM_POOL_COVER_SECONDS', 600))
+
+# Content-addressed store of the backups' disks, filled by export_backups (see vm_management/backup_store.py).
+# Changing BACKUP_CHUNK_SIZE makes the next backup of every VM a full copy.
+BACKUP_STORE_ROOT = os.environ.get('BACKUP_STORE_ROOT', str(BASE_DIR / 'backup_store'))
+BACKUP_CHUNK_SIZE = int(os.environ.get('BACKUP_CHUNK_SIZE', 4 * 1024 * 1024))
+BACKUP_COMPRESS_THREADS = int(os.environ.get('BACKUP_COMPRESS_THREADS', os.cpu_count() or 1))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {
+            'format': '%(message)s',
+        },
+    },
+    'handlers': {
+        'slow_commands': {
+            'class': 'logging.handlers.WatchedFileHandler' if HYPERVISOR_SLOW_LOG_FILE else 'logging.StreamHandler',
+            'formatter': 'message',
+            **({'filename': HYPERVISOR_SLOW_LOG_FILE} if HYPERVISOR_SLOW_LOG_FILE else {}),
+        },
+    },
+    'loggers': {
+        'vm_management.slow_commands': {
+            'handlers': ['slow_commands'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
+
 # Smtp and Email
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -190,6 +364,9 @@ if not GOOGLE_OAUTH_CLIENT_ID:
         'GOOGLE_OAUTH_CLIENT_ID is missing.'
     )
 
+# Google's ID token signing certificates, cached per Cache-Control (accounts/google_certs.py)
+GOOGLE_OAUTH_CERTS_URL = os.environ.get('GOOGLE_OAUTH_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs')
+
 # We need these lines below to allow the Google sign in popup to work.
 
 SECURE_REFERRER_POLICY = 'no-referrer-when-downgrade'
@@ -199,13 +376,23 @@ SECURE_CROSS_ORIGIN_OPENER_POLICY = "same-origin-allow-popups"
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # Authorizes from token claims, without loading the user (see accounts/tokens.py)
+        'accounts.tokens.ClaimsJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
 }
 
+# Short-lived access tokens bound how stale the role/subscription claims can get;
+# claims are reloaded from the database on every refresh.
+SIMPLE_JWT = {
+    'ACCESS_TOKEN_LIFETIME': timedelta(minutes=5),
+    'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
+    'TOKEN_OBTAIN_SERIALIZER': 'accounts.tokens.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'accounts.tokens.ClaimsTokenRefreshSerializer',
+}
+
 # CSRF Settings
 CSRF_COOKIE_SECURE = False
 CSRF_COOKIE_HTTPONLY = False
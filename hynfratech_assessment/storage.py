@@ -0,0 +1,26 @@
+"""
+Static files storage.
+
+collectstatic writes every asset under a content-hashed name, with gzip and
+brotli precompressed copies and a staticfiles.json manifest. WhiteNoise
+serves the hashed names with far-future immutable caching and picks the
+precompressed copy matching the client's Accept-Encoding.
+"""
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+
+class StaticFilesStorage(CompressedManifestStaticFilesStorage):
+    """
+    Hashed, precompressed static files.
+
+    Assets missing from the manifest (e.g. in tests or a checkout where
+    collectstatic has not run yet) are served under their plain name instead
+    of failing the page render.
+    """
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
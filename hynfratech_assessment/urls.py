@@ -18,6 +18,7 @@ from django.urls import include, path
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from django.conf import settings
 from django.conf.urls.static import static
+from vm_management.views import metrics
 
 urlpatterns = [
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
@@ -25,6 +26,7 @@ urlpatterns = [
     path("vm_management/", include("vm_management.urls")),
     path("accounts/", include("accounts.urls")),
     path('admin/', admin.site.urls),
+    path('metrics', metrics, name='metrics'),
 ]
 
 if settings.DEBUG:
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import VM, ActionLog, Payment, Subscription, RatePlan, Backup
+from .models import VM, ActionLog, Payment, Subscription, RatePlan, Backup, OutboundEmail, RequestProfile, WarmVM
 from accounts.models import CustomUser  # Import CustomUser from accounts app
 
 @admin.register(VM)
@@ -39,4 +39,26 @@ class RatePlanAdmin(admin.ModelAdmin):
 
 @admin.register(Backup)
 class BackupAdmin(admin.ModelAdmin):
-    list_display = ('vm', 'user', 'created_at',)
\ No newline at end of file
+    list_display = ('vm', 'user', 'created_at', 'export_status', 'exported_at', 'stored_size')
+    list_filter = ('export_status',)
+    exclude = ('manifest',)
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('to_email', 'subject', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('to_email', 'subject')
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('method', 'path', 'view_name', 'status_code', 'duration', 'query_count', 'user', 'created_at')
+    list_filter = ('view_name',)
+    search_fields = ('path',)
+    exclude = ('stats',)
+    readonly_fields = ('created_at',)
+
+@admin.register(WarmVM)
+class WarmVMAdmin(admin.ModelAdmin):
+    list_display = ('name', 'host', 'cpu', 'memory', 'disk_size', 'status', 'created_at')
+    list_filter = ('status', 'host')
+    readonly_fields = ('created_at', 'updated_at')
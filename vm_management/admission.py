@@ -0,0 +1,422 @@
+"""
+Admission control and fair scheduling of hypervisor commands.
+
+Every vboxmanage command passes through the scheduler of its host before
+it runs. Each worker process lets at most HYPERVISOR_MAX_CONCURRENT_COMMANDS
+commands run per host, of which at most HYPERVISOR_MAX_HEAVY_COMMANDS may be
+disk-heavy (snapshots, disk creation, clones, exports), so quick commands
+always have free slots however many backups are queued. The heavy limit
+also holds host-wide: an admitted heavy command then takes one of the
+host's HYPERVISOR_MAX_HEAVY_COMMANDS slots in the shared cache (atomic on
+Redis), so more workers do not mean more concurrent snapshots on the host.
+
+Waiting commands are ordered by weighted fair queueing: each tenant's
+commands get virtual finish times advanced by cost / weight, where the cost
+reflects how long the subcommand typically runs and the weight grows with
+the tenant's rate plan. A tenant scripting backups only delays its own
+queue. When the host queue or a tenant's share of it is full, or a command
+waits longer than HYPERVISOR_QUEUE_TIMEOUT, HypervisorBusy is raised and
+the middleware answers 503 with a Retry-After hint.
+"""
+import asyncio
+import contextvars
+import math
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from .hypervisor_stats import get_subcommand
+from .metrics import increment, observe, record
+
+HEAVY_SUBCOMMANDS = {'snapshot take', 'snapshot restore', 'createhd', 'createmedium', 'clonevm', 'clonemedium', 'export', 'import'}
+
+# Relative cost of a subcommand in the fair queue, roughly its typical duration over a quick command's
+COMMAND_COSTS = {
+    'snapshot take': 20,
+    'snapshot restore': 20,
+    'createhd': 10,
+    'createmedium': 10,
+    'clonevm': 20,
+    'clonemedium': 30,
+    'export': 50,
+    'import': 50,
+    'startvm': 5,
+    'unregistervm': 3,
+}
+DEFAULT_COST = 1
+
+# Fair-queue weight by rate plan; commands without a tenant (collector, reconciler) weigh 1
+PLAN_WEIGHTS = {'bronze': 1, 'silver': 2, 'gold': 4, 'platinum': 8}
+
+SYSTEM_TENANT = (None, 1)
+
+HEAVY_SLOT_KEY = 'vm_management:hypervisor_heavy_slot:{}:{}'
+SLOT_POLL_INITIAL_DELAY = 0.05
+SLOT_POLL_MAX_DELAY = 1
+
+_current_tenant = contextvars.ContextVar('hypervisor_tenant', default=SYSTEM_TENANT)
+
+
+class HypervisorBusy(Exception):
+    """
+    The host's queue is full; retry_after is a hint in seconds.
+    """
+    def __init__(self, host, retry_after):
+        super().__init__(f'Hypervisor {host} is busy, retry in {retry_after}s')
+        self.host = host
+        self.retry_after = retry_after
+
+
+def get_plan_weight(rate_plan):
+    return PLAN_WEIGHTS.get(rate_plan.name.lower(), 1) if rate_plan else 1
+
+
+def set_current_tenant(user_id, weight):
+    """
+    Attribute the hypervisor commands of the current request to a tenant.
+
+    Returns:
+        Token to pass to reset_current_tenant().
+    """
+    return _current_tenant.set((user_id, weight))
+
+
+def reset_current_tenant(token):
+    _current_tenant.reset(token)
+
+
+def get_current_tenant():
+    """
+    Returns:
+        tuple: (user ID or None, weight) of the tenant the current commands are queued for.
+    """
+    return _current_tenant.get()
+
+
+def get_command_class(command):
+    subcommand = get_subcommand(command)
+    return subcommand, subcommand in HEAVY_SUBCOMMANDS, COMMAND_COSTS.get(subcommand, DEFAULT_COST)
+
+
+class _Waiter:
+    """
+    A queued command, woken through a threading.Event (sync callers) or a future (async callers).
+    """
+    def __init__(self, tenant, start_tag, finish_tag, heavy, sequence, loop=None):
+        self.tenant = tenant
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.heavy = heavy
+        self.sequence = sequence
+        self.granted = False
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+
+    def grant(self):
+        self.granted = True
+        if self.loop:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+        else:
+            self.event.set()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class HostScheduler:
+    """
+    Concurrency limits and weighted fair queue of one host.
+
+    Parameters:
+        host (str): The host.
+        max_concurrent (int): Commands running at once.
+        max_heavy (int): Heavy commands running at once (counted in max_concurrent).
+        max_queued (int): Commands waiting at once before new ones are rejected.
+        max_queued_per_tenant (int): Commands one tenant may have waiting.
+    """
+    def __init__(self, host, max_concurrent, max_heavy, max_queued, max_queued_per_tenant):
+        self.host = host
+        self.max_concurrent = max_concurrent
+        self.max_heavy = min(max_heavy, max_concurrent)
+        self.max_queued = max_queued
+        self.max_queued_per_tenant = max_queued_per_tenant
+        self._lock = threading.Lock()
+        self._queue = []
+        self._running = 0
+        self._running_heavy = 0
+        self._virtual_time = 0.0
+        self._tenant_finish = {}
+        self._tenant_queued = Counter()
+        self._sequence = 0
+
+    def _can_run(self, heavy):
+        return self._running < self.max_concurrent and (not heavy or self._running_heavy < self.max_heavy)
+
+    def _start(self, heavy):
+        self._running += 1
+        self._running_heavy += heavy
+
+    def _retry_after(self):
+        # Rough time for the queue ahead to drain, assuming a second per queued command and slot
+        return max(1, math.ceil(len(self._queue) / self.max_concurrent))
+
+    def _enqueue(self, tenant, weight, cost, heavy, loop=None):
+        """
+        Start the command now if a slot is free and nobody eligible is waiting, else queue it.
+
+        Returns:
+            _Waiter or None if the command may run immediately.
+        """
+        with self._lock:
+            if self._can_run(heavy) and not any(heavy or not waiter.heavy for waiter in self._queue):
+                self._start(heavy)
+                return None
+            if len(self._queue) >= self.max_queued or self._tenant_queued[tenant] >= self.max_queued_per_tenant:
+                raise HypervisorBusy(self.host, self._retry_after())
+
+            start_tag = max(self._virtual_time, self._tenant_finish.get(tenant, 0.0))
+            finish_tag = start_tag + cost / weight
+            self._tenant_finish[tenant] = finish_tag
+            self._sequence += 1
+            waiter = _Waiter(tenant, start_tag, finish_tag, heavy, self._sequence, loop)
+            self._queue.append(waiter)
+            self._tenant_queued[tenant] += 1
+            return waiter
+
+    def _dispatch(self):
+        """
+        Grant free slots to the eligible waiters with the earliest finish tags. Called with the lock held.
+        """
+        while self._queue and self._running < self.max_concurrent:
+            eligible = [waiter for waiter in self._queue if self._can_run(waiter.heavy)]
+            if not eligible:
+                return
+            waiter = min(eligible, key=lambda waiter: (waiter.finish_tag, waiter.sequence))
+            self._remove(waiter)
+            self._virtual_time = max(self._virtual_time, waiter.start_tag)
+            self._start(waiter.heavy)
+            waiter.grant()
+
+    def _remove(self, waiter):
+        self._queue.remove(waiter)
+        self._tenant_queued[waiter.tenant] -= 1
+        if not self._tenant_queued[waiter.tenant]:
+            del self._tenant_queued[waiter.tenant]
+
+    def _abandon(self, waiter):
+        """
+        Give up on a waiter that timed out. Returns True if it was granted in the meantime.
+        """
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._remove(waiter)
+            raise HypervisorBusy(self.host, self._retry_after())
+
+    def release(self, heavy):
+        with self._lock:
+            self._running -= 1
+            self._running_heavy -= heavy
+            if not self._queue:
+                # Idle: forget the tags so an early burst is not held against a tenant forever
+                self._tenant_finish.clear()
+            self._dispatch()
+
+    def acquire(self, tenant, weight, cost, heavy, timeout):
+        waiter = self._enqueue(tenant, weight, cost, heavy)
+        if waiter is not None and not waiter.event.wait(timeout):
+            self._abandon(waiter)
+
+    async def aacquire(self, tenant, weight, cost, heavy, timeout):
+        waiter = self._enqueue(tenant, weight, cost, heavy, asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+        except asyncio.CancelledError:
+            # The request went away: hand the slot on if it was granted meanwhile, else leave the queue
+            try:
+                granted = self._abandon(waiter)
+            except HypervisorBusy:
+                granted = False
+            if granted:
+                self.release(heavy)
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {'running': self._running, 'running_heavy': self._running_heavy, 'queued': len(self._queue)}
+
+
+class HostSlots:
+    """
+    Host-wide slots of heavy commands, shared by every worker through the cache.
+
+    Parameters:
+        host (str): The host.
+        count (int): Heavy commands running at once on the host.
+    """
+    def __init__(self, host, count):
+        self.host = host
+        self.count = count
+
+    @property
+    def expiry(self):
+        # A slot outlives a crashed holder by at most one heavy command
+        return settings.HYPERVISOR_HEAVY_COMMAND_TIMEOUT + settings.HYPERVISOR_CONNECT_TIMEOUT + 60
+
+    def try_acquire(self):
+        """
+        Returns:
+            tuple: (cache key, token) of the slot taken, or None if all are taken.
+        """
+        token = uuid.uuid4().hex
+        for index in range(self.count):
+            key = HEAVY_SLOT_KEY.format(self.host, index)
+            if cache.add(key, token, self.expiry):
+                return key, token
+        return None
+
+    def release(self, slot):
+        key, token = slot
+        if cache.get(key) == token:
+            cache.delete(key)
+
+    def acquire(self, timeout):
+        """
+        Wait up to timeout seconds for a slot.
+
+        Raises:
+            HypervisorBusy: If the host's slots stay taken.
+        """
+        started = time.monotonic()
+        delay = SLOT_POLL_INITIAL_DELAY
+        while (slot := self.try_acquire()) is None:
+            waited = time.monotonic() - started
+            if waited >= timeout:
+                raise HypervisorBusy(self.host, max(1, math.ceil(settings.HYPERVISOR_QUEUE_TIMEOUT)))
+            time.sleep(min(delay, timeout - waited))
+            delay = min(delay * 2, SLOT_POLL_MAX_DELAY)
+        return slot
+
+    async def aacquire(self, timeout):
+        """
+        Async version of acquire(), waiting on the event loop.
+        """
+        started = time.monotonic()
+        delay = SLOT_POLL_INITIAL_DELAY
+        while (slot := await sync_to_async(self.try_acquire)()) is None:
+            waited = time.monotonic() - started
+            if waited >= timeout:
+                raise HypervisorBusy(self.host, max(1, math.ceil(settings.HYPERVISOR_QUEUE_TIMEOUT)))
+            await asyncio.sleep(min(delay, timeout - waited))
+            delay = min(delay * 2, SLOT_POLL_MAX_DELAY)
+        return slot
+
+    async def arelease(self, slot):
+        await sync_to_async(self.release)(slot)
+
+
+def get_host_slots(host):
+    return HostSlots(host, settings.HYPERVISOR_MAX_HEAVY_COMMANDS)
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(host):
+    with _schedulers_lock:
+        if host not in _schedulers:
+            _schedulers[host] = HostScheduler(
+                host,
+                settings.HYPERVISOR_MAX_CONCURRENT_COMMANDS,
+                settings.HYPERVISOR_MAX_HEAVY_COMMANDS,
+                settings.HYPERVISOR_MAX_QUEUED_COMMANDS,
+                settings.HYPERVISOR_MAX_QUEUED_PER_TENANT,
+            )
+        return _schedulers[host]
+
+
+def _record_wait(host, heavy, waited, rejected):
+    labels = {'host': host, 'class': 'heavy' if heavy else 'light'}
+    record('queue', waited)
+    observe('hypervisor_queue_wait_seconds', labels, waited)
+    if rejected:
+        increment('hypervisor_rejections_total', labels)
+
+
+@contextmanager
+def admit(host, command):
+    """
+    Run the enclosed command once the host's scheduler admits it.
+
+    Raises:
+        HypervisorBusy: If the queue is full or the wait exceeds HYPERVISOR_QUEUE_TIMEOUT.
+    """
+    scheduler = get_scheduler(host)
+    _, heavy, cost = get_command_class(command)
+    tenant, weight = get_current_tenant()
+    timeout = settings.HYPERVISOR_QUEUE_TIMEOUT
+    started = time.monotonic()
+    slot = None
+    try:
+        scheduler.acquire(tenant, weight, cost, heavy, timeout)
+        if heavy:
+            try:
+                slot = get_host_slots(host).acquire(max(0, timeout - (time.monotonic() - started)))
+            except BaseException:
+                scheduler.release(heavy)
+                raise
+    except HypervisorBusy:
+        _record_wait(host, heavy, time.monotonic() - started, rejected=True)
+        raise
+    _record_wait(host, heavy, time.monotonic() - started, rejected=False)
+    try:
+        yield
+    finally:
+        if slot:
+            get_host_slots(host).release(slot)
+        scheduler.release(heavy)
+
+
+@asynccontextmanager
+async def aadmit(host, command):
+    """
+    Async version of admit(), waiting on the event loop.
+    """
+    scheduler = get_scheduler(host)
+    _, heavy, cost = get_command_class(command)
+    tenant, weight = get_current_tenant()
+    timeout = settings.HYPERVISOR_QUEUE_TIMEOUT
+    started = time.monotonic()
+    slot = None
+    try:
+        await scheduler.aacquire(tenant, weight, cost, heavy, timeout)
+        if heavy:
+            try:
+                slot = await get_host_slots(host).aacquire(max(0, timeout - (time.monotonic() - started)))
+            except BaseException:  # Including the request going away
+                scheduler.release(heavy)
+                raise
+    except HypervisorBusy:
+        _record_wait(host, heavy, time.monotonic() - started, rejected=True)
+        raise
+    _record_wait(host, heavy, time.monotonic() - started, rejected=False)
+    try:
+        yield
+    finally:
+        if slot:
+            await get_host_slots(host).arelease(slot)
+        scheduler.release(heavy)
@@ -0,0 +1,328 @@
+"""
+Hypervisor-side agent.
+
+Runs on each VirtualBox host next to VBoxSVC and answers batched JSON-RPC
+2.0 requests from the Django app (see agent_client.py) through one
+long-lived VirtualBox API session, so listing 500 VMs is one HTTP request
+and a walk over in-memory API objects rather than 500 VBoxManage
+processes spawned over SSH.
+
+Methods:
+    list()                               [{name, id, state, memory, cpu}] of every VM
+    info(name)                           {name, id, state, memory, cpu, snapshots}
+    start(name, type='headless')         Launch the VM and wait until it runs
+    stop(name)                           Press its ACPI power button
+    snapshot(name, snapshot, description='')  Take a snapshot and wait for it
+    metrics(names)                       {VM name: {metric: latest value}} of the performance collector
+
+Every request is signed with the shared secret (HMAC-SHA256 of
+"<timestamp>.<body>" in the X-Agent-Signature header, the Unix timestamp in
+X-Agent-Timestamp) and refused if the signature is wrong or the timestamp
+is more than MAX_CLOCK_SKEW seconds off. The agent also remembers the
+signatures it accepted for as long as their timestamp is valid and refuses
+them again, so a captured request cannot be replayed at all. (The client
+gives each call a random id, so no two requests share a body.) Serve over
+TLS (--certfile/--keyfile) when the network between the app and the host
+is not trusted.
+
+The agent only needs Python 3 and the VirtualBox SDK bindings (vboxapi),
+not Django, so this file can be copied to the host as it is:
+
+    HYPERVISOR_AGENT_SECRET=... python3 agent.py --bind 0.0.0.0:8765
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+RPC_PATH = '/rpc'
+SIGNATURE_HEADER = 'X-Agent-Signature'
+TIMESTAMP_HEADER = 'X-Agent-Timestamp'
+MAX_CLOCK_SKEW = 300
+MAX_BATCH_SIZE = 1000
+MAX_BODY_BYTES = 1024 * 1024
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+
+def sign(secret, timestamp, body):
+    """
+    Signature of a request body (bytes) sent at timestamp.
+    """
+    return hmac.new(secret.encode(), f'{timestamp}.'.encode() + body, hashlib.sha256).hexdigest()
+
+
+def verify(secret, timestamp, signature, body, now=None):
+    try:
+        timestamp = int(timestamp)
+    except (TypeError, ValueError):
+        return False
+    if abs((now or time.time()) - timestamp) > MAX_CLOCK_SKEW:
+        return False
+    return hmac.compare_digest(sign(secret, timestamp, body), signature or '')
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class VirtualBoxSession:
+    """
+    The VirtualBox API, opened once for the life of the agent.
+    """
+    def __init__(self):
+        from vboxapi import VirtualBoxManager
+
+        self.manager = VirtualBoxManager(None, None)
+        self.constants = self.manager.constants
+        self.states = {
+            getattr(self.constants, name): name[len('MachineState_'):].lower()
+            for name in dir(self.constants) if name.startswith('MachineState_')
+        }
+
+    def init_thread(self):
+        # Each request thread has to register with the XPCOM/COM runtime
+        self.manager.initPerThread()
+
+    def deinit_thread(self):
+        self.manager.deinitPerThread()
+
+    @property
+    def vbox(self):
+        return self.manager.getVirtualBox()
+
+    def _describe(self, machine):
+        return {
+            'name': machine.name,
+            'id': machine.id,
+            'state': self.states.get(machine.state, str(machine.state)),
+            'memory': machine.memorySize,
+            'cpu': machine.CPUCount,
+        }
+
+    def _find(self, name):
+        try:
+            return self.vbox.findMachine(name)
+        except Exception:
+            raise RPCError(INVALID_PARAMS, f'No VM named {name!r}')
+
+    def _wait(self, progress):
+        progress = progress[0] if isinstance(progress, (list, tuple)) else progress
+        progress.waitForCompletion(-1)
+        if progress.resultCode:
+            raise RPCError(SERVER_ERROR, progress.errorInfo.text if progress.errorInfo else f'Failed with {progress.resultCode}')
+
+    def list(self):
+        return [self._describe(machine) for machine in self.manager.getArray(self.vbox, 'machines')]
+
+    def info(self, name):
+        machine = self._find(name)
+        info = self._describe(machine)
+        info['snapshots'] = machine.snapshotCount
+        return info
+
+    def start(self, name, type='headless'):
+        machine = self._find(name)
+        session = self.manager.getSessionObject()
+        try:
+            self._wait(machine.launchVMProcess(session, type, []))
+        finally:
+            session.unlockMachine()
+        return self._describe(machine)
+
+    def stop(self, name):
+        machine = self._find(name)
+        session = self.manager.getSessionObject()
+        machine.lockMachine(session, self.constants.LockType_Shared)
+        try:
+            session.console.powerButton()
+        finally:
+            session.unlockMachine()
+        return self._describe(machine)
+
+    def snapshot(self, name, snapshot, description=''):
+        machine = self._find(name)
+        session = self.manager.getSessionObject()
+        machine.lockMachine(session, self.constants.LockType_Shared)
+        try:
+            self._wait(session.machine.takeSnapshot(snapshot, description, True))
+        finally:
+            session.unlockMachine()
+        return {'name': name, 'snapshot': snapshot}
+
+    def metrics(self, names):
+        collector = self.vbox.performanceCollector
+        values, metric_names, objects, _, scales, _, indices, lengths = collector.queryMetricsData(names, [])
+        machines = {machine.id: machine.name for machine in self.manager.getArray(self.vbox, 'machines')}
+        result = {}
+        for position, metric in enumerate(metric_names):
+            if not lengths[position]:
+                continue
+            try:
+                owner = machines.get(self.manager.queryInterface(objects[position], 'IMachine').id, 'host')
+            except Exception:
+                owner = 'host'
+            latest = values[indices[position] + lengths[position] - 1]
+            result.setdefault(owner, {})[metric] = latest / (scales[position] or 1)
+        return result
+
+
+class Agent:
+    """
+    Authentication and JSON-RPC dispatch, independent of the HTTP server.
+    """
+    METHODS = ('list', 'info', 'start', 'stop', 'snapshot', 'metrics')
+
+    def __init__(self, session, secret):
+        self.session = session
+        self.secret = secret
+        self._seen = set()  # Signatures accepted while their timestamp still passes verify()
+        self._seen_order = deque()  # (timestamp, signature) in the order they were accepted
+        self._seen_lock = threading.Lock()
+
+    def _is_replay(self, timestamp, signature, now=None):
+        now = now or time.time()
+        with self._seen_lock:
+            while self._seen_order and now - self._seen_order[0][0] > MAX_CLOCK_SKEW:
+                self._seen.discard(self._seen_order.popleft()[1])
+            if signature in self._seen:
+                return True
+            self._seen.add(signature)
+            self._seen_order.append((int(timestamp), signature))
+            return False
+
+    def _call(self, request):
+        if not isinstance(request, dict) or request.get('jsonrpc') != '2.0' or not isinstance(request.get('method'), str):
+            raise RPCError(INVALID_REQUEST, 'Invalid request')
+        if request['method'] not in self.METHODS:
+            raise RPCError(METHOD_NOT_FOUND, f"Unknown method {request['method']!r}")
+        params = request.get('params', {})
+        if not isinstance(params, dict):
+            raise RPCError(INVALID_PARAMS, 'params must be an object')
+        try:
+            return getattr(self.session, request['method'])(**params)
+        except TypeError as error:
+            raise RPCError(INVALID_PARAMS, str(error))
+
+    def _respond(self, request):
+        request_id = request.get('id') if isinstance(request, dict) else None
+        try:
+            return {'jsonrpc': '2.0', 'id': request_id, 'result': self._call(request)}
+        except RPCError as error:
+            return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': error.code, 'message': error.message}}
+        except Exception as error:
+            logger.exception('RPC call failed')
+            return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': SERVER_ERROR, 'message': str(error)}}
+
+    def handle(self, body, timestamp, signature):
+        """
+        Answer one HTTP request body.
+
+        Returns:
+            tuple: (HTTP status, response object)
+        """
+        if not verify(self.secret, timestamp, signature, body):
+            return 401, {'jsonrpc': '2.0', 'id': None, 'error': {'code': INVALID_REQUEST, 'message': 'Bad signature'}}
+        if self._is_replay(timestamp, signature):
+            return 401, {'jsonrpc': '2.0', 'id': None, 'error': {'code': INVALID_REQUEST, 'message': 'Replayed request'}}
+        try:
+            requests = json.loads(body)
+        except ValueError:
+            return 400, {'jsonrpc': '2.0', 'id': None, 'error': {'code': PARSE_ERROR, 'message': 'Parse error'}}
+
+        if isinstance(requests, list) and not 0 < len(requests) <= MAX_BATCH_SIZE:
+            return 400, {'jsonrpc': '2.0', 'id': None, 'error': {'code': INVALID_REQUEST, 'message': f'Batches hold 1 to {MAX_BATCH_SIZE} calls'}}
+        self.session.init_thread()
+        try:
+            if isinstance(requests, list):
+                return 200, [self._respond(request) for request in requests]
+            return 200, self._respond(requests)
+        finally:
+            self.session.deinit_thread()
+
+
+class AgentRequestHandler(BaseHTTPRequestHandler):
+    agent = None  # Set by make_server()
+
+    def do_POST(self):
+        if self.path != RPC_PATH:
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            self.send_error(413)
+            return
+        body = self.rfile.read(length)
+        status, response = self.agent.handle(body, self.headers.get(TIMESTAMP_HEADER), self.headers.get(SIGNATURE_HEADER))
+        payload = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.info(f'{self.client_address[0]} {format % args}')
+
+
+def make_server(bind, secret, session=None, certfile=None, keyfile=None):
+    """
+    Build the agent's HTTP server (call serve_forever() on it).
+
+    Parameters:
+        bind (tuple): (address, port) to listen on.
+        secret (str): Shared secret of the request signatures.
+        session: VirtualBoxSession, opened here by default.
+    """
+    handler = type('Handler', (AgentRequestHandler,), {'agent': Agent(session or VirtualBoxSession(), secret)})
+    server = ThreadingHTTPServer(bind, handler)
+    server.daemon_threads = True
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the VirtualBox API of this host to the hynfratech app')
+    parser.add_argument('--bind', default='127.0.0.1:8765', help='address:port to listen on')
+    parser.add_argument('--certfile', help='TLS certificate (PEM)')
+    parser.add_argument('--keyfile', help='TLS private key (PEM)')
+    args = parser.parse_args(argv)
+
+    secret = os.environ.get('HYPERVISOR_AGENT_SECRET')
+    if not secret:
+        parser.error('HYPERVISOR_AGENT_SECRET is not set')
+    address, _, port = args.bind.rpartition(':')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    server = make_server((address, int(port)), secret, certfile=args.certfile, keyfile=args.keyfile)
+    logger.info(f'Agent listening on {args.bind}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
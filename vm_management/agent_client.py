@@ -0,0 +1,141 @@
+"""
+Client of the hypervisor-side agent (see agent.py).
+
+When HYPERVISOR_AGENT_URL is set, the bulk reads of the app (the
+reconciler's inventory, the metrics collector) ask the host's agent in one
+signed JSON-RPC batch instead of running vboxmanage over SSH. The URL may
+contain {host}, e.g. 'https://{host}:8765/rpc', for one agent per host.
+
+Agent requests go the way of vboxmanage commands: through the host's
+scheduler (admission.py) and circuit breaker (resilience.py), and into the
+command statistics as 'agent <method>' (hypervisor_stats.py).
+"""
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from django.conf import settings
+
+from .admission import admit
+from .agent import SIGNATURE_HEADER, TIMESTAMP_HEADER, sign
+from .hypervisor_stats import record_command
+from .metrics import timed
+from .resilience import HostConnectionError, call
+
+
+class AgentError(Exception):
+    """
+    The agent refused a request or one of its calls failed.
+    """
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class AgentClient:
+    """
+    Parameters:
+        url (str): URL of the agent's /rpc endpoint.
+        secret (str): Shared secret of the request signatures.
+        timeout (float): Seconds to wait for the agent's answer.
+        host (str): Host the agent runs on, the URL's by default.
+    """
+    def __init__(self, url, secret, timeout, host=None):
+        self.url = url
+        self.secret = secret
+        self.timeout = timeout
+        self.host = host or urllib.parse.urlsplit(url).hostname
+
+    def _send(self, payload):
+        body = json.dumps(payload).encode()
+        timestamp = int(time.time())
+        request = urllib.request.Request(self.url, data=body, method='POST', headers={
+            'Content-Type': 'application/json',
+            TIMESTAMP_HEADER: str(timestamp),
+            SIGNATURE_HEADER: sign(self.secret, timestamp, body),
+        })
+        try:
+            with timed('hypervisor'), urllib.request.urlopen(request, timeout=self.timeout) as response:
+                answer = response.read()
+                return json.loads(answer), len(answer)
+        except urllib.error.HTTPError as error:
+            raise AgentError(f'Agent at {self.url} answered {error.code}', error.code) from error
+        except (urllib.error.URLError, OSError, ValueError) as error:
+            raise HostConnectionError(f'{self.url}: {error!r}') from error
+
+    def _post(self, calls):
+        command = f'agent {calls[0][0]}' if len(calls) == 1 else 'agent batch'
+
+        def run_once():
+            # Fresh ids on every attempt: the agent refuses a signature it has already seen
+            requests = [{'jsonrpc': '2.0', 'id': uuid.uuid4().hex, 'method': method, 'params': params} for method, params in calls]
+            with admit(self.host, command):
+                started = time.monotonic()
+                try:
+                    responses, size = self._send(requests)
+                except HostConnectionError as error:
+                    record_command(self.host, command, None, str(error), time.monotonic() - started, 0)
+                    raise
+                except AgentError as error:
+                    record_command(self.host, command, error.code, str(error), time.monotonic() - started, 0)
+                    raise
+
+            record_command(self.host, command, 0, '', time.monotonic() - started, size)
+            return requests, responses
+
+        return call(self.host, command, run_once)
+
+    def batch(self, calls):
+        """
+        Run several calls in one request.
+
+        Parameters:
+            calls (list): (method, params dict) pairs.
+
+        Returns:
+            list: The result of each call in order, or an AgentError for the calls that failed.
+
+        Raises:
+            AgentError: If the agent refused the request.
+            HypervisorBusy: If the host's queue is full (see admission.py).
+            HypervisorUnavailable: If the agent cannot be reached (see resilience.py).
+        """
+        requests, responses = self._post(calls)
+        responses = {response.get('id'): response for response in responses}
+        results = []
+        for request in requests:
+            response = responses.get(request['id'], {'error': {'message': 'No response'}})
+            if 'error' in response:
+                results.append(AgentError(response['error'].get('message'), response['error'].get('code')))
+            else:
+                results.append(response['result'])
+        return results
+
+    def call(self, method, **params):
+        """
+        Run one call.
+
+        Raises:
+            AgentError: If it failed.
+        """
+        result, = self.batch([(method, params)])
+        if isinstance(result, AgentError):
+            raise result
+        return result
+
+
+def get_agent(host):
+    """
+    Get the client of a host's agent, or None if no agent is configured.
+    """
+    if not settings.HYPERVISOR_AGENT_URL:
+        return None
+    return AgentClient(
+        settings.HYPERVISOR_AGENT_URL.format(host=host),
+        settings.HYPERVISOR_AGENT_SECRET,
+        settings.HYPERVISOR_AGENT_TIMEOUT,
+        host,
+    )
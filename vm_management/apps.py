@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class VmManagementConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'vm_management'
+
+    def ready(self):
+        # Register model signal handlers (page version stamps)
+        from . import signals  # noqa: F401
@@ -0,0 +1,336 @@
+"""
+Async versions of the hypervisor-bound views.
+
+They use the async ORM and the non-blocking SSH client, so under an ASGI
+server one worker process can keep hundreds of hypervisor calls in flight
+instead of pinning a thread per call. Behaviour matches the synchronous
+views in views.py.
+
+vm_events, the live event stream of the VM list, is async only: it holds
+its connection open and must not pin a worker thread while doing so.
+"""
+import asyncio
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.contrib.auth.views import redirect_to_login
+from django.shortcuts import redirect, render
+from django.urls import reverse
+
+from accounts.models import CustomUser, UserRole
+from .admission import get_plan_weight, reset_current_tenant, set_current_tenant
+from .hypervisor import arun_vboxmanage_command, host_username, host_password, host_ip
+from .events import broker, listener, publish_job
+from .locks import VMLock, VMLockTimeout, transition_status
+from .models import VM, ActionLog, Payment, Subscription, Backup
+from .versioning import user_versioned
+from .vm_metrics import COLLECT_INTERVAL, get_summary
+from .warm_pool import aclaim
+from .backup_store import get_snapshot_uuid
+
+
+def admin_or_standard_user_required(view_func):
+    """
+    Async decorator to check if the user is logged in and is either an admin or a standard user.
+    If not, they are redirected to the login or 'access_denied' page.
+    """
+    @wraps(view_func)
+    async def _wrapped_view(request, *args, **kwargs):
+        user = await request.auser()
+        # Templates read request.user synchronously, so hand them the already loaded user
+        request.user = user
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+
+        if user.role in [UserRole.ADMIN, UserRole.STANDARD_USER]:
+            return await view_func(request, *args, **kwargs)
+        return redirect(reverse('access_denied'))
+    return _wrapped_view
+
+def subscription_required(view_func):
+    """
+    Async decorator to check if the user has an active subscription.
+    If not, they are redirected to the 'services' page.
+    The view's hypervisor commands are attributed to the user's plan.
+    """
+    @wraps(view_func)
+    async def _wrapped_view(request, *args, **kwargs):
+        user = await request.auser()
+        request.user = user
+        try:
+            subscription = await Subscription.objects.select_related('rate_plan').aget(user=user)
+        except Subscription.DoesNotExist:
+            return redirect('services')
+
+        if not subscription.active:
+            return redirect('user_payments')
+
+        token = set_current_tenant(user.id, get_plan_weight(subscription.rate_plan))
+        try:
+            return await view_func(request, *args, **kwargs)
+        finally:
+            reset_current_tenant(token)
+    return _wrapped_view
+
+def vm_locked(operation):
+    """
+    Async decorator running a view that operates on one VM under that VM's lock (see views.vm_locked).
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        async def _wrapped_view(request, vm_id, *args, **kwargs):
+            lock = VMLock(vm_id, operation)
+            try:
+                await lock.aacquire(settings.VM_LOCK_TIMEOUT)
+            except VMLockTimeout:
+                messages.error(request, "Another operation on this VM is still in progress. Please try again shortly.")
+                return redirect('vm_list')
+            try:
+                return await view_func(request, vm_id, *args, **kwargs)
+            finally:
+                await lock.arelease()
+        return _wrapped_view
+    return decorator
+
+def check_host_credentials():
+    if not host_username or not host_ip or not host_password:
+        raise ValueError("HOST_USER, HOST_IP, or HOST_PASSWORD environment variables are not set.")
+
+async def run_command(command):
+    return await arun_vboxmanage_command(host_ip, host_username, host_password, command)
+
+
+@admin_or_standard_user_required
+@subscription_required
+async def create_vm(request):
+    """
+    Create a new VM (async version of views.create_vm).
+
+    The three vboxmanage calls still run in order, but the worker is free to
+    serve other requests while they are in flight.
+    """
+    user = await request.auser()
+    subscription = await Subscription.objects.select_related(
+        'rate_plan', 'parent_account__subscription__rate_plan'
+    ).aget(user=user)
+
+    # Determine which user should have their limits applied (for multi-client accounts)
+    if subscription.parent_account:
+        parent_account = subscription.parent_account
+        managed_users = CustomUser.objects.filter(subscription__parent_account=parent_account)
+        user_vms_count = await VM.objects.filter(user__in=managed_users).acount()
+        plan_limit = parent_account.subscription.rate_plan.max_vms
+    else:
+        user_vms_count = await VM.objects.filter(user=user).acount()
+        plan_limit = subscription.rate_plan.max_vms
+
+    # Check if user has reached their VM creation limit
+    if user_vms_count >= plan_limit:
+        return render(request, 'accounts/access_denied.html', {'error': f"You've reached your VM creation limit of {plan_limit} VMs."})
+
+    # VM creation logic
+    if request.method == 'POST':
+        name = request.POST.get('name')
+        disk_size = min(int(request.POST.get('disk_size')), 2048)  # Enforce a maximum disk size of 2048 MB
+        cpu = min(int(request.POST.get('cpu', 1)), 2)  # Enforce a maximum of 2 CPU cores
+        memory = int(request.POST.get('memory', 256))
+
+        # Calculate price based on disk size
+        price_per_mb = 0.01  # Example price per MB
+        extra_mb = max(disk_size - 1024, 0)
+        price = extra_mb * price_per_mb
+
+        if price != 0:
+            # Create a payment entry with status pending
+            await Payment.objects.acreate(user=user, amount=price, status='pending')
+
+        check_host_credentials()
+
+        if not await aclaim(name, cpu, memory, disk_size):
+            await run_command(f'vboxmanage createvm --name {name} --register')
+            await run_command(f'vboxmanage modifyvm {name} --memory {memory} --cpus {cpu} --vram 16 --nic1 nat')
+            await run_command(f'vboxmanage createhd --filename ~/VirtualBox\\ VMs/{name}/{name}.vdi --size {disk_size}')
+            await run_command(f'vboxmanage storagectl {name} --name SATA --add sata --controller IntelAhci')
+            await run_command(f'vboxmanage storageattach {name} --storagectl SATA --port 0 --device 0 --type hdd --medium ~/VirtualBox\\ VMs/{name}/{name}.vdi')
+
+        # Save VM in database
+        vm = await VM.objects.acreate(name=name, user=user, disk_size=disk_size, status='stopped', cpu=cpu, memory=memory, price=price)
+        await ActionLog.objects.acreate(action_type='create', vm=vm, user=user)
+
+        return redirect('vm_list')
+
+    return render(request, 'vm_management/create_vm_clean.html')
+
+@subscription_required
+@vm_locked('backup')
+async def backup_vm(request, vm_id):
+    """
+    Create a backup of a VM (async version of views.backup_vm).
+    """
+    try:
+        vm = await VM.objects.select_related('user').aget(id=vm_id)
+        subscription = await Subscription.objects.select_related(
+            'rate_plan', 'parent_account__subscription__rate_plan'
+        ).aget(user=vm.user)
+    except VM.DoesNotExist:
+        return render(request, 'accounts/access_denied.html', {'error': "VM does not exist."})
+
+    # Determine which user should have their limits applied (for multi-client accounts)
+    if subscription.parent_account:
+        parent_account = subscription.parent_account
+        managed_users = CustomUser.objects.filter(subscription__parent_account=parent_account)
+        user_backups_count = await Backup.objects.filter(user__in=managed_users).acount()
+        plan_limit = parent_account.subscription.rate_plan.max_backups
+    else:
+        user_backups_count = await Backup.objects.filter(user=vm.user).acount()
+        plan_limit = subscription.rate_plan.max_backups
+
+    # Check if user has reached their backup creation limit
+    if user_backups_count >= plan_limit:
+        return render(request, 'accounts/access_denied.html', {'error': f"You've reached your backup creation limit of {plan_limit} backups."})
+
+    check_host_credentials()
+
+    user = await request.auser()
+    await sync_to_async(publish_job)(vm.user_id, vm, 'backup')
+
+    # Use vboxmanage to take a snapshot (backup)
+    output = await run_command(f'vboxmanage snapshot {vm.name} take {vm.name}')
+
+    await Backup.objects.acreate(vm=vm, user=user, snapshot_uuid=get_snapshot_uuid(output))
+    await ActionLog.objects.acreate(action_type='backup', vm=vm, user=user)
+
+    messages.success(request, "Backup created successfully.")
+    return redirect('vm_list')
+
+@admin_or_standard_user_required
+@subscription_required
+@vm_locked('start')
+async def start_vm(request, vm_id):
+    """
+    Start a VM (async version of views.start_vm).
+    """
+    vm = await VM.objects.aget(id=vm_id)
+    user = await request.auser()
+    check_host_credentials()
+
+    if vm.user_id == user.id:  # Ensure user owns the VM
+        await sync_to_async(publish_job)(user.id, vm, 'start')
+        await run_command(f'vboxmanage startvm {vm.name} --type headless')
+
+        await sync_to_async(transition_status)(vm, 'running', from_statuses=['stopped'])
+
+        await ActionLog.objects.acreate(action_type='start', vm=vm, user=user)
+
+    return redirect('vm_list')
+
+@admin_or_standard_user_required
+@subscription_required
+@vm_locked('stop')
+async def stop_vm(request, vm_id):
+    """
+    Stop a VM (async version of views.stop_vm).
+    """
+    vm = await VM.objects.aget(id=vm_id)
+    user = await request.auser()
+    check_host_credentials()
+
+    if vm.user_id == user.id:  # Ensure user owns the VM
+        await sync_to_async(publish_job)(user.id, vm, 'stop')
+        await run_command(f'vboxmanage controlvm {vm.name} acpipowerbutton')
+
+        await sync_to_async(transition_status)(vm, 'stopped', from_statuses=['running'])
+
+        await ActionLog.objects.acreate(action_type='stop', vm=vm, user=user)
+
+    return redirect('vm_list')
+
+@admin_or_standard_user_required
+@user_versioned(refresh_interval=COLLECT_INTERVAL)
+@subscription_required
+async def vm_details(request, vm_id):
+    """
+    Show the details of a VM (async version of views.vm_details).
+
+    The VM info and the snapshot list are fetched from the host concurrently.
+    """
+    vm = await VM.objects.aget(id=vm_id)
+    user = await request.auser()
+    check_host_credentials()
+
+    if vm.user_id != user.id:  # Ensure user owns the VM
+        return redirect('vm_list')
+
+    vm_info_output, snapshots_output = await asyncio.gather(
+        run_command(f'vboxmanage showvminfo {vm.name}'),
+        run_command(f'vboxmanage snapshot {vm.name} list'),
+    )
+
+    # Process vm_info_output into a dictionary
+    vm_details_dict = {}
+    for line in vm_info_output.splitlines():
+        if ':' in line:
+            key, value = line.split(':', 1)  # Split by the first colon
+            vm_details_dict[key.strip()] = value.strip()  # Clean up spaces
+
+    # Process snapshots_output into a list
+    vm_details_dict['Snapshots'] = [
+        line.split(':', 1)[1].strip() for line in snapshots_output.splitlines() if 'Name:' in line
+    ]
+
+    return render(request, 'vm_management/vm_details_clean.html', {
+        'vm': vm,
+        'vm_details': vm_details_dict,
+        'resource_metrics': await sync_to_async(get_summary)(vm.id),
+    })
+
+
+# Comment line sent when there is no event, so proxies do not drop an idle stream
+EVENT_KEEPALIVE_SECONDS = 20
+# Streams are closed after this long and the browser reconnects, so a stream
+# never outlives a deploy or a session logout by much
+EVENT_STREAM_SECONDS = 300
+EVENT_RETRY_MILLISECONDS = 3000
+
+
+def format_event(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event['data'], cls=DjangoJSONEncoder)}\n\n"
+
+
+@admin_or_standard_user_required
+async def vm_events(request):
+    """
+    Stream the user's VM changes, job starts and new action logs as server-sent events.
+
+    The vm_list page keeps one stream open instead of being reloaded to watch
+    a VM start or stop; events come from the in-process broker (see events.py).
+    """
+    user = await request.auser()
+    listener.ensure_started()
+
+    async def stream():
+        queue = broker.subscribe(user.id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + EVENT_STREAM_SECONDS
+        try:
+            yield f'retry: {EVENT_RETRY_MILLISECONDS}\n\n'
+            while loop.time() < deadline:
+                try:
+                    event = await asyncio.wait_for(queue.get(), min(EVENT_KEEPALIVE_SECONDS, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                yield format_event(event)
+        finally:
+            broker.unsubscribe(user.id, queue)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx must not buffer the stream
+    return response
@@ -0,0 +1,325 @@
+"""
+Chunked, deduplicated store of backup disk images.
+
+A backup is a snapshot, which only lives on the VirtualBox host as a
+differencing image next to the VM. The export_backups worker copies the
+disk as of the snapshot off the host: vboxmanage clonemedium flattens it
+into a raw image (raw rather than 'vboxmanage export', whose OVA is
+compressed as a whole so two exports share no bytes), which is streamed in
+BACKUP_CHUNK_SIZE chunks into a content-addressed store under
+BACKUP_STORE_ROOT, each chunk named by its SHA-256. Fixed-size chunks line
+up with the disk's blocks, so a block written since the last backup changes
+only the chunk holding it; every other chunk is already in the store and is
+neither compressed nor written again.
+
+Chunks are compressed with zlib on BACKUP_COMPRESS_THREADS threads while
+the next ones are read (zlib releases the GIL). The backup's manifest lists
+its chunk hashes in order; iter_backup() reads the image back from them.
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .hypervisor import open_host_file, run_vboxmanage_command, host_username, host_password, host_ip
+from .metrics import increment
+from .models import Backup
+
+logger = logging.getLogger(__name__)
+
+CODEC = 'zlib'
+COMPRESS_LEVEL = 6
+
+SNAPSHOT_INFO_COMMAND = 'vboxmanage snapshot {vm} showvminfo {snapshot}'
+MEDIUM_INFO_COMMAND = 'vboxmanage showmediuminfo disk {path}'
+CLONE_COMMAND = 'vboxmanage clonemedium disk {source} {target} --format RAW'
+CLOSE_COMMAND = 'vboxmanage closemedium disk {target} --delete'
+
+# 'snapshot take' ends with 'Snapshot taken. UUID: ...'
+SNAPSHOT_UUID_PATTERN = re.compile(r'UUID: ([0-9a-f-]{36})')
+
+# Attached disks in showvminfo, e.g. 'SATA (0, 0): /home/u/VirtualBox VMs/a/a.vdi (UUID: ...)'
+DISK_PATTERN = re.compile(r'\(\d+, \d+\): .+ \(UUID: ([0-9a-f-]{36})\)')
+
+# showmediuminfo starts with 'UUID:           ...' (its 'Parent UUID:' line does not match)
+MEDIUM_UUID_PATTERN = re.compile(r'^UUID:\s+([0-9a-f-]{36})', re.MULTILINE)
+
+# An export stuck in 'exporting' this long belongs to a worker that died
+STALE_EXPORTING_AFTER = timedelta(hours=6)
+
+# Chunks younger than this are never swept: an export may have found one and not saved its manifest yet
+SWEEP_GRACE = timedelta(days=1)
+
+
+class ChunkStore:
+    """
+    Compressed chunks on the local disk, at <root>/chunks/<first 2 hex digits>/<SHA-256>.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def get_path(self, digest):
+        return os.path.join(self.root, 'chunks', digest[:2], digest)
+
+    def has(self, digest):
+        """
+        Whether the chunk is stored. Refreshes its modification time, so sweep() leaves it alone.
+        """
+        try:
+            os.utime(self.get_path(digest))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, digest, data):
+        """
+        Compress and store a chunk.
+
+        Returns:
+            int: Size of the compressed chunk.
+        """
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+        path = self.get_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed, so a reader never sees half a chunk
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(descriptor, 'wb') as chunk:
+                chunk.write(compressed)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        return len(compressed)
+
+    def get(self, digest):
+        """
+        Read a chunk back.
+
+        Raises:
+            ValueError: If the chunk is corrupt.
+        """
+        with open(self.get_path(digest), 'rb') as chunk:
+            data = zlib.decompress(chunk.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f'Chunk {digest} is corrupt')
+        return data
+
+    def sweep(self, referenced, older_than):
+        """
+        Delete the chunks not in referenced that were last written or found before older_than (a timestamp).
+
+        Returns:
+            int: Number of chunks deleted.
+        """
+        deleted = 0
+        for directory, _, names in os.walk(os.path.join(self.root, 'chunks')):
+            for name in names:
+                path = os.path.join(directory, name)
+                if name in referenced or os.stat(path).st_mtime >= older_than:
+                    continue
+                os.unlink(path)
+                deleted += 1
+        return deleted
+
+
+def get_store():
+    return ChunkStore(settings.BACKUP_STORE_ROOT)
+
+
+@dataclass
+class StoreReport:
+    manifest: dict
+    written: int = 0  # Chunks compressed and written
+    reused: int = 0  # Chunks already in the store
+    stored_size: int = 0  # Compressed bytes written
+
+
+def _read_chunk(stream, size):
+    # Pipes and SFTP files may return less than asked for before the end
+    parts = []
+    while size:
+        part = stream.read(size)
+        if not part:
+            break
+        parts.append(part)
+        size -= len(part)
+    return b''.join(parts)
+
+
+def store_stream(stream, store=None):
+    """
+    Store a binary stream in chunks, skipping those already in the store.
+
+    Returns:
+        StoreReport
+    """
+    store = store or get_store()
+    chunk_size = settings.BACKUP_CHUNK_SIZE
+    threads = settings.BACKUP_COMPRESS_THREADS
+    report = StoreReport(manifest={'chunk_size': chunk_size, 'size': 0, 'codec': CODEC, 'chunks': []})
+    seen = set()
+    pending = deque()
+
+    with ThreadPoolExecutor(threads) as pool:
+        while True:
+            data = _read_chunk(stream, chunk_size)
+            if not data:
+                break
+            digest = hashlib.sha256(data).hexdigest()
+            report.manifest['chunks'].append(digest)
+            report.manifest['size'] += len(data)
+
+            # seen also catches repeats inside this stream (zeroed blocks) still being compressed
+            if digest in seen or store.has(digest):
+                report.reused += 1
+                continue
+            seen.add(digest)
+            pending.append(pool.submit(store.put, digest, data))
+            # Bounds the chunks held in memory when reading is faster than compressing
+            while len(pending) > 2 * threads:
+                report.stored_size += pending.popleft().result()
+                report.written += 1
+
+        for future in pending:
+            report.stored_size += future.result()
+            report.written += 1
+
+    increment('backup_chunks_total', {'result': 'written'}, report.written)
+    increment('backup_chunks_total', {'result': 'reused'}, report.reused)
+    return report
+
+
+def iter_backup(backup, store=None):
+    """
+    Yield the disk image of an exported backup, one chunk at a time.
+    """
+    store = store or get_store()
+    for digest in backup.manifest['chunks']:
+        yield store.get(digest)
+
+
+def get_snapshot_uuid(output):
+    """
+    Get the UUID of the snapshot from the output of 'snapshot take', or '' if it has none.
+    """
+    match = SNAPSHOT_UUID_PATTERN.search(output)
+    return match.group(1) if match else ''
+
+
+def get_source_disk(backup):
+    """
+    Get the disk to export: the UUID of the VM's first disk as of the snapshot.
+
+    VMs built by create_vm before it attached their disk have none; theirs is
+    the disk file create_vm made for them, exported as it is now since no
+    snapshot covers it. (Warm-pool clones always have one attached.)
+
+    Raises:
+        ValueError: If the snapshot has no disk attached and the VM has no such disk file.
+    """
+    snapshot = backup.snapshot_uuid or backup.vm.name
+    output = run_vboxmanage_command(host_ip, host_username, host_password, SNAPSHOT_INFO_COMMAND.format(vm=backup.vm.name, snapshot=snapshot))
+    match = DISK_PATTERN.search(output)
+    if match:
+        return match.group(1)
+
+    path = f'~/VirtualBox\\ VMs/{backup.vm.name}/{backup.vm.name}.vdi'
+    match = MEDIUM_UUID_PATTERN.search(run_vboxmanage_command(host_ip, host_username, host_password, MEDIUM_INFO_COMMAND.format(path=path)))
+    if not match:
+        raise ValueError(f'Snapshot {snapshot} of {backup.vm.name} has no disk attached and the VM has no disk file {backup.vm.name}.vdi')
+    return match.group(1)
+
+
+def export_backup(backup, store=None):
+    """
+    Copy the disk of a backup's snapshot from the host into the store and save its manifest.
+
+    Returns:
+        StoreReport
+    """
+    target = f'~/VirtualBox VMs/{backup.vm.name}/backup-{backup.id}.raw'
+    quoted_target = target.replace(' ', '\\ ')
+    run_vboxmanage_command(host_ip, host_username, host_password, CLONE_COMMAND.format(source=get_source_disk(backup), target=quoted_target))
+    try:
+        with open_host_file(host_ip, host_username, host_password, target) as stream:
+            report = store_stream(stream, store)
+    finally:
+        run_vboxmanage_command(host_ip, host_username, host_password, CLOSE_COMMAND.format(target=quoted_target))
+
+    backup.manifest = report.manifest
+    backup.stored_size = report.stored_size
+    backup.export_status = 'exported'
+    backup.exported_at = timezone.now()
+    backup.export_error = ''
+    backup.save(update_fields=['manifest', 'stored_size', 'export_status', 'exported_at', 'export_error'])
+    return report
+
+
+def claim_backup(now=None):
+    """
+    Mark the oldest backup waiting for its export as 'exporting' and return it, or None.
+    """
+    now = now or timezone.now()
+    due = Q(export_status='pending') | Q(export_status='exporting', export_started_at__lt=now - STALE_EXPORTING_AFTER)
+    for backup in Backup.objects.filter(due).select_related('vm').order_by('created_at')[:10]:
+        # Conditional update, so two workers never export the same backup
+        if Backup.objects.filter(due, id=backup.id).update(export_status='exporting', export_started_at=now):
+            return backup
+    return None
+
+
+@dataclass
+class ExportReport:
+    exported: list = field(default_factory=list)  # [(Backup, StoreReport)]
+    failed: list = field(default_factory=list)  # [(Backup, error)]
+    swept: int = 0
+
+
+def export_pending(limit=None):
+    """
+    Export the backups waiting for it, oldest first.
+
+    Returns:
+        ExportReport
+    """
+    report = ExportReport()
+    while limit is None or len(report.exported) + len(report.failed) < limit:
+        backup = claim_backup()
+        if backup is None:
+            break
+        try:
+            report.exported.append((backup, export_backup(backup)))
+        except Exception as error:
+            logger.exception(f'Exporting backup {backup.id} failed')
+            backup.export_status = 'failed'
+            backup.export_error = str(error)
+            backup.save(update_fields=['export_status', 'export_error'])
+            report.failed.append((backup, error))
+    return report
+
+
+def sweep(store=None, now=None):
+    """
+    Delete the chunks no backup refers to any more (their backups or VMs were deleted).
+
+    Returns:
+        int: Number of chunks deleted.
+    """
+    store = store or get_store()
+    now = now or timezone.now()
+    referenced = set()
+    # Manifests of backups still exporting are not saved yet; their chunks are protected by SWEEP_GRACE
+    for manifest in Backup.objects.filter(manifest__isnull=False).values_list('manifest', flat=True).iterator():
+        referenced.update(manifest['chunks'])
+    return store.sweep(referenced, (now - SWEEP_GRACE).timestamp())
@@ -0,0 +1,225 @@
+"""
+Live events for the VM list.
+
+VM changes, new ActionLog entries and the start of hypervisor jobs are
+published to the users they concern and pushed to their open vm_list pages
+over server-sent events (see async_views.vm_events), so nobody has to
+reload the page to see a VM finish starting.
+
+Each worker keeps an in-process broker of the streams it serves. On
+PostgreSQL events travel between processes (workers, the metrics
+collector, management commands) over LISTEN/NOTIFY on EVENT_CHANNEL; NOTIFY
+is transactional, so an event is only delivered if its change commits.
+Other databases (sqlite in development) deliver events to the publishing
+process only, once the transaction commits.
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+from collections import defaultdict
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections, transaction
+
+logger = logging.getLogger(__name__)
+
+EVENT_CHANNEL = 'vm_management_events'
+
+# NOTIFY payloads are limited to 8000 bytes
+MAX_PAYLOAD_BYTES = 7900
+
+# Events a slow client may fall behind by before it is told to reload instead
+SUBSCRIBER_QUEUE_SIZE = 100
+
+LISTEN_RECONNECT_SECONDS = 5
+
+
+class EventBroker:
+    """
+    In-process publish/subscribe of events by user.
+
+    Subscribers are asyncio queues of the stream views; publishers may run in
+    any thread (the listener thread, sync views), so events are handed to
+    each subscriber's event loop.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, user_id):
+        queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers[user_id].add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id, set())
+            subscribers.difference_update({entry for entry in subscribers if entry[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(user_id, None)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def dispatch(self, user_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(_put, queue, event)
+            except RuntimeError:  # the stream's event loop has closed
+                self.unsubscribe(user_id, queue)
+
+
+def _put(queue, event):
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        # The client fell behind: drop its backlog and have it reload the page once
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait({'type': 'resync', 'data': {}})
+
+
+broker = EventBroker()
+
+
+def dispatch_payload(payload):
+    """
+    Hand the events of one published payload to the local subscribers.
+    """
+    for user_id, event_type, data in json.loads(payload):
+        broker.dispatch(user_id, {'type': event_type, 'data': data})
+
+
+def _split_payloads(events):
+    payloads, batch = [], []
+    for event in events:
+        batch.append(event)
+        if len(batch) > 1 and len(json.dumps(batch, cls=DjangoJSONEncoder)) > MAX_PAYLOAD_BYTES:
+            payloads.append(json.dumps(batch[:-1], cls=DjangoJSONEncoder))
+            batch = [event]
+    if batch:
+        payloads.append(json.dumps(batch, cls=DjangoJSONEncoder))
+    return payloads
+
+
+def publish(events):
+    """
+    Publish events once the current transaction commits.
+
+    Parameters:
+        events (list): (user ID, event type, data) tuples.
+    """
+    events = [event for event in events if event[0]]
+    if not events:
+        return
+
+    for payload in _split_payloads(events):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, %s)', [EVENT_CHANNEL, payload])
+        else:
+            transaction.on_commit(lambda payload=payload: dispatch_payload(payload))
+
+
+def get_vm_data(vm):
+    return {
+        'id': vm.id,
+        'name': vm.name,
+        'status': vm.status,
+        'cpu': vm.cpu,
+        'memory': vm.memory,
+        'disk_size': vm.disk_size,
+    }
+
+
+def get_vm_events(vm, removed=False):
+    """
+    Events of a saved or deleted VM: its owner gets the new row, and a
+    previous owner (after a transfer) sees it removed.
+    """
+    if removed:
+        return [(vm.user_id, 'vm_removed', {'id': vm.id})]
+    events = [(vm.user_id, 'vm', get_vm_data(vm))]
+    previous_user_id = getattr(vm, '_loaded_user_id', None)
+    if previous_user_id and previous_user_id != vm.user_id:
+        events.append((previous_user_id, 'vm_removed', {'id': vm.id}))
+    return events
+
+
+def get_action_events(log):
+    data = {
+        'id': log.id,
+        'action_type': log.action_type,
+        'vm': log.vm_id,
+        'user': log.user_id,
+        'timestamp': log.timestamp,
+    }
+    events = [(log.user_id, 'action', data)]
+    if log.vm.user_id != log.user_id:
+        events.append((log.vm.user_id, 'action', data))
+    return events
+
+
+def publish_job(user_id, vm, action):
+    """
+    Tell a user a hypervisor operation on one of their VMs has started; its
+    completion arrives as the VM and ActionLog events.
+    """
+    publish([(user_id, 'job', {'vm': vm.id, 'action': action, 'state': 'started'})])
+
+
+class NotificationListener:
+    """
+    Thread LISTENing on EVENT_CHANNEL with a dedicated connection and
+    dispatching every notification to the local broker. Started by the
+    first event stream a worker serves.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_started(self):
+        if connections['default'].vendor != 'postgresql':
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='vm-events-listener', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception(f'Listening on {EVENT_CHANNEL} failed, reconnecting')
+                time.sleep(LISTEN_RECONNECT_SECONDS)
+
+    def _listen(self):
+        wrapper = connections['default']
+        raw_connection = wrapper.get_new_connection(wrapper.get_connection_params())
+        try:
+            raw_connection.autocommit = True
+            with raw_connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {EVENT_CHANNEL}')
+            while True:
+                if select.select([raw_connection], [], [], 60) == ([], [], []):
+                    continue
+                raw_connection.poll()
+                while raw_connection.notifies:
+                    notification = raw_connection.notifies.pop(0)
+                    try:
+                        dispatch_payload(notification.payload)
+                    except ValueError:
+                        logger.warning(f'Ignoring malformed event payload: {notification.payload[:200]}')
+        finally:
+            raw_connection.close()
+
+
+listener = NotificationListener()
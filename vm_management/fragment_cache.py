@@ -0,0 +1,152 @@
+import hashlib
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+
+OBJECT_VERSION_KEY = 'vm_management:object_version:{}:{}'
+FRAGMENT_KEY = 'vm_management:fragment:{}:{}'
+STATS_KEY = 'vm_management:fragment_stats:{}:{}'
+STATS_NAMES_KEY = 'vm_management:fragment_stats:names'
+
+# Hit/miss counters are kept per process and flushed to the shared cache
+# at most every STATS_FLUSH_INTERVAL seconds, so counting costs no cache round-trip per row.
+STATS_FLUSH_INTERVAL = 10
+
+_stats_lock = threading.Lock()
+_pending_stats = Counter()
+_last_flush = time.monotonic()
+
+
+def _version_key(instance):
+    return OBJECT_VERSION_KEY.format(instance._meta.label_lower, instance.pk)
+
+
+def bump_object_version(instance):
+    """
+    Invalidate every cached fragment rendered from a model instance.
+    """
+    cache.set(_version_key(instance), time.time_ns(), None)
+
+
+def bump_object_versions(instances):
+    """
+    Invalidate the fragments of many instances at once (e.g. after bulk_update(),
+    which does not send model signals).
+    """
+    stamp = time.time_ns()
+    cache.set_many({_version_key(instance): stamp for instance in instances}, None)
+
+
+def prefetch_object_versions(instances):
+    """
+    Load the fragment versions of many instances with one cache round-trip.
+
+    Versions are stored on the instances, so rendering a list only costs a
+    single get_many() instead of one cache lookup per row.
+    """
+    instances = [instance for instance in instances if instance is not None]
+    versions = cache.get_many({_version_key(instance) for instance in instances})
+    for instance in instances:
+        instance._fragment_version = versions.get(_version_key(instance))
+    return instances
+
+
+def get_object_version(instance):
+    """
+    Get the fragment version of a model instance, creating one if none exists.
+    """
+    version = getattr(instance, '_fragment_version', None)
+    if version is None:
+        key = _version_key(instance)
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+        instance._fragment_version = version
+    return version
+
+
+def make_fragment_key(fragment_name, vary_on):
+    """
+    Build the cache key of a fragment.
+
+    Model instances in vary_on are replaced by their label, primary key and
+    current version, so a signal bumping the version invalidates the fragment.
+    """
+    parts = []
+    for value in vary_on:
+        if hasattr(value, '_meta') and getattr(value, 'pk', None) is not None:
+            value = f'{value._meta.label_lower}:{value.pk}:{get_object_version(value)}'
+        parts.append(str(value))
+    digest = hashlib.md5(':'.join(parts).encode(), usedforsecurity=False).hexdigest()
+    return FRAGMENT_KEY.format(fragment_name, digest)
+
+
+def record_lookup(fragment_name, hit):
+    """
+    Count a fragment cache hit or miss.
+    """
+    global _last_flush
+    with _stats_lock:
+        _pending_stats[(fragment_name, 'hits' if hit else 'misses')] += 1
+        if time.monotonic() - _last_flush < STATS_FLUSH_INTERVAL:
+            return
+        pending = dict(_pending_stats)
+        _pending_stats.clear()
+        _last_flush = time.monotonic()
+    _flush_stats(pending)
+
+
+def _flush_stats(pending):
+    names = set(cache.get(STATS_NAMES_KEY, ()))
+    for (fragment_name, kind), count in pending.items():
+        names.add(fragment_name)
+        key = STATS_KEY.format(fragment_name, kind)
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key, count)
+        except ValueError:
+            cache.set(key, count, None)
+    cache.set(STATS_NAMES_KEY, sorted(names), None)
+
+
+def flush_stats():
+    """
+    Push this process's pending counters to the shared cache immediately.
+    """
+    global _last_flush
+    with _stats_lock:
+        pending = dict(_pending_stats)
+        _pending_stats.clear()
+        _last_flush = time.monotonic()
+    if pending:
+        _flush_stats(pending)
+
+
+def get_stats():
+    """
+    Return the hit/miss counters of every fragment, aggregated across workers.
+
+    Returns:
+        dict: {fragment_name: {'hits': int, 'misses': int}}
+    """
+    flush_stats()
+    stats = {}
+    for fragment_name in cache.get(STATS_NAMES_KEY, ()):
+        stats[fragment_name] = {
+            kind: cache.get(STATS_KEY.format(fragment_name, kind), 0)
+            for kind in ('hits', 'misses')
+        }
+    return stats
+
+
+def reset_stats():
+    flush_stats()
+    for fragment_name in cache.get(STATS_NAMES_KEY, ()):
+        cache.delete_many([STATS_KEY.format(fragment_name, kind) for kind in ('hits', 'misses')])
+    cache.delete(STATS_NAMES_KEY)
+
+
+def get_fragment_timeout():
+    return getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 60 * 60 * 24)
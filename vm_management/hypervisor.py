@@ -0,0 +1,464 @@
+"""
+Execution of vboxmanage commands on the VirtualBox host.
+
+run_vboxmanage_command() is the blocking (paramiko) client used by the
+synchronous views. arun_vboxmanage_command() is its non-blocking (asyncssh)
+counterpart used by the async views, which share a small pool of SSH
+connections per host and multiplex commands over SSH sessions.
+
+When the host is this machine and vboxmanage is installed here (Django
+running on the VirtualBox host as HOST_USER, whose VM registry and home
+the commands must see), HYPERVISOR_BACKEND = 'auto' runs the commands as
+local processes instead, from argument lists and without a shell,
+skipping SSH altogether; 'ssh' and 'local' force either backend.
+With 'fake' both clients answer from FakeHypervisor, which only simulates
+each subcommand's latency (load tests, demos).
+
+Both clients wait for the host's scheduler (see admission.py) before
+running a command; the wait is timed as 'queue', not 'hypervisor'. They
+time out, retry and fail fast on an unreachable host as described in
+resilience.py. Identical read-only commands running at the same time are
+coalesced into one (see singleflight.py). open_host_file() reads a file
+off the host, e.g. the disk images exported for backups (see backup_store.py).
+"""
+import asyncio
+import contextlib
+import functools
+import getpass
+import io
+import ipaddress
+import logging
+import os
+import shlex
+import shutil
+import socket
+import subprocess
+import time
+import weakref
+
+from django.conf import settings
+
+from .admission import aadmit, admit
+from .hypervisor_stats import get_subcommand, record_command
+from .metrics import timed
+from .resilience import HostConnectionError, acall, call, get_command_timeout, is_read_only
+from .singleflight import flights, get_flight_key
+
+logger = logging.getLogger(__name__)
+
+# The .env file is loaded by the settings module
+host_username = os.environ.get('HOST_USER')
+host_home = os.environ.get('HOST_HOME')
+host_password = os.environ.get('HOST_PASSWORD')
+home_dir = os.getenv('HOST_HOME', '/root')  # Default to '/root' if HOME is not set
+host_ip = os.getenv('HOST_IP')
+
+# OpenSSH allows 10 sessions per connection by default (MaxSessions)
+SSH_MAX_SESSIONS = int(os.getenv('HYPERVISOR_SSH_MAX_SESSIONS', 10))
+SSH_POOL_SIZE = int(os.getenv('HYPERVISOR_SSH_POOL_SIZE', 20))
+
+VBOXMANAGE_EXECUTABLES = ('vboxmanage', 'VBoxManage')
+
+# Host files are read over SFTP this many bytes ahead, in up to SFTP_MAX_CONCURRENT_REQUESTS pipelined 32 KiB reads
+SFTP_READ_AHEAD = 4 * 1024 * 1024
+SFTP_MAX_CONCURRENT_REQUESTS = 64
+
+
+@functools.lru_cache
+def find_vboxmanage():
+    """
+    Get the path of the local vboxmanage executable, or None if VirtualBox is not installed here.
+    """
+    for name in VBOXMANAGE_EXECUTABLES:
+        path = shutil.which(name)
+        if path:
+            return path
+    return None
+
+
+@functools.lru_cache
+def is_local_host(host):
+    """
+    Whether every address host resolves to is a loopback address or one of this machine's own.
+    """
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+        own_addresses = {info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None)}
+    except (socket.gaierror, UnicodeError):
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address.split('%')[0]).is_loopback or address in own_addresses for address in addresses)
+
+
+def get_backend(host, username):
+    """
+    Get the backend running the commands of a host as username: 'ssh', 'local' or 'fake'.
+
+    VirtualBox keeps a VM registry per user, so a local process only sees the
+    VMs (and the ~) of username when this process runs as that user.
+
+    Raises:
+        ValueError: If HYPERVISOR_BACKEND is 'local' and this process runs as another user.
+    """
+    backend = settings.HYPERVISOR_BACKEND
+    is_host_user = getpass.getuser() == username
+    if backend == 'auto':
+        return 'local' if is_local_host(host) and find_vboxmanage() and is_host_user else 'ssh'
+    if backend == 'local' and not is_host_user:
+        raise ValueError(f"The local hypervisor backend runs as {getpass.getuser()}, not as HOST_USER {username}; run the app as {username} or use 'ssh'.")
+    return backend
+
+
+def get_local_args(command):
+    """
+    Split a command line into the argument list of a local process, expanding ~ as the shell would.
+    """
+    args = [os.path.expanduser(arg) if arg.startswith('~') else arg for arg in shlex.split(command)]
+    if args and args[0].lower() == 'vboxmanage':
+        args[0] = find_vboxmanage() or args[0]
+    return args
+
+def run_vboxmanage_command(host, username, password, command):
+    """
+    Run a vboxmanage command on the remote host.
+
+    Parameters:
+        host (str): IP address of the host running VirtualBox.
+        username (str): Username to log in to the host.
+        password (str): Password to log in to the host.
+        command (str): vboxmanage command to run, e.g. "startvm myvm".
+
+    Returns:
+        str: Output of the vboxmanage command.
+
+    Raises:
+        HypervisorBusy: If the host's queue is full (see admission.py).
+        HypervisorUnavailable: If the host cannot be reached (see resilience.py).
+    """
+    logger.debug(f"Running on {username}@{host}: {command}")
+    timeout = get_command_timeout(command)
+
+    def run_once():
+        with admit(host, command):
+            started = time.monotonic()
+            try:
+                with timed('hypervisor'):
+                    backend = get_backend(host, username)
+                    if backend == 'fake':
+                        exit_status, output, error = fake_hypervisor.run(command)
+                    elif backend == 'local':
+                        exit_status, output, error = _run_locally(command, timeout)
+                    else:
+                        exit_status, output, error = _run_over_ssh(host, username, password, command, timeout)
+            except HostConnectionError as connection_error:
+                # Timeouts and unreachable hosts count as failed commands too
+                record_command(host, command, None, str(connection_error), time.monotonic() - started, 0)
+                raise
+
+        record_command(host, command, exit_status, error, time.monotonic() - started, len(output))
+        return output
+
+    if is_read_only(command):
+        return flights.do(get_flight_key(host, command), lambda: call(host, command, run_once))
+    return call(host, command, run_once)
+
+def _run_over_ssh(host, username, password, command, timeout):
+    # Imported on first use: paramiko pulls in the whole crypto stack and most workers never need it
+    import paramiko
+
+    # port = 2112
+    port = os.getenv('HOST_PORT')
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    connect_timeout = settings.HYPERVISOR_CONNECT_TIMEOUT
+
+    try:
+        # Connect using the password
+        ssh.connect(
+            host, port, username=username, password=password,
+            timeout=connect_timeout, banner_timeout=connect_timeout, auth_timeout=connect_timeout,
+        )
+
+        # timeout applies to every read, so a hung command raises socket.timeout instead of blocking forever
+        stdin, stdout, stderr = ssh.exec_command(command, timeout=timeout)
+        output = stdout.read().decode()
+        error = stderr.read().decode()
+        exit_status = stdout.channel.recv_exit_status()
+    except (paramiko.SSHException, OSError, EOFError) as error:
+        raise HostConnectionError(f'{host}: {error!r}') from error
+    finally:
+        ssh.close()
+
+    return exit_status, output, error
+
+
+def _run_locally(command, timeout):
+    try:
+        result = subprocess.run(get_local_args(command), capture_output=True, text=True, timeout=timeout)
+    except (OSError, ValueError, subprocess.TimeoutExpired) as error:
+        raise HostConnectionError(f'localhost: {error!r}') from error
+    return result.returncode, result.stdout, result.stderr
+
+
+async def _arun_locally(command, timeout):
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *get_local_args(command), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+    except (OSError, ValueError) as error:
+        raise HostConnectionError(f'localhost: {error!r}') from error
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError as error:
+        process.kill()
+        await process.wait()
+        raise HostConnectionError(f'localhost: command timed out after {timeout}s') from error
+    finally:
+        if process.returncode is None:
+            process.kill()
+    return process.returncode, stdout.decode(), stderr.decode()
+
+
+class SFTPReader:
+    """
+    Sequential reader of an SFTP file that fetches SFTP_READ_AHEAD bytes at a time.
+
+    SFTPFile.prefetch() requests the whole file at once and keeps every answer
+    in memory however slowly the file is read; this holds one window.
+    """
+    def __init__(self, stream, read_ahead=SFTP_READ_AHEAD):
+        self.stream = stream
+        self.read_ahead = read_ahead
+        self.size = stream.stat().st_size
+        self.position = 0
+        self.buffer = b''
+
+    def read(self, size):
+        if not self.buffer and self.position < self.size:
+            length = min(self.read_ahead, self.size - self.position)
+            self.buffer = b''.join(self.stream.readv([(self.position, length)], SFTP_MAX_CONCURRENT_REQUESTS))
+            self.position += length
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+@contextlib.contextmanager
+def open_host_file(host, username, password, path):
+    """
+    Open a file on the host for reading, e.g. a disk image exported by vboxmanage.
+
+    Parameters:
+        path (str): Path of the file; '~/...' is relative to the home directory of username.
+
+    Yields:
+        A binary file object (an SFTPReader over SSH). The fake backend yields an empty file.
+
+    Raises:
+        HostConnectionError: If the host cannot be reached or the file cannot be opened.
+    """
+    backend = get_backend(host, username)
+    if backend == 'fake':
+        yield io.BytesIO()
+        return
+    if backend == 'local':
+        try:
+            stream = open(os.path.expanduser(path), 'rb')
+        except OSError as error:
+            raise HostConnectionError(f'localhost: {error!r}') from error
+        with stream:
+            yield stream
+        return
+
+    import paramiko
+
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    connect_timeout = settings.HYPERVISOR_CONNECT_TIMEOUT
+    try:
+        try:
+            ssh.connect(
+                host, os.getenv('HOST_PORT'), username=username, password=password,
+                timeout=connect_timeout, banner_timeout=connect_timeout, auth_timeout=connect_timeout,
+            )
+            # SFTP paths are relative to the home directory already
+            stream = ssh.open_sftp().open(path[2:] if path.startswith('~/') else path, 'rb')
+            # Request the following blocks ahead instead of one round-trip per read
+            reader = SFTPReader(stream)
+        except (paramiko.SSHException, OSError, EOFError) as error:
+            raise HostConnectionError(f'{host}: {error!r}') from error
+        with stream:
+            yield reader
+    finally:
+        ssh.close()
+
+
+class FakeHypervisor:
+    """
+    Stand-in for the VirtualBox host that only simulates latency.
+
+    Each subcommand sleeps for its typical duration (scaled by
+    HYPERVISOR_FAKE_LATENCY_SCALE) and returns output shaped like the real
+    vboxmanage output the views parse.
+    """
+    LATENCIES = {
+        'createvm': 0.3,
+        'modifyvm': 0.1,
+        'createhd': 1.0,
+        'startvm': 1.5,
+        'controlvm acpipowerbutton': 0.5,
+        'snapshot take': 2.0,
+        'snapshot list': 0.05,
+        'showvminfo': 0.05,
+        'unregistervm': 0.5,
+    }
+    DEFAULT_LATENCY = 0.1
+
+    def get_latency(self, command):
+        scale = getattr(settings, 'HYPERVISOR_FAKE_LATENCY_SCALE', 1)
+        return self.LATENCIES.get(get_subcommand(command), self.DEFAULT_LATENCY) * scale
+
+    def get_output(self, command):
+        subcommand = get_subcommand(command)
+        vm_name = command.split()[2].strip('"') if len(command.split()) > 2 else ''
+        if subcommand == 'showvminfo':
+            return f'Name:            {vm_name}\nState:           running\nMemory size:     256MB\nNumber of CPUs:  1\n'
+        if subcommand == 'snapshot list':
+            return f'   Name: {vm_name} (UUID: 00000000-0000-0000-0000-000000000000) *\n'
+        if subcommand == 'showmediuminfo':
+            return 'UUID:           00000000-0000-0000-0000-000000000000\n'
+        return ''
+
+    def run(self, command):
+        time.sleep(self.get_latency(command))
+        return 0, self.get_output(command), ''
+
+    async def arun(self, command):
+        await asyncio.sleep(self.get_latency(command))
+        return 0, self.get_output(command), ''
+
+
+fake_hypervisor = FakeHypervisor()
+
+
+class AsyncSSHPool:
+    """
+    Pool of asyncssh connections to one host.
+
+    Each connection carries up to SSH_MAX_SESSIONS concurrent commands; new
+    connections are opened on demand up to SSH_POOL_SIZE, after which callers
+    wait for a free session. Pools are bound to the event loop that created them.
+    """
+    def __init__(self, host, port, username, password, max_sessions=SSH_MAX_SESSIONS, pool_size=SSH_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_sessions = max_sessions
+        self.pool_size = pool_size
+        self._connections = []  # [(connection, semaphore)]
+        self._condition = asyncio.Condition()
+
+    async def _acquire(self):
+        async with self._condition:
+            while True:
+                self._connections = [(conn, sem) for conn, sem in self._connections if not conn.is_closed()]
+                for conn, sem in self._connections:
+                    if not sem.locked():
+                        await sem.acquire()
+                        return conn, sem
+
+                if len(self._connections) < self.pool_size:
+                    import asyncssh
+
+                    conn = await asyncio.wait_for(asyncssh.connect(
+                        self.host, port=int(self.port or 22), username=self.username,
+                        password=self.password, known_hosts=None,
+                    ), settings.HYPERVISOR_CONNECT_TIMEOUT)
+                    sem = asyncio.Semaphore(self.max_sessions)
+                    self._connections.append((conn, sem))
+                    await sem.acquire()
+                    return conn, sem
+
+                await self._condition.wait()
+
+    async def _release(self, sem):
+        sem.release()
+        async with self._condition:
+            self._condition.notify()
+
+    async def run(self, command, timeout):
+        """
+        Run a command on one of the pooled connections.
+
+        Returns:
+            tuple: (exit status, stdout, stderr)
+
+        Raises:
+            HostConnectionError: If the host cannot be reached or the command exceeds timeout seconds.
+        """
+        import asyncssh
+
+        try:
+            conn, sem = await self._acquire()
+            try:
+                result = await asyncio.wait_for(conn.run(command, check=False), timeout)
+            finally:
+                await self._release(sem)
+        except (asyncssh.Error, OSError, asyncio.TimeoutError) as error:
+            raise HostConnectionError(f'{self.host}: {error!r}') from error
+        return result.exit_status, result.stdout or '', result.stderr or ''
+
+
+_async_pools = weakref.WeakKeyDictionary()  # {event loop: {(host, port, username): AsyncSSHPool}}
+
+def get_async_pool(host, username, password):
+    loop = asyncio.get_running_loop()
+    port = os.getenv('HOST_PORT')
+    pools = _async_pools.setdefault(loop, {})
+    key = (host, port, username)
+    if key not in pools:
+        pools[key] = AsyncSSHPool(host, port, username, password)
+    return pools[key]
+
+async def arun_vboxmanage_command(host, username, password, command):
+    """
+    Run a vboxmanage command on the remote host without blocking the event loop.
+
+    Parameters:
+        host (str): IP address of the host running VirtualBox.
+        username (str): Username to log in to the host.
+        password (str): Password to log in to the host.
+        command (str): vboxmanage command to run, e.g. "startvm myvm".
+
+    Returns:
+        str: Output of the vboxmanage command.
+
+    Raises:
+        HypervisorBusy: If the host's queue is full (see admission.py).
+        HypervisorUnavailable: If the host cannot be reached (see resilience.py).
+    """
+    logger.debug(f"Running on {username}@{host}: {command}")
+    timeout = get_command_timeout(command)
+
+    async def run_once():
+        async with aadmit(host, command):
+            started = time.monotonic()
+            try:
+                with timed('hypervisor'):
+                    backend = get_backend(host, username)
+                    if backend == 'fake':
+                        exit_status, output, error = await fake_hypervisor.arun(command)
+                    elif backend == 'local':
+                        exit_status, output, error = await _arun_locally(command, timeout)
+                    else:
+                        exit_status, output, error = await get_async_pool(host, username, password).run(command, timeout)
+            except HostConnectionError as connection_error:
+                # Timeouts and unreachable hosts count as failed commands too
+                record_command(host, command, None, str(connection_error), time.monotonic() - started, 0)
+                raise
+
+        record_command(host, command, exit_status, error, time.monotonic() - started, len(output))
+        return output
+
+    if is_read_only(command):
+        return await flights.ado(get_flight_key(host, command), lambda: acall(host, command, run_once))
+    return await acall(host, command, run_once)
@@ -0,0 +1,146 @@
+"""
+Latency and failure statistics of vboxmanage commands.
+
+Every command run by the hypervisor clients is recorded per subcommand and
+host: in the cumulative Prometheus histograms served at /metrics, in
+rolling per-slot histograms (the hypervisor_stats command shows the last
+hour), and in the slow-command log when it takes longer than
+HYPERVISOR_SLOW_COMMAND_SECONDS. Both kinds of histograms are kept in the
+metrics cache (see metrics.py), so pressure on the default cache never
+empties them.
+"""
+import json
+import logging
+import shlex
+import time
+
+from django.conf import settings
+
+from .metrics import COMMAND_TIME_BUCKETS, SUM_SCALE, SharedCounters, get_bucket, increment, observe
+
+logger = logging.getLogger(__name__)
+slow_command_logger = logging.getLogger('vm_management.slow_commands')
+
+# Subcommands whose cost depends on their action, e.g. "snapshot <vm> take"
+SUBCOMMANDS_WITH_ACTION = ('snapshot', 'controlvm')
+
+ROLLING_SLOT_SECONDS = 5 * 60
+ROLLING_SLOTS = 12  # one hour
+
+_rolling = SharedCounters('hypervisor_rolling', timeout=ROLLING_SLOT_SECONDS * (ROLLING_SLOTS + 1))
+
+ROLLING_FIELDS = [str(le) for le in COMMAND_TIME_BUCKETS] + ['+Inf', 'count', 'sum', 'errors']
+
+
+def get_subcommand(command):
+    """
+    Get the vboxmanage subcommand of a command line, e.g. 'createvm' or 'snapshot take',
+    or the method of an agent call ('agent list', see agent_client.py).
+    """
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        args = command.split()
+
+    if args and args[0].lower() == 'vboxmanage':
+        args = args[1:]
+    if not args:
+        return 'unknown'
+    if args[0] == 'agent' and len(args) > 1:
+        return f'agent {args[1]}'
+    if args[0] in SUBCOMMANDS_WITH_ACTION and len(args) > 2:
+        return f'{args[0]} {args[2]}'
+    return args[0]
+
+
+def get_slow_command_threshold():
+    return getattr(settings, 'HYPERVISOR_SLOW_COMMAND_SECONDS', 5)
+
+
+def record_command(host, command, exit_status, stderr, duration, output_bytes):
+    """
+    Record one finished vboxmanage command.
+
+    Parameters:
+        host (str): Host the command ran on.
+        command (str): The command line.
+        exit_status (int): Exit status of the command (None if it timed out or never reached the host).
+        stderr (str): What the command wrote to stderr, or the connection error.
+        duration (float): Wall time in seconds.
+        output_bytes (int): Size of the command's stdout.
+    """
+    subcommand = get_subcommand(command)
+    failed = exit_status != 0
+    labels = {'subcommand': subcommand, 'host': host}
+
+    observe('vboxmanage_command_duration_seconds', labels, duration)
+    observe('vboxmanage_command_output_bytes', labels, output_bytes)
+    if failed:
+        increment('vboxmanage_command_failures_total', labels)
+
+    slot = int(time.time() // ROLLING_SLOT_SECONDS)
+    _rolling.add((subcommand, host), {
+        f'{slot}:{get_bucket(COMMAND_TIME_BUCKETS, duration)}': 1,
+        f'{slot}:count': 1,
+        f'{slot}:sum': round(duration * SUM_SCALE),
+        f'{slot}:errors': int(failed),
+    })
+
+    if exit_status is None:
+        logger.warning(f"vboxmanage {subcommand} on {host} failed: {stderr.strip()}")
+    elif failed:
+        logger.warning(f"vboxmanage {subcommand} on {host} exited with {exit_status}: {stderr.strip()}")
+
+    if duration >= get_slow_command_threshold():
+        slow_command_logger.warning(json.dumps({
+            'event': 'slow_hypervisor_command',
+            'host': host,
+            'subcommand': subcommand,
+            'command': command,
+            'duration': round(duration, 3),
+            'exit_status': exit_status,
+            'output_bytes': output_bytes,
+            'stderr': stderr.strip()[:1000],
+        }))
+
+
+def get_percentile(bucket_counts, count, quantile):
+    """
+    Estimate a percentile as the upper bound of the bucket it falls in.
+    """
+    target = quantile * count
+    cumulative = 0
+    for le in COMMAND_TIME_BUCKETS:
+        cumulative += bucket_counts.get(str(le), 0)
+        if cumulative >= target:
+            return le
+    return float('inf')
+
+
+def get_rolling_stats(slots=ROLLING_SLOTS):
+    """
+    Aggregate the command statistics of the last slots * ROLLING_SLOT_SECONDS, across workers.
+
+    Returns:
+        dict: {(subcommand, host): {'count', 'errors', 'mean', 'p50', 'p95', 'p99'}}
+    """
+    current_slot = int(time.time() // ROLLING_SLOT_SECONDS)
+    window = range(current_slot - slots + 1, current_slot + 1)
+    series = _rolling.get_series()
+    values = _rolling.get_values(series, [f'{slot}:{field}' for slot in window for field in ROLLING_FIELDS])
+
+    stats = {}
+    for entry in series:
+        totals = {field: sum(values[(entry, f'{slot}:{field}')] for slot in window) for field in ROLLING_FIELDS}
+        count = totals['count']
+        if not count:
+            continue
+        stats[tuple(entry)] = {
+            'count': count,
+            'errors': totals['errors'],
+            'mean': totals['sum'] / SUM_SCALE / count,
+            'p50': get_percentile(totals, count, 0.5),
+            'p95': get_percentile(totals, count, 0.95),
+            'p99': get_percentile(totals, count, 0.99),
+        }
+    return stats
@@ -0,0 +1,260 @@
+"""
+HTTP load generator with tenant scenarios.
+
+Each simulated tenant is a real user with its own session that logs in and
+then loops over weighted actions (list VMs, create, start/stop, backup,
+details, pay, ...) with an exponential think time between them. Requests
+are timed individually (redirects are not followed), and the results are
+aggregated per action into throughput, error rate and latency percentiles.
+
+Used by the loadtest management command, which can also start the app
+under gunicorn with the fake hypervisor.
+"""
+import random
+import re
+import statistics
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+
+from accounts.models import CustomUser, UserRole
+from .models import RatePlan, Subscription
+
+TENANT_PREFIX = 'loadtest-'
+TENANT_PASSWORD = 'loadtest-password'
+TENANT_PLAN = 'platinum'
+
+# {action: weight}
+DEFAULT_MIX = {
+    'vm_list': 40,
+    'vm_details': 10,
+    'create_vm': 8,
+    'delete_vm': 4,
+    'start_vm': 12,
+    'stop_vm': 12,
+    'backup_vm': 4,
+    'user_payments': 6,
+    'pay': 4,
+}
+
+VM_ID_RE = re.compile(r'/vm_management/start/(\d+)/')
+
+
+@dataclass
+class Sample:
+    action: str
+    started: float
+    duration: float
+    status: int  # 0 when the request failed without a response
+    error: bool
+
+
+def parse_mix(value):
+    """
+    Parse a mix such as 'vm_list=50,start_vm=10' into {action: weight}.
+    """
+    mix = {}
+    for entry in value.split(','):
+        action, _, weight = entry.partition('=')
+        action = action.strip()
+        if action not in DEFAULT_MIX:
+            raise ValueError(f"Unknown action '{action}', choose from {', '.join(DEFAULT_MIX)}")
+        mix[action] = float(weight or 1)
+    return mix
+
+
+def create_tenants(count, prefix=TENANT_PREFIX):
+    """
+    Create (or reuse) count tenants with an active subscription on the largest plan.
+
+    Returns:
+        list: The usernames of the tenants.
+    """
+    RatePlan.create_plans()
+    rate_plan = RatePlan.objects.get(name=TENANT_PLAN)
+    usernames = []
+    for i in range(count):
+        username = f'{prefix}{i}'
+        user, created = CustomUser.objects.get_or_create(username=username, defaults={'role': UserRole.STANDARD_USER})
+        if created:
+            user.set_password(TENANT_PASSWORD)
+            user.save()
+        Subscription.objects.update_or_create(user=user, defaults={'rate_plan': rate_plan, 'active': True})
+        usernames.append(username)
+    return usernames
+
+
+def delete_tenants(prefix=TENANT_PREFIX):
+    return CustomUser.objects.filter(username__startswith=prefix).delete()[0]
+
+
+class Tenant:
+    """
+    One simulated customer with its own session.
+
+    Parameters:
+        base_url (str): Root URL of the app, e.g. 'http://127.0.0.1:8000'.
+        username (str): Username of the tenant.
+        mix (dict): {action: weight}.
+        think_time (float): Mean pause between two actions, in seconds.
+        record (callable): Called with every Sample.
+        max_vms (int): VM limit of the tenant's plan; create_vm deletes a VM instead once it is reached.
+        timeout (float): Request timeout in seconds.
+    """
+    def __init__(self, base_url, username, mix, think_time, record, max_vms, timeout=60):
+        import requests
+
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.actions = list(mix)
+        self.weights = list(mix.values())
+        self.think_time = think_time
+        self.record = record
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.vm_ids = []
+        self.vm_counter = 0
+        self.max_vms = max_vms
+
+    def request(self, action, method, path, data=None):
+        headers = {'X-CSRFToken': self.session.cookies.get('csrftoken', ''), 'Referer': self.base_url + path}
+        started = time.monotonic()
+        try:
+            response = self.session.request(
+                method, self.base_url + path, data=data, headers=headers,
+                allow_redirects=False, timeout=self.timeout,
+            )
+        except Exception:
+            self.record(Sample(action, started, time.monotonic() - started, 0, True))
+            return None
+        duration = time.monotonic() - started
+        self.record(Sample(action, started, duration, response.status_code, response.status_code >= 400))
+        return response
+
+    def login(self):
+        self.request('login_page', 'GET', '/accounts/login/')
+        response = self.request('login', 'POST', '/accounts/login/', {
+            'username': self.username,
+            'password': TENANT_PASSWORD,
+            'csrfmiddlewaretoken': self.session.cookies.get('csrftoken', ''),
+        })
+        return response is not None and response.status_code == 302
+
+    def refresh_vm_ids(self, response):
+        if response is not None and response.status_code == 200:
+            self.vm_ids = sorted({int(vm_id) for vm_id in VM_ID_RE.findall(response.text)})
+
+    def run(self, deadline):
+        if not self.login():
+            return
+        self.refresh_vm_ids(self.request('vm_list', 'GET', '/vm_management/'))
+
+        while time.monotonic() < deadline:
+            action = random.choices(self.actions, self.weights)[0]
+            getattr(self, f'do_{action}')()
+            if self.think_time:
+                time.sleep(min(random.expovariate(1 / self.think_time), max(deadline - time.monotonic(), 0)))
+
+    def do_vm_list(self):
+        self.refresh_vm_ids(self.request('vm_list', 'GET', '/vm_management/'))
+
+    def do_create_vm(self):
+        if len(self.vm_ids) >= self.max_vms:
+            return self.do_delete_vm()
+        self.vm_counter += 1
+        self.request('create_vm', 'POST', '/vm_management/create/', {
+            'name': f'{self.username}-{self.vm_counter}-{random.randrange(10 ** 6)}',
+            'disk_size': 1024, 'cpu': 1, 'memory': 256,
+        })
+        self.do_vm_list()
+
+    def with_vm(self, action, path):
+        if not self.vm_ids:
+            return self.do_create_vm()
+        self.request(action, 'GET', path.format(random.choice(self.vm_ids)))
+
+    def do_delete_vm(self):
+        if not self.vm_ids:
+            return
+        vm_id = self.vm_ids.pop(random.randrange(len(self.vm_ids)))
+        self.request('delete_vm', 'GET', f'/vm_management/delete/{vm_id}/')
+
+    def do_start_vm(self):
+        self.with_vm('start_vm', '/vm_management/start/{}/')
+
+    def do_stop_vm(self):
+        self.with_vm('stop_vm', '/vm_management/stop/{}/')
+
+    def do_backup_vm(self):
+        self.with_vm('backup_vm', '/vm_management/backup/{}/')
+
+    def do_vm_details(self):
+        self.with_vm('vm_details', '/vm_management/details/{}/')
+
+    def do_user_payments(self):
+        self.request('user_payments', 'GET', '/vm_management/payments/user/')
+
+    def do_pay(self):
+        self.request('pay', 'POST', '/vm_management/payment/', {'plan': TENANT_PLAN})
+
+
+def run_load(base_url, usernames, duration, mix=None, think_time=1.0, timeout=60):
+    """
+    Run every tenant concurrently for duration seconds.
+
+    Returns:
+        list: Every Sample recorded.
+    """
+    samples = []
+    lock = threading.Lock()
+
+    def record(sample):
+        with lock:
+            samples.append(sample)
+
+    max_vms = RatePlan.objects.get(name=TENANT_PLAN).max_vms
+    tenants = [
+        Tenant(base_url, username, mix or DEFAULT_MIX, think_time, record, max_vms, timeout)
+        for username in usernames
+    ]
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=tenant.run, args=(deadline,), daemon=True) for tenant in tenants]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(duration + timeout)
+    return samples
+
+
+def summarize(samples, duration):
+    """
+    Aggregate samples per action.
+
+    Returns:
+        dict: {action: {'count', 'errors', 'rps', 'p50', 'p95', 'p99', 'max'}}, latencies in seconds,
+        with the totals under 'all'.
+    """
+    by_action = defaultdict(list)
+    for sample in samples:
+        by_action[sample.action].append(sample)
+        by_action['all'].append(sample)
+
+    summary = {}
+    for action, action_samples in by_action.items():
+        durations = sorted(sample.duration for sample in action_samples)
+        if len(durations) > 1:
+            percentiles = statistics.quantiles(durations, n=100, method='inclusive')
+            p50, p95, p99 = percentiles[49], percentiles[94], percentiles[98]
+        else:
+            p50 = p95 = p99 = durations[0]
+        summary[action] = {
+            'count': len(durations),
+            'errors': sum(sample.error for sample in action_samples),
+            'rps': len(durations) / duration,
+            'p50': p50,
+            'p95': p95,
+            'p99': p99,
+            'max': durations[-1],
+        }
+    return summary
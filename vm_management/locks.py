@@ -0,0 +1,138 @@
+"""
+Per-VM locks for hypervisor operations.
+
+Operations on one VM (start, stop, backup, configure, delete) run one at a
+time across every worker: a second operation waits up to VM_LOCK_TIMEOUT
+seconds for the first to finish and then fails, while operations on
+different VMs never wait for each other.
+
+On PostgreSQL the lock is a session-level advisory lock keyed by the VM id,
+released when the operation ends or, if the worker dies, when its
+connection drops. Other databases fall back to a cache key with an expiry
+(atomic on Redis). Status changes are written with a conditional UPDATE
+(transition_status) instead of a full save, so an operation never
+overwrites fields another one changed meanwhile.
+
+Wait times feed the vm_lock_wait_seconds histogram and the request's
+Server-Timing header.
+"""
+import asyncio
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import connection
+
+from .events import get_vm_events, publish
+from .fragment_cache import bump_object_versions
+from .metrics import increment, observe, record
+from .models import VM
+from .versioning import bump_user_version
+
+# First key of the two-key advisory locks, so they cannot collide with other users of advisory locks
+LOCK_NAMESPACE = 0x564D  # 'VM'
+CACHE_LOCK_KEY = 'vm_management:vm_lock:{}'
+# A cache lock outlives a crashed holder by at most this long
+CACHE_LOCK_EXPIRY = 15 * 60
+
+POLL_INITIAL_DELAY = 0.01
+POLL_MAX_DELAY = 0.2
+
+
+class VMLockTimeout(Exception):
+    pass
+
+
+class VMLock:
+    """
+    Lock of one VM for one operation.
+
+    Parameters:
+        vm_id (int): ID of the VM.
+        operation (str): Name of the operation, used to label the wait-time metrics.
+    """
+    def __init__(self, vm_id, operation):
+        self.vm_id = int(vm_id)
+        self.operation = operation
+        self.token = uuid.uuid4().hex
+
+    @property
+    def cache_key(self):
+        return CACHE_LOCK_KEY.format(self.vm_id)
+
+    def try_acquire(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [LOCK_NAMESPACE, self.vm_id])
+                return cursor.fetchone()[0]
+        return cache.add(self.cache_key, self.token, CACHE_LOCK_EXPIRY)
+
+    def release(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [LOCK_NAMESPACE, self.vm_id])
+        elif cache.get(self.cache_key) == self.token:
+            cache.delete(self.cache_key)
+
+    def _record_wait(self, waited, acquired):
+        record('lock', waited)
+        observe('vm_lock_wait_seconds', {'operation': self.operation}, waited)
+        if not acquired:
+            increment('vm_lock_timeouts_total', {'operation': self.operation})
+
+    def acquire(self, timeout):
+        """
+        Wait up to timeout seconds for the lock.
+
+        Raises:
+            VMLockTimeout: If another operation still holds it.
+        """
+        started = time.monotonic()
+        delay = POLL_INITIAL_DELAY
+        while not self.try_acquire():
+            waited = time.monotonic() - started
+            if waited >= timeout:
+                self._record_wait(waited, acquired=False)
+                raise VMLockTimeout(f'VM {self.vm_id} is locked by another operation')
+            time.sleep(min(delay, timeout - waited))
+            delay = min(delay * 2, POLL_MAX_DELAY)
+        self._record_wait(time.monotonic() - started, acquired=True)
+
+    async def aacquire(self, timeout):
+        """
+        Async version of acquire(), waiting without holding a thread.
+        """
+        started = time.monotonic()
+        delay = POLL_INITIAL_DELAY
+        while not await sync_to_async(self.try_acquire)():
+            waited = time.monotonic() - started
+            if waited >= timeout:
+                self._record_wait(waited, acquired=False)
+                raise VMLockTimeout(f'VM {self.vm_id} is locked by another operation')
+            await asyncio.sleep(min(delay, timeout - waited))
+            delay = min(delay * 2, POLL_MAX_DELAY)
+        self._record_wait(time.monotonic() - started, acquired=True)
+
+    async def arelease(self):
+        await sync_to_async(self.release)()
+
+
+def transition_status(vm, to_status, from_statuses):
+    """
+    Move a VM to a new status with a conditional UPDATE ... WHERE status IN from_statuses.
+
+    Only the status column is written, so concurrent changes to other fields
+    are kept. The instance is updated to match.
+
+    Returns:
+        bool: Whether the row changed (False if its status was not one of from_statuses).
+    """
+    changed = VM.objects.filter(id=vm.id, status__in=from_statuses).update(status=to_status)
+    vm.status = to_status if changed else VM.objects.values_list('status', flat=True).get(id=vm.id)
+    if changed:
+        # update() skips model signals
+        bump_user_version(vm.user_id)
+        bump_object_versions([vm])
+        publish(get_vm_events(vm))
+    return bool(changed)
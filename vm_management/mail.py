@@ -0,0 +1,140 @@
+"""
+Outbound email queue.
+
+Views never talk to the SMTP server. queue_email() stores the message in
+the OutboundEmail table once the surrounding transaction commits, and the
+send_queued_emails worker delivers the queue over a single authenticated
+SMTP connection, retrying failures with exponential backoff.
+"""
+import logging
+import random
+from datetime import timedelta
+from itertools import groupby
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 6
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 60 * 60
+
+# A row stuck in 'sending' this long belongs to a worker that died mid-batch
+STALE_SENDING_AFTER = timedelta(minutes=10)
+
+
+def queue_email(subject, body, to_email):
+    """
+    Queue an email for delivery after the current transaction commits.
+
+    Outside a transaction the message is queued immediately. If the
+    transaction rolls back nothing is queued, so users are never notified
+    about changes that did not happen.
+    """
+    if not to_email:
+        return
+
+    transaction.on_commit(
+        lambda: OutboundEmail.objects.create(subject=subject, body=body, to_email=to_email)
+    )
+
+
+def get_backoff(attempts):
+    """
+    Seconds to wait before the next attempt: exponential backoff with jitter.
+    """
+    ceiling = min(BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS)
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def claim_batch(batch_size):
+    """
+    Mark up to batch_size due emails as 'sending' and return them.
+
+    Rows are locked with SKIP LOCKED only while they are claimed, so several
+    workers can drain the queue without sending a message twice and no lock
+    is held during SMTP round-trips.
+    """
+    now = timezone.now()
+    OutboundEmail.objects.filter(status='sending', next_attempt_at__lte=now - STALE_SENDING_AFTER).update(status='pending')
+
+    with transaction.atomic():
+        batch = list(
+            OutboundEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('to_email', 'id')[:batch_size]
+        )
+        OutboundEmail.objects.filter(id__in=[email.id for email in batch]).update(status='sending', next_attempt_at=now)
+    for email in batch:
+        email.status = 'sending'
+    return batch
+
+
+def deliver_pending_emails(batch_size=100, connection=None):
+    """
+    Deliver due emails over one SMTP connection.
+
+    Messages are grouped by recipient and sent back to back on the same
+    authenticated connection. Failed messages are rescheduled with backoff
+    and marked 'failed' after MAX_ATTEMPTS.
+
+    Returns:
+        tuple: (number sent, number failed or rescheduled)
+    """
+    batch = claim_batch(batch_size)
+    if not batch:
+        return 0, 0
+
+    # Only the mailer worker sends, web workers never need the smtplib/email.mime stack
+    from django.core.mail import EmailMessage, get_connection
+
+    connection = connection or get_connection(fail_silently=False)
+    sent = failed = 0
+
+    try:
+        connection.open()
+        for to_email, emails in groupby(batch, key=lambda email: email.to_email):
+            for email in emails:
+                message = EmailMessage(
+                    email.subject, email.body, settings.EMAIL_HOST_USER, [to_email], connection=connection
+                )
+                try:
+                    message.send()
+                except Exception as e:
+                    _reschedule(email, e)
+                    failed += 1
+                    # The server may have dropped us, start the next message on a fresh connection
+                    connection.close()
+                    connection.open()
+                else:
+                    email.status = 'sent'
+                    email.sent_at = timezone.now()
+                    email.save(update_fields=['status', 'sent_at'])
+                    sent += 1
+    except Exception as e:
+        # Could not (re)connect: give every unsent message of the batch back to the queue
+        for email in batch:
+            if email.status == 'sending':
+                _reschedule(email, e)
+                failed += 1
+    finally:
+        connection.close()
+
+    return sent, failed
+
+
+def _reschedule(email, error):
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= MAX_ATTEMPTS:
+        email.status = 'failed'
+        logger.error(f"Giving up on email {email.id} to {email.to_email} after {email.attempts} attempts: {error}")
+    else:
+        email.status = 'pending'
+        email.next_attempt_at = timezone.now() + timedelta(seconds=get_backoff(email.attempts))
+        logger.warning(f"Email {email.id} to {email.to_email} failed (attempt {email.attempts}), retrying: {error}")
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from accounts.models import CustomUser
+from vm_management.models import VM
+from vm_management.views import bulk_transfer_vms
+
+class Command(BaseCommand):
+    help = 'Transfer VMs to a new owner in one transaction, sending one digest email per affected user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', required=True, help='Username of the new owner')
+        parser.add_argument('--by', required=True, help='Username of the admin performing the transfer')
+        parser.add_argument('--from', dest='from_user', help='Transfer every VM of this username')
+        parser.add_argument('--vm-ids', nargs='+', type=int, default=[], help='IDs of the VMs to transfer')
+
+    def handle(self, *args, **options):
+        try:
+            new_user = CustomUser.objects.get(username=options['to'])
+            initiator = CustomUser.objects.get(username=options['by'])
+        except CustomUser.DoesNotExist as e:
+            raise CommandError(e)
+
+        vm_ids = set(options['vm_ids'])
+        if options['from_user']:
+            vm_ids.update(VM.objects.filter(user__username=options['from_user']).values_list('id', flat=True))
+        if not vm_ids:
+            raise CommandError('Nothing to transfer: pass --from and/or --vm-ids.')
+
+        vms = bulk_transfer_vms(vm_ids, new_user.id, initiator)
+        self.stdout.write(self.style.SUCCESS(f'Transferred {len(vms)} VM(s) to {new_user.username}'))
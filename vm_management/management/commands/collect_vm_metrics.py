@@ -0,0 +1,36 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from vm_management.vm_metrics import COLLECT_INTERVAL, collect, setup_collection
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Collect the CPU, RAM and network metrics of every VM on the host into their ring buffers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Collect one sample and exit instead of looping')
+        parser.add_argument('--interval', type=int, default=COLLECT_INTERVAL, help='Seconds between two samples')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        setup_collection(interval)
+        if options['once']:
+            # The host needs one period to take its first sample
+            time.sleep(interval)
+
+        while True:
+            started = time.monotonic()
+            try:
+                updated = collect()
+            except Exception:
+                if options['once']:
+                    raise
+                logger.exception('Collecting VM metrics failed')
+            else:
+                self.stdout.write(f'Collected metrics of {updated} VMs')
+
+            if options['once']:
+                break
+            time.sleep(max(0, interval - (time.monotonic() - started)))
@@ -0,0 +1,54 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from vm_management.backup_store import export_pending, sweep
+
+logger = logging.getLogger(__name__)
+
+# Sweeping walks the whole store, so a looping worker does it at most this often
+SWEEP_INTERVAL = 60 * 60
+
+class Command(BaseCommand):
+    help = "Copy the disks of new backups from the host into the deduplicated backup store"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep exporting new backups instead of exiting when none is left')
+        parser.add_argument('--interval', type=float, default=30, help='Seconds to sleep when no backup is waiting (with --loop)')
+        parser.add_argument('--sweep', action='store_true', help='Also delete the chunks no backup refers to any more')
+
+    def handle(self, *args, **options):
+        last_swept = None
+        while True:
+            started = time.monotonic()
+            report = None
+            try:
+                report = export_pending()
+                if options['sweep'] and (last_swept is None or started - last_swept >= SWEEP_INTERVAL):
+                    report.swept = sweep()
+                    last_swept = started
+            except Exception:
+                if not options['loop']:
+                    raise
+                logger.exception('Exporting backups failed')
+            else:
+                self.write_report(report, time.monotonic() - started)
+
+            if not options['loop']:
+                break
+            if report is None or not report.exported and not report.failed:
+                time.sleep(options['interval'])
+
+    def write_report(self, report, duration):
+        for backup, error in report.failed:
+            self.stdout.write(self.style.WARNING(f'Exporting backup {backup.id} of {backup.vm.name} failed: {error}'))
+        for backup, stored in report.exported:
+            self.stdout.write(
+                f'Exported backup {backup.id} of {backup.vm.name}: {stored.manifest["size"]} bytes, '
+                f'{stored.written} chunks written ({stored.stored_size} bytes), {stored.reused} already stored'
+            )
+        if report.exported or report.failed or report.swept:
+            self.stdout.write(
+                f'Exported {len(report.exported)} backups in {duration:.2f}s, {len(report.failed)} failed, '
+                f'{report.swept} unused chunks deleted'
+            )
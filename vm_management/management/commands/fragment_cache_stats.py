@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from vm_management.fragment_cache import get_stats, reset_stats
+
+class Command(BaseCommand):
+    help = 'Show hit/miss counters of the template fragment cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        stats = get_stats()
+        if not stats:
+            self.stdout.write('No fragment cache lookups recorded yet.')
+
+        for fragment_name, counts in sorted(stats.items()):
+            total = counts['hits'] + counts['misses']
+            hit_rate = counts['hits'] / total * 100 if total else 0
+            self.stdout.write(f"{fragment_name}: {counts['hits']} hits, {counts['misses']} misses ({hit_rate:.1f}% hit rate)")
+
+        if options['reset']:
+            reset_stats()
+            self.stdout.write(self.style.SUCCESS('Fragment cache counters reset'))
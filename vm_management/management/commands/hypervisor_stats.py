@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from vm_management.hypervisor_stats import ROLLING_SLOT_SECONDS, ROLLING_SLOTS, get_rolling_stats
+
+class Command(BaseCommand):
+    help = 'Show latency percentiles and failure rates of vboxmanage commands per subcommand and host'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--minutes', type=int, default=ROLLING_SLOT_SECONDS * ROLLING_SLOTS // 60,
+            help='Length of the window, rounded up to whole slots (max one hour)',
+        )
+
+    def handle(self, *args, **options):
+        slots = max(1, min(ROLLING_SLOTS, -(-options['minutes'] * 60 // ROLLING_SLOT_SECONDS)))
+        stats = get_rolling_stats(slots)
+        if not stats:
+            self.stdout.write('No hypervisor commands recorded in this window.')
+            return
+
+        self.stdout.write(f"{'subcommand':<26} {'host':<16} {'count':>6} {'errors':>6} {'mean s':>8} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7}")
+        for (subcommand, host), entry in sorted(stats.items()):
+            self.stdout.write(
+                f"{subcommand:<26} {host:<16} {entry['count']:>6} {entry['errors']:>6} {entry['mean']:>8.2f} "
+                f"{entry['p50']:>7g} {entry['p95']:>7g} {entry['p99']:>7g}"
+            )
@@ -0,0 +1,136 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from vm_management.loadtest import DEFAULT_MIX, create_tenants, delete_tenants, parse_mix, run_load, summarize
+
+# Throughput gain below which a higher concurrency level is considered saturated
+SATURATION_GAIN = 0.1
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate concurrent tenants (login, list, create, start/stop, backup, pay) against the app and '
+        'report throughput, errors and latency percentiles per endpoint and concurrency level'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of a running app; by default gunicorn is started with the fake hypervisor')
+        parser.add_argument('--workers', type=int, default=2, help='Gunicorn workers when the app is started here')
+        parser.add_argument('--concurrency', default='5,10,20', help='Comma-separated numbers of concurrent tenants to run in turn')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run each concurrency level')
+        parser.add_argument('--think', type=float, default=1.0, help='Mean think time between two actions of a tenant, in seconds')
+        parser.add_argument('--mix', help=f"Action weights, e.g. 'vm_list=50,start_vm=10' (actions: {', '.join(DEFAULT_MIX)})")
+        parser.add_argument('--latency-scale', type=float, default=1.0, help='Multiplier of the fake hypervisor latencies')
+        parser.add_argument('--keep', action='store_true', help='Keep the load test tenants and their VMs afterwards')
+
+    def handle(self, *args, **options):
+        try:
+            levels = sorted({int(level) for level in options['concurrency'].split(',')})
+            mix = parse_mix(options['mix']) if options['mix'] else DEFAULT_MIX
+        except ValueError as e:
+            raise CommandError(e)
+
+        usernames = create_tenants(levels[-1])
+        server = None
+        try:
+            base_url = options['url']
+            if not base_url:
+                server, base_url = self.start_server(options['workers'], options['latency_scale'])
+
+            results = []
+            for level in levels:
+                self.stdout.write(f'\n{level} concurrent tenants for {options["duration"]:g}s against {base_url}')
+                samples = run_load(base_url, usernames[:level], options['duration'], mix, options['think'])
+                if not samples:
+                    self.stdout.write('No requests completed.')
+                    continue
+                summary = summarize(samples, options['duration'])
+                self.write_summary(summary)
+                results.append((level, summary['all']))
+            self.write_levels(results)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(10)
+            if not options['keep']:
+                delete_tenants()
+
+    def start_server(self, workers, latency_scale):
+        port = get_free_port()
+        env = dict(
+            os.environ,
+            HYPERVISOR_BACKEND='fake',
+            HYPERVISOR_FAKE_LATENCY_SCALE=str(latency_scale),
+            WEB_CONCURRENCY=str(workers),
+            GUNICORN_BIND=f'127.0.0.1:{port}',
+        )
+        # The fake hypervisor never connects, but the views refuse to run without host settings
+        for name in ('HOST_USER', 'HOST_PASSWORD', 'HOST_IP'):
+            env.setdefault(name, 'loadtest')
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'hynfratech_assessment.asgi:application'],
+            cwd=settings.BASE_DIR, env=env,
+        )
+        base_url = f'http://127.0.0.1:{port}'
+        self.wait_for_server(server, port)
+        self.stdout.write(f'Started gunicorn with {workers} workers and the fake hypervisor on {base_url}')
+        return server, base_url
+
+    def wait_for_server(self, server, port, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f'gunicorn exited with {server.returncode}')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError(f'gunicorn did not start listening within {timeout}s')
+
+    def write_summary(self, summary):
+        self.stdout.write(
+            f"{'endpoint':<16} {'count':>7} {'errors':>7} {'err %':>6} {'req/s':>8} "
+            f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+        )
+        for action, entry in sorted(summary.items(), key=lambda item: (item[0] == 'all', item[0])):
+            self.stdout.write(
+                f"{action:<16} {entry['count']:>7} {entry['errors']:>7} {entry['errors'] / entry['count'] * 100:>6.1f} "
+                f"{entry['rps']:>8.2f} {entry['p50'] * 1000:>8.0f} {entry['p95'] * 1000:>8.0f} "
+                f"{entry['p99'] * 1000:>8.0f} {entry['max'] * 1000:>8.0f}"
+            )
+
+    def write_levels(self, results):
+        """
+        Compare the concurrency levels and point out where throughput stops scaling.
+        """
+        if len(results) < 2:
+            return
+        self.stdout.write(f"\n{'tenants':>7} {'req/s':>8} {'err %':>6} {'p95 ms':>8}")
+        saturated_at = None
+        previous_rps = None
+        for level, entry in results:
+            if saturated_at is None and previous_rps and entry['rps'] < previous_rps * (1 + SATURATION_GAIN):
+                saturated_at = level
+            previous_rps = entry['rps']
+            self.stdout.write(
+                f"{level:>7} {entry['rps']:>8.2f} {entry['errors'] / entry['count'] * 100:>6.1f} {entry['p95'] * 1000:>8.0f}"
+            )
+        if saturated_at is None:
+            self.stdout.write('Throughput still scales at the highest level; try more tenants.')
+        else:
+            self.stdout.write(self.style.WARNING(
+                f'Throughput gained less than {SATURATION_GAIN:.0%} going to {saturated_at} tenants: the server saturates there.'
+            ))
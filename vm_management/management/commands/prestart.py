@@ -0,0 +1,72 @@
+import hashlib
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles.finders import get_finders
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.executor import MigrationExecutor
+
+STATIC_FINGERPRINT_FILE = '.staticfiles-fingerprint'
+
+
+def get_pending_migrations(database=DEFAULT_DB_ALIAS):
+    """
+    Return the migrations that have not been applied to the database yet.
+    """
+    executor = MigrationExecutor(connections[database])
+    return executor.migration_plan(executor.loader.graph.leaf_nodes())
+
+
+def get_static_fingerprint():
+    """
+    Hash the path, size and modification time of every static source file.
+
+    The storage backend is part of the hash, so switching backends forces a
+    new collectstatic as well.
+    """
+    digest = hashlib.sha1(repr(settings.STORAGES.get('staticfiles')).encode())
+    files = []
+    for finder in get_finders():
+        for path, storage in finder.list([]):
+            stat = os.stat(storage.path(path))
+            files.append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+    for entry in sorted(files):
+        digest.update(entry.encode())
+    return digest.hexdigest()
+
+
+class Command(BaseCommand):
+    help = 'Apply migrations and collect static files, skipping each step when nothing changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-migrate', action='store_true', help='Do not touch the database (e.g. at image build time)')
+        parser.add_argument('--no-static', action='store_true', help='Do not collect static files')
+
+    def handle(self, *args, **options):
+        if not options['no_migrate']:
+            pending = get_pending_migrations()
+            if pending:
+                self.stdout.write(f"{len(pending)} unapplied migration(s), migrating")
+                call_command('migrate', interactive=False, verbosity=options['verbosity'])
+            else:
+                self.stdout.write('Migrations up to date, skipping migrate')
+
+        if not options['no_static']:
+            fingerprint = get_static_fingerprint()
+            fingerprint_path = os.path.join(settings.STATIC_ROOT, STATIC_FINGERPRINT_FILE)
+            try:
+                with open(fingerprint_path) as f:
+                    collected = f.read().strip()
+            except OSError:
+                collected = None
+
+            if collected == fingerprint:
+                self.stdout.write('Static files unchanged, skipping collectstatic')
+            else:
+                call_command('collectstatic', interactive=False, verbosity=options['verbosity'])
+                with open(fingerprint_path, 'w') as f:
+                    f.write(fingerprint)
+
+        self.stdout.write(self.style.SUCCESS('Ready to start'))
@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+# What a worker does before it can serve its first request
+STARTUP_CODE = (
+    "import django; django.setup(); "
+    "from django.core.asgi import get_asgi_application; get_asgi_application(); "
+    "from django.urls import get_resolver; get_resolver().url_patterns"
+)
+
+
+def parse_importtime(output):
+    """
+    Parse the output of python -X importtime.
+
+    Returns:
+        list: (module, self microseconds, cumulative microseconds, depth) in import order.
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+class Command(BaseCommand):
+    help = 'Report how long a fresh worker takes to start and which imports cost the most'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=25, help='Number of modules to show')
+        parser.add_argument('--self', action='store_true', dest='sort_self', help='Sort by self time instead of cumulative time')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', STARTUP_CODE],
+            capture_output=True, text=True, env=os.environ.copy(),
+        )
+        elapsed = time.perf_counter() - started
+
+        if result.returncode != 0:
+            self.stderr.write(result.stderr)
+            self.stderr.write(self.style.ERROR('Worker start-up failed'))
+            return
+
+        modules = parse_importtime(result.stderr)
+        total_us = sum(cumulative_us for _, _, cumulative_us, depth in modules if depth == 0)
+
+        self.stdout.write(f"Worker start-up: {elapsed * 1000:.0f} ms wall time, {total_us / 1000:.0f} ms importing {len(modules)} modules")
+        self.stdout.write(f"{'self ms':>9} {'cumul ms':>9}  module")
+
+        key = (lambda module: module[1]) if options['sort_self'] else (lambda module: module[2])
+        for name, self_us, cumulative_us, depth in sorted(modules, key=key, reverse=True)[:options['limit']]:
+            self.stdout.write(f"{self_us / 1000:9.1f} {cumulative_us / 1000:9.1f}  {name}")
@@ -0,0 +1,47 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from vm_management.reconcile import reconcile
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Fix VM status and configuration drift between the database and the hypervisor, and report orphans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', help='Host to reconcile (default: HOST_IP)')
+        parser.add_argument('--dry-run', action='store_true', help='Report the drift without writing it')
+        parser.add_argument('--loop', action='store_true', help='Keep reconciling every --interval seconds')
+        parser.add_argument('--interval', type=float, default=60, help='Seconds between two runs (with --loop)')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            try:
+                report = reconcile(options['host'], dry_run=options['dry_run'])
+            except Exception:
+                if not options['loop']:
+                    raise
+                logger.exception('VM reconciliation failed')
+            else:
+                self.write_report(report, time.monotonic() - started, options['dry_run'])
+
+            if not options['loop']:
+                break
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
+
+    def write_report(self, report, duration, dry_run):
+        for vm, diff in report.updated:
+            changes = ', '.join(f'{name} {old} -> {new}' for name, (old, new) in diff.items())
+            self.stdout.write(f'{"Would update" if dry_run else "Updated"} {vm.name} (id {vm.id}): {changes}')
+        for vm in report.missing_on_host:
+            self.stdout.write(self.style.WARNING(f'Missing on {report.host}: {vm.name} (id {vm.id}, user {vm.user_id})'))
+        for name in report.unmanaged_on_host:
+            self.stdout.write(self.style.WARNING(f'Not in the database: {name} on {report.host}'))
+        for vm in report.changed_meanwhile:
+            self.stdout.write(f'Left {vm.name} (id {vm.id}) alone: its status changed during the run')
+        self.stdout.write(
+            f'Checked {report.checked} VMs against {report.host} in {duration:.2f}s: {len(report.updated)} drifted, '
+            f'{len(report.missing_on_host)} missing on the host, {len(report.unmanaged_on_host)} not in the database'
+        )
@@ -0,0 +1,40 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from vm_management.warm_pool import refill
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Clone VMs into the warm pool up to the demand of each shape, and remove surplus or broken ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', help='Host whose pool to refill (default: HOST_IP)')
+        parser.add_argument('--loop', action='store_true', help='Keep refilling every --interval seconds')
+        parser.add_argument('--interval', type=float, default=15, help='Seconds between two runs (with --loop)')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            try:
+                report = refill(options['host'])
+            except Exception:
+                if not options['loop']:
+                    raise
+                logger.exception('Refilling the warm pool failed')
+            else:
+                self.write_report(report, time.monotonic() - started)
+
+            if not options['loop']:
+                break
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
+
+    def write_report(self, report, duration):
+        for warm, error in report.failed:
+            self.stdout.write(self.style.WARNING(f'Cloning {warm.name} ({warm.cpu} CPU, {warm.memory} MB, {warm.disk_size} MB disk) failed: {error}'))
+        targets = ', '.join(f'{cpu}:{memory}:{disk_size}={target}' for (cpu, memory, disk_size), target in sorted(report.targets.items()))
+        self.stdout.write(
+            f'Refilled the warm pool of {report.host} in {duration:.2f}s: {len(report.created)} cloned, '
+            f'{len(report.removed)} removed, {len(report.failed)} failed (targets: {targets or "none"})'
+        )
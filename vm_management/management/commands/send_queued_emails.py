@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+from vm_management.mail import deliver_pending_emails
+
+class Command(BaseCommand):
+    help = 'Deliver queued outbound emails over a shared SMTP connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep draining the queue instead of exiting when it is empty')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to sleep when the queue is empty (with --loop)')
+        parser.add_argument('--batch-size', type=int, default=100, help='Maximum number of emails per SMTP connection')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = deliver_pending_emails(batch_size=options['batch_size'])
+            if sent or failed:
+                self.stdout.write(f'Sent {sent} emails, {failed} failed')
+
+            if not options['loop']:
+                break
+            if not sent and not failed:
+                time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS('Email queue drained'))
@@ -0,0 +1,79 @@
+import json
+import os
+from fnmatch import fnmatch
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+MANIFEST_NAME = 'staticfiles.json'
+
+
+def get_wire_sizes(static_root, hashed_name):
+    """
+    Return the size of an asset and of its precompressed copies, in bytes.
+
+    Returns:
+        dict: {'raw': size, 'gzip': size or None, 'brotli': size or None}
+    """
+    path = os.path.join(static_root, hashed_name)
+    sizes = {'raw': os.path.getsize(path)}
+    for encoding, suffix in (('gzip', '.gz'), ('brotli', '.br')):
+        sizes[encoding] = os.path.getsize(path + suffix) if os.path.exists(path + suffix) else None
+    return sizes
+
+
+def get_budget(name, budgets):
+    for pattern, budget in budgets.items():
+        if fnmatch(name, pattern):
+            return budget
+    return None
+
+
+class Command(BaseCommand):
+    help = 'Report the size of the collected static assets against the STATIC_ASSET_BUDGETS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--strict', action='store_true', help='Exit with an error when an asset is over budget')
+        parser.add_argument('--all', action='store_true', help='List every asset, not only those over budget')
+
+    def handle(self, *args, **options):
+        manifest_path = os.path.join(settings.STATIC_ROOT, MANIFEST_NAME)
+        try:
+            with open(manifest_path) as f:
+                paths = json.load(f)['paths']
+        except OSError:
+            raise CommandError(f"No manifest at {manifest_path}, run collectstatic first.")
+
+        budgets = getattr(settings, 'STATIC_ASSET_BUDGETS', {})
+        total_raw = total_wire = 0
+        over_budget = []
+
+        for name, hashed_name in sorted(paths.items()):
+            sizes = get_wire_sizes(settings.STATIC_ROOT, hashed_name)
+            # What a client that accepts brotli actually downloads
+            wire = min(size for size in sizes.values() if size is not None)
+            total_raw += sizes['raw']
+            total_wire += wire
+
+            budget = get_budget(name, budgets)
+            over = budget is not None and wire > budget
+            if over:
+                over_budget.append(name)
+
+            if over or options['all']:
+                line = (
+                    f"{name}: {sizes['raw'] / 1024:.1f} KiB raw, "
+                    f"{(sizes['gzip'] or sizes['raw']) / 1024:.1f} KiB gzip, "
+                    f"{(sizes['brotli'] or sizes['raw']) / 1024:.1f} KiB brotli"
+                )
+                if budget is not None:
+                    line += f" (budget {budget / 1024:.0f} KiB)"
+                self.stdout.write(self.style.ERROR(line) if over else line)
+
+        self.stdout.write(
+            f"{len(paths)} assets, {total_raw / 1024:.0f} KiB raw, {total_wire / 1024:.0f} KiB on the wire, "
+            f"{len(over_budget)} over budget"
+        )
+
+        if over_budget and options['strict']:
+            raise CommandError(f"{len(over_budget)} static asset(s) over budget.")
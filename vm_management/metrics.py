@@ -0,0 +1,412 @@
+"""
+Per-request performance metrics.
+
+The metrics middleware opens a RequestTimings for every request. Database
+queries, hypervisor commands and template renders add their time to it
+through the hooks below; the totals are sent back in a Server-Timing
+header and folded into Prometheus histograms labelled by URL name. The
+hypervisor client adds per-command histograms (see hypervisor_stats.py).
+
+Like the fragment cache counters, histograms are kept per process and
+flushed to the shared cache every METRICS_FLUSH_INTERVAL seconds, so the
+/metrics endpoint reports the whole deployment whichever worker serves it.
+They live in their own cache alias (METRICS_CACHE), which never culls: a
+counter evicted to make room for fragments would read as a reset or a lost
+series to the scraper.
+"""
+import contextvars
+import hashlib
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.core.cache import caches
+from django.template.backends.django import DjangoTemplates
+
+METRICS_CACHE = 'metrics'
+
+METRIC_KEY = 'vm_management:metrics:{}:{}:{}'
+# Series are registered once each (cache.add) and listed in numbered slots, so concurrent flushes never lose one
+SERIES_REGISTERED_KEY = 'vm_management:metrics:{}:registered:{}'
+SERIES_COUNT_KEY = 'vm_management:metrics:{}:series_count'
+SERIES_SLOT_KEY = 'vm_management:metrics:{}:series:{}'
+
+METRICS_FLUSH_INTERVAL = 10
+METRIC_PREFIX = 'hynfratech_'
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+# vboxmanage commands take from milliseconds (showvminfo) to minutes (createhd, snapshot take)
+COMMAND_TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTE_BUCKETS = (0, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# {metric: (help text, buckets)}
+HISTOGRAMS = {
+    'request_duration_seconds': ('Wall time of the request', TIME_BUCKETS),
+    'db_query_duration_seconds': ('Time spent in database queries per request', TIME_BUCKETS),
+    'db_queries': ('Database queries per request', COUNT_BUCKETS),
+    'hypervisor_command_duration_seconds': ('Time spent in hypervisor commands per request', TIME_BUCKETS),
+    'hypervisor_commands': ('Hypervisor commands per request', COUNT_BUCKETS),
+    'template_render_duration_seconds': ('Time spent rendering templates per request', TIME_BUCKETS),
+    'vboxmanage_command_duration_seconds': ('Latency of vboxmanage commands by subcommand and host', COMMAND_TIME_BUCKETS),
+    'vboxmanage_command_output_bytes': ('Output size of vboxmanage commands by subcommand and host', BYTE_BUCKETS),
+    'vm_lock_wait_seconds': ('Time spent waiting for a per-VM operation lock, by operation', TIME_BUCKETS),
+    'hypervisor_queue_wait_seconds': ('Time hypervisor commands waited for admission, by host and class', TIME_BUCKETS),
+}
+
+# {metric: help text}
+COUNTERS = {
+    'vboxmanage_command_failures_total': 'vboxmanage commands that exited with a non-zero status, by subcommand and host',
+    'vm_lock_timeouts_total': 'VM operations rejected because another operation held the VM lock too long, by operation',
+    'hypervisor_rejections_total': 'Hypervisor commands rejected because the host queue was full or too slow, by host and class',
+    'hypervisor_connection_failures_total': 'Hypervisor commands that could not reach the host or timed out, by host',
+    'hypervisor_retries_total': 'Retries of read-only hypervisor commands, by host',
+    'hypervisor_fast_failures_total': 'Hypervisor commands failed at once because the host circuit breaker was open, by host',
+    'hypervisor_stale_reads_total': 'Read-only hypervisor commands answered with the last known output, by host',
+    'warm_pool_claims_total': 'create_vm requests served from the warm pool (hit) or built from scratch (miss)',
+    'hypervisor_coalesced_commands_total': 'Read-only hypervisor commands that shared the output of an identical one in flight, by host',
+    'backup_chunks_total': 'Chunks of exported backup disks written to the backup store or already in it (reused)',
+}
+
+# Sums are kept as integers (cache.incr) in millionths
+SUM_SCALE = 1_000_000
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """
+    Time and number of operations of each kind ('db', 'hypervisor', 'template', 'lock', 'queue') during one request.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = defaultdict(float)
+        self.counts = Counter()
+        self.queries = None  # Set to a list to capture the SQL of the request (see profiling.py)
+
+    def add(self, kind, seconds):
+        self.durations[kind] += seconds
+        self.counts[kind] += 1
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def start_request():
+    """
+    Start collecting timings for the current request (or task).
+
+    Returns:
+        tuple: (RequestTimings, token to pass to end_request())
+    """
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def get_current_timings():
+    return _current.get()
+
+
+def record(kind, seconds):
+    """
+    Add an operation to the current request's timings, if there is one.
+    """
+    timings = _current.get()
+    if timings is not None:
+        timings.add(kind, seconds)
+
+
+@contextmanager
+def timed(kind):
+    """
+    Time the enclosed block as an operation of the given kind.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind, time.perf_counter() - started)
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper recording every query in the current request's timings.
+    """
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started
+        timings.add('db', duration)
+        if timings.queries is not None:
+            timings.queries.append({'sql': sql, 'many': many, 'time': round(duration, 6)})
+
+
+def install_query_timer(connection):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+class TimedTemplate:
+    """
+    Template wrapper recording the time of each top-level render.
+    """
+    def __init__(self, template):
+        self.template = template
+
+    def render(self, context=None, request=None):
+        with timed('template'):
+            return self.template.render(context, request)
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    Django template backend whose templates record their render time.
+
+    Included and extended templates are rendered by the engine directly, so
+    each page is only counted once.
+    """
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+def format_server_timing(timings):
+    """
+    Build the Server-Timing header value of a request.
+    """
+    entries = [f'app;dur={timings.elapsed * 1000:.1f}']
+    for kind in ('db', 'hypervisor', 'template', 'lock', 'queue'):
+        if timings.counts[kind]:
+            entries.append(f'{kind};dur={timings.durations[kind] * 1000:.1f};desc="{timings.counts[kind]}"')
+    return ', '.join(entries)
+
+
+class SharedCounters:
+    """
+    Integer counters kept per process and added to the shared cache at most
+    every flush_interval seconds, so counting costs no cache round-trip.
+
+    Counters are grouped in series (tuples of label values); each series has
+    any number of named fields. Flushes triggered by add() run in a
+    background thread, so recording from an event loop never waits on the cache.
+
+    Parameters:
+        name (str): Namespace of the cache keys.
+        timeout (int): Lifetime of each cache key, None to keep them forever.
+        flush_interval (int): Seconds between two flushes of a process's counters.
+    """
+    def __init__(self, name, timeout=None, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.name = name
+        self.timeout = timeout
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._last_flush = time.monotonic()
+        self._writer = None  # Thread writing the last flush
+
+    @property
+    def cache(self):
+        return caches[METRICS_CACHE]
+
+    def _digest(self, series):
+        # Label values may contain characters that are not valid in every cache backend's keys
+        return hashlib.md5(repr(series).encode(), usedforsecurity=False).hexdigest()
+
+    def _key(self, series, field):
+        return METRIC_KEY.format(self.name, self._digest(series), field)
+
+    def add(self, series, counts):
+        """
+        Add {field: value} to the counters of a series.
+        """
+        with self._lock:
+            for field, value in counts.items():
+                self._pending[(series, field)] += value
+            if time.monotonic() - self._last_flush < self.flush_interval:
+                return
+            # At most one writer per process; the counters pile up until it is done
+            if self._writer is not None and self._writer.is_alive():
+                return
+            pending = self._take_pending()
+            self._writer = threading.Thread(target=self._write, args=(pending,), daemon=True)
+            self._writer.start()
+
+    def _take_pending(self):
+        pending = dict(self._pending)
+        self._pending.clear()
+        self._last_flush = time.monotonic()
+        return pending
+
+    def _register(self, series):
+        registered_key = SERIES_REGISTERED_KEY.format(self.name, self._digest(series))
+        count_key = SERIES_COUNT_KEY.format(self.name)
+        values = self.cache.get_many([registered_key, count_key])
+        slot = values.get(registered_key)
+        # Registered again when the count was lost or its slot was evicted or reused since
+        if slot is not None and slot <= values.get(count_key, 0) and self.cache.get(SERIES_SLOT_KEY.format(self.name, slot)) == series:
+            return
+        self.cache.add(count_key, 0, None)
+        slot = self.cache.incr(count_key)
+        # The generic incr() of the local cache backends sets the key again with the default timeout
+        self.cache.touch(count_key, None)
+        self.cache.set(SERIES_SLOT_KEY.format(self.name, slot), series, None)
+        self.cache.set(registered_key, slot, None)
+
+    def _write(self, pending):
+        for entry in {entry for entry, _ in pending}:
+            self._register(entry)
+        for (entry, field), value in pending.items():
+            key = self._key(entry, field)
+            self.cache.add(key, 0, self.timeout)
+            try:
+                self.cache.incr(key, value)
+                self.cache.touch(key, self.timeout)
+            except ValueError:
+                self.cache.set(key, value, self.timeout)
+
+    def flush(self):
+        """
+        Push this process's pending counters to the shared cache immediately.
+        """
+        writer = self._writer
+        if writer is not None:
+            writer.join()
+        with self._lock:
+            pending = self._take_pending()
+        if pending:
+            self._write(pending)
+
+    def get_series(self):
+        self.flush()
+        count = self.cache.get(SERIES_COUNT_KEY.format(self.name), 0)
+        slots = self.cache.get_many([SERIES_SLOT_KEY.format(self.name, slot) for slot in range(1, count + 1)])
+        # Two workers registering the same series at once both take a slot
+        return sorted(set(slots.values()))
+
+    def get_values(self, series, fields):
+        """
+        Read the counters of many series with one cache round-trip.
+
+        Returns:
+            dict: {(series, field): value}
+        """
+        keys = {(entry, field): self._key(entry, field) for entry in series for field in fields}
+        values = self.cache.get_many(keys.values())
+        return {entry_field: values.get(key, 0) for entry_field, key in keys.items()}
+
+    def reset(self, fields):
+        series = self.get_series()
+        for entry in series:
+            self.cache.delete_many([self._key(entry, field) for field in fields])
+        self.cache.delete_many([SERIES_REGISTERED_KEY.format(self.name, self._digest(entry)) for entry in series])
+        count_key = SERIES_COUNT_KEY.format(self.name)
+        self.cache.delete_many([SERIES_SLOT_KEY.format(self.name, slot) for slot in range(1, self.cache.get(count_key, 0) + 1)] + [count_key])
+
+
+_histograms = SharedCounters('histograms')
+
+
+def format_labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels.items())
+
+
+def get_bucket(buckets, value):
+    return next((str(le) for le in buckets if value <= le), '+Inf')
+
+
+def get_fields(metric):
+    if metric in COUNTERS:
+        return ['value']
+    return [str(le) for le in HISTOGRAMS[metric][1]] + ['+Inf', 'sum', 'count']
+
+
+def observe(metric, labels, value):
+    """
+    Add one observation to a histogram.
+
+    Parameters:
+        metric (str): Name of the histogram (a key of HISTOGRAMS).
+        labels (dict): Label names and values of the series.
+        value (float): The observed value.
+    """
+    buckets = HISTOGRAMS[metric][1]
+    _histograms.add((metric, format_labels(labels)), {
+        get_bucket(buckets, value): 1,
+        'count': 1,
+        'sum': round(value * SUM_SCALE),
+    })
+
+
+def increment(metric, labels, value=1):
+    """
+    Increment a counter (a key of COUNTERS).
+    """
+    _histograms.add((metric, format_labels(labels)), {'value': value})
+
+
+def observe_request(view, timings):
+    """
+    Fold a finished request into the histograms of its view.
+    """
+    labels = {'view': view}
+    observe('request_duration_seconds', labels, timings.elapsed)
+    observe('db_query_duration_seconds', labels, timings.durations['db'])
+    observe('db_queries', labels, timings.counts['db'])
+    observe('hypervisor_command_duration_seconds', labels, timings.durations['hypervisor'])
+    observe('hypervisor_commands', labels, timings.counts['hypervisor'])
+    observe('template_render_duration_seconds', labels, timings.durations['template'])
+
+
+def flush_metrics():
+    """
+    Push this process's pending observations to the shared cache immediately.
+    """
+    _histograms.flush()
+
+
+def render_prometheus():
+    """
+    Render every metric, aggregated across workers, in the Prometheus text format.
+    """
+    series = _histograms.get_series()
+    values = _histograms.get_values(series, {field for metric, _ in series for field in get_fields(metric)})
+
+    lines = []
+    for metric, help_text in [(metric, help_text) for metric, (help_text, _) in HISTOGRAMS.items()] + list(COUNTERS.items()):
+        name = METRIC_PREFIX + metric
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {"counter" if metric in COUNTERS else "histogram"}')
+        for entry in series:
+            series_metric, labels = entry
+            if series_metric != metric:
+                continue
+            if metric in COUNTERS:
+                lines.append(f'{name}{{{labels}}} {values[(entry, "value")]}')
+                continue
+            cumulative = 0
+            for le in get_fields(metric)[:-2]:
+                cumulative += values[(entry, le)]
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {values[(entry, "sum")] / SUM_SCALE}')
+            lines.append(f'{name}_count{{{labels}}} {values[(entry, "count")]}')
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics():
+    _histograms.reset({field for metric, _ in _histograms.get_series() for field in get_fields(metric)})
@@ -0,0 +1,118 @@
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.http import JsonResponse
+from django.shortcuts import render
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.deprecation import MiddlewareMixin
+
+from .admission import HypervisorBusy
+from .resilience import HypervisorUnavailable
+from .metrics import end_request, format_server_timing, get_current_timings, observe_request, start_request
+from .profiling import RequestProfiler, can_profile, is_profiling_requested
+
+
+def get_view_label(request):
+    """
+    Label a request by the name of the URL pattern it matched.
+    """
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is None:
+        return 'unmatched'
+    return resolver_match.view_name or resolver_match.route or 'unnamed'
+
+
+def _finish(request, response, timings):
+    response['Server-Timing'] = format_server_timing(timings)
+    observe_request(get_view_label(request), timings)
+    return response
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Time every request, add a Server-Timing header and record it in the metrics histograms.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            timings, token = start_request()
+            try:
+                response = await get_response(request)
+            finally:
+                end_request(token)
+            return _finish(request, response, timings)
+    else:
+        def middleware(request):
+            timings, token = start_request()
+            try:
+                response = get_response(request)
+            finally:
+                end_request(token)
+            return _finish(request, response, timings)
+    return middleware
+
+
+@sync_and_async_middleware
+def profiling_middleware(get_response):
+    """
+    Profile the request when an admin asks for it (see profiling.py).
+
+    cProfile only sees the thread it was enabled in. Under ASGI the event
+    loop thread runs the async middleware and views, and the request's
+    thread-sensitive worker thread runs the sync views, templates and ORM
+    calls, so both are profiled and their stats merged.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            if not is_profiling_requested(request):
+                return await get_response(request)
+
+            user = await request.auser()
+            profiler = RequestProfiler(get_current_timings())
+            if not can_profile(user) or not profiler.start():
+                return await get_response(request)
+            try:
+                # sync_to_async is thread-sensitive: these run in the same thread as the sync view
+                await sync_to_async(profiler.enable)()
+                try:
+                    response = await get_response(request)
+                finally:
+                    await sync_to_async(profiler.disable)()
+            finally:
+                profiler.stop()
+            await sync_to_async(profiler.save)(request, response, user, get_view_label(request))
+            return response
+    else:
+        def middleware(request):
+            if not is_profiling_requested(request):
+                return get_response(request)
+
+            profiler = RequestProfiler(get_current_timings())
+            if not can_profile(request.user) or not profiler.start():
+                return get_response(request)
+            try:
+                response = get_response(request)
+            finally:
+                profiler.stop()
+            profiler.save(request, response, request.user, get_view_label(request))
+            return response
+    return middleware
+
+
+class HypervisorErrorMiddleware(MiddlewareMixin):
+    """
+    Answer 503 with a Retry-After header when a view's hypervisor command was
+    rejected by the host's scheduler or the host is unreachable, as JSON for
+    the API and as the error page otherwise.
+    """
+    def process_exception(self, request, exception):
+        if isinstance(exception, HypervisorBusy):
+            message = "The VirtualBox host is busy. Please try again shortly."
+        elif isinstance(exception, HypervisorUnavailable):
+            message = "The VirtualBox host cannot be reached right now. Please try again shortly."
+        else:
+            return None
+        if request.path.startswith('/api/'):
+            response = JsonResponse({'detail': message}, status=503)
+        else:
+            response = render(request, 'accounts/access_denied.html', {'error': message}, status=503)
+        response['Retry-After'] = str(exception.retry_after)
+        return response
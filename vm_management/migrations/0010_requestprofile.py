@@ -0,0 +1,34 @@
+# Generated by Django 5.0.6 on 2026-10-19 14:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm_management', '0009_outboundemail'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.TextField()),
+                ('view_name', models.CharField(blank=True, default='', max_length=200)),
+                ('status_code', models.IntegerField()),
+                ('duration', models.FloatField()),
+                ('query_count', models.IntegerField(default=0)),
+                ('query_time', models.FloatField(default=0)),
+                ('queries', models.JSONField(default=list)),
+                ('stats', models.BinaryField()),
+                ('summary', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
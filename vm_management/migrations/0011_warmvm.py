@@ -0,0 +1,30 @@
+# Generated by Django 5.0.6 on 2026-10-19 14:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm_management', '0010_requestprofile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WarmVM',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('host', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('cpu', models.IntegerField()),
+                ('memory', models.IntegerField()),
+                ('disk_size', models.IntegerField()),
+                ('status', models.CharField(choices=[('provisioning', 'Provisioning'), ('ready', 'Ready'), ('claimed', 'Claimed'), ('failed', 'Failed')], default='provisioning', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['host', 'cpu', 'memory', 'disk_size', 'status'], name='vm_manageme_host_24ee80_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.0.6 on 2026-10-19 14:56
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm_management', '0011_warmvm'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='export_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='export_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='export_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('exporting', 'Exporting'), ('exported', 'Exported'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='exported_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='manifest',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='snapshot_uuid',
+            field=models.CharField(blank=True, default='', max_length=36),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='stored_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='backup',
+            index=models.Index(fields=['export_status', 'created_at'], name='vm_manageme_export__0fc15a_idx'),
+        ),
+    ]
@@ -32,10 +32,30 @@ class VM(models.Model):
         }
     
 class Backup(models.Model):
+    EXPORT_STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('exporting', 'Exporting'),
+        ('exported', 'Exported'),
+        ('failed', 'Failed'),
+    ]
+
     vm = models.ForeignKey(VM, on_delete=models.CASCADE)
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     description = models.TextField(blank=True, null=True)  # Optional field for description
+    snapshot_uuid = models.CharField(max_length=36, blank=True, default='')  # As reported by 'snapshot take'
+    # Copy of the snapshot's disk in the backup store (see backup_store.py)
+    export_status = models.CharField(max_length=20, choices=EXPORT_STATUS_CHOICES, default='pending')
+    export_started_at = models.DateTimeField(null=True, blank=True)
+    exported_at = models.DateTimeField(null=True, blank=True)
+    export_error = models.TextField(blank=True, default='')
+    manifest = models.JSONField(null=True, blank=True)  # {'chunk_size', 'size', 'codec', 'chunks': [SHA-256 of each chunk]}
+    stored_size = models.BigIntegerField(default=0)  # Compressed bytes this backup added to the store
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['export_status', 'created_at']),
+        ]
 
     def __str__(self):
         return f"Backup for {self.vm.name} by {self.user.username} on {self.created_at.strftime('%Y-%m-%d %H:%M:%S')}"
@@ -47,6 +67,8 @@ class Backup(models.Model):
             'user': self.user.username,
             'created_at': self.created_at.isoformat(),
             'description': self.description,
+            'export_status': self.export_status,
+            'size': self.manifest['size'] if self.manifest else None,
         }
 
 class ActionLog(models.Model):
@@ -159,3 +181,84 @@ class Subscription(models.Model):
         user_backup_count = ActionLog.objects.filter(user=self.user, action_type='backup').count()
         return user_backup_count < self.rate_plan.max_backups
 
+
+class OutboundEmail(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+
+    to_email = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)  # Earliest time the worker may (re)try
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"Email to {self.to_email}: {self.subject} - {self.status}"
+
+
+class RequestProfile(models.Model):
+    user = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True)  # Admin who asked for the profile
+    method = models.CharField(max_length=10)
+    path = models.TextField()
+    view_name = models.CharField(max_length=200, blank=True, default='')
+    status_code = models.IntegerField()
+    duration = models.FloatField()  # Wall time in seconds
+    query_count = models.IntegerField(default=0)
+    query_time = models.FloatField(default=0)  # Seconds spent in SQL
+    queries = models.JSONField(default=list)  # [{'sql': ..., 'time': seconds}]
+    stats = models.BinaryField()  # cProfile stats (marshal format, loadable with pstats)
+    summary = models.TextField()  # Top functions by cumulative time
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
+
+    @property
+    def duration_ms(self):
+        return self.duration * 1000
+
+    @property
+    def query_time_ms(self):
+        return self.query_time * 1000
+
+
+class WarmVM(models.Model):
+    """
+    A VM cloned ahead of demand (see warm_pool.py), handed out by create_vm instead of building one.
+    """
+    STATUS_CHOICES = [
+        ('provisioning', 'Provisioning'),
+        ('ready', 'Ready'),
+        ('claimed', 'Claimed'),
+        ('failed', 'Failed'),
+    ]
+
+    host = models.CharField(max_length=255)
+    name = models.CharField(max_length=100, unique=True)  # Name on the host until it is claimed
+    cpu = models.IntegerField()
+    memory = models.IntegerField()  # MB
+    disk_size = models.IntegerField()  # MB
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='provisioning')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['host', 'cpu', 'memory', 'disk_size', 'status']),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.cpu} CPU, {self.memory} MB, {self.disk_size} MB disk) - {self.status}"
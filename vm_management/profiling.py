@@ -0,0 +1,105 @@
+"""
+On-demand profiling of single requests.
+
+An admin adds ?_profile=1 or an "X-Profile: 1" header to any request. The
+request then runs under cProfile, its SQL is captured through the metrics
+query hook, and the result is stored as a RequestProfile that admins can
+list, inspect and download as a .prof file (pstats, snakeviz). Requests
+without the flag only pay for two dictionary lookups. Only the latest
+MAX_PROFILES profiles are kept.
+"""
+import cProfile
+import io
+import marshal
+import pstats
+import threading
+
+from accounts.models import UserRole
+from .metrics import RequestTimings
+from .models import RequestProfile
+
+PROFILE_QUERY_PARAM = '_profile'
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+SUMMARY_LINES = 40
+
+# Each profile holds a whole pstats dump and the request's SQL
+MAX_PROFILES = 200
+
+# cProfile hooks the whole interpreter thread, so only one request is profiled at a time
+_profiling_lock = threading.Lock()
+
+
+def is_profiling_requested(request):
+    return request.META.get(PROFILE_HEADER) == '1' or request.GET.get(PROFILE_QUERY_PARAM) == '1'
+
+
+def can_profile(user):
+    return user.is_authenticated and user.role == UserRole.ADMIN
+
+
+class RequestProfiler:
+    """
+    cProfile and SQL capture of one request.
+
+    Parameters:
+        timings (RequestTimings): The request's metrics, used to capture its SQL.
+    """
+    def __init__(self, timings):
+        # Without the metrics middleware there is nothing to hook the SQL capture to
+        self.timings = timings or RequestTimings()
+        self.profilers = {}  # {thread id: cProfile.Profile}
+
+    def start(self):
+        """
+        Start profiling the calling thread. Returns False if another request is being profiled.
+        """
+        if not _profiling_lock.acquire(blocking=False):
+            return False
+        self.timings.queries = []
+        self.enable()
+        return True
+
+    def enable(self):
+        """
+        Profile the calling thread too, e.g. the worker thread running a sync view under ASGI.
+        """
+        profiler = self.profilers[threading.get_ident()] = cProfile.Profile()
+        profiler.enable()
+
+    def disable(self):
+        self.profilers[threading.get_ident()].disable()
+
+    def stop(self):
+        """
+        Stop profiling the thread that called start(); disable() the others first.
+        """
+        self.disable()
+        _profiling_lock.release()
+
+    def save(self, request, response, user, view_name):
+        """
+        Store the profile and add its id to the response.
+        """
+        summary = io.StringIO()
+        stats = pstats.Stats(*self.profilers.values(), stream=summary)
+        stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+
+        queries = self.timings.queries
+        profile = RequestProfile.objects.create(
+            user=user,
+            method=request.method,
+            path=request.get_full_path(),
+            view_name=view_name,
+            status_code=response.status_code,
+            duration=self.timings.elapsed,
+            query_count=len(queries),
+            query_time=sum(query['time'] for query in queries),
+            queries=queries,
+            stats=marshal.dumps(stats.stats),
+            summary=summary.getvalue(),
+        )
+        response['X-Profile-Id'] = str(profile.id)
+
+        stale = RequestProfile.objects.order_by('-created_at', '-id').values_list('id', flat=True)[MAX_PROFILES:]
+        RequestProfile.objects.filter(id__in=list(stale)).delete()
+        return profile
@@ -0,0 +1,185 @@
+"""
+Reconciliation of the VM table with the hypervisor.
+
+VM.status is only written by start_vm and stop_vm, so a VM shut down from
+inside the guest or changed on the host directly drifts from its row.
+reconcile() reads the whole inventory of a host with one
+`vboxmanage list vms --long` (or one call to the host's agent, see
+agent.py), diffs it against the VM table in memory and writes the
+corrections in a few bulk queries; VMs that exist on only one side are
+reported, never deleted.
+
+The rows are read before the inventory, and a status is only corrected if
+the row still has the status that was read: a start or stop that went
+through transition_status in the meantime is newer than the inventory and
+wins. VMs in a transitional state (starting, stopping, snapshotting, ...)
+keep their status until the next run.
+"""
+import re
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from django.db import transaction
+
+from .agent_client import get_agent
+from .events import get_vm_events, publish
+from .fragment_cache import bump_object_versions
+from .hypervisor import run_vboxmanage_command, host_username, host_password, host_ip
+from .models import VM
+from .versioning import bump_user_version
+
+INVENTORY_COMMAND = 'vboxmanage list vms --long'
+
+# A VM's block starts with its unindented name; shared folders also have
+# unindented "Name: 'folder', Host path: ..." lines, always quoted
+VM_NAME_RE = re.compile(r"^Name:\s+(?!')(.+?)\s*$")
+STATE_RE = re.compile(r'^State:\s+(.+?)(?:\s+\(since .*\))?\s*$')
+MEMORY_RE = re.compile(r'^Memory size:\s+(\d+)\s*MB', re.IGNORECASE)
+CPUS_RE = re.compile(r'^Number of CPUs:\s+(\d+)')
+
+# States as `list vms --long` prints them. The VM holds its resources in
+# RUNNING_STATES and none in STOPPED_STATES; every other state is transitional or unknown.
+RUNNING_STATES = {'running', 'paused', 'guru meditation'}
+STOPPED_STATES = {'powered off', 'saved', 'aborted', 'aborted-saved', 'teleported'}
+
+# The same states as the agent reports them (MachineState names, see agent.py)
+AGENT_RUNNING_STATES = {'running', 'paused', 'stuck'}
+AGENT_STOPPED_STATES = {'poweredoff', 'saved', 'aborted', 'abortedsaved', 'teleported'}
+
+
+@dataclass
+class ReconcileReport:
+    host: str
+    checked: int = 0
+    updated: list = field(default_factory=list)  # [(VM, {field: (old, new)})]
+    missing_on_host: list = field(default_factory=list)  # [VM]
+    unmanaged_on_host: list = field(default_factory=list)  # [name]
+    changed_meanwhile: list = field(default_factory=list)  # [VM] whose status another operation changed during the run
+
+
+def get_status(state, running_states=RUNNING_STATES, stopped_states=STOPPED_STATES):
+    """
+    Map a VirtualBox state to a VM status, or None for transitional and unknown states.
+    """
+    state = state.lower()
+    if state in running_states:
+        return 'running'
+    if state in stopped_states:
+        return 'stopped'
+    return None
+
+
+def parse_inventory(output):
+    """
+    Parse the output of `vboxmanage list vms --long`.
+
+    Returns:
+        dict: {VM name: {'status', 'memory', 'cpu'}} with whatever fields were found.
+    """
+    inventory = {}
+    current = None
+    for line in output.splitlines():
+        match = VM_NAME_RE.match(line)
+        if match:
+            current = inventory.setdefault(match.group(1), {})
+            state_seen = False
+            continue
+        if current is None:
+            continue
+        if not state_seen and (match := STATE_RE.match(line)):
+            state_seen = True
+            status = get_status(match.group(1))
+            if status:
+                current['status'] = status
+        elif 'memory' not in current and (match := MEMORY_RE.match(line)):
+            current['memory'] = int(match.group(1))
+        elif 'cpu' not in current and (match := CPUS_RE.match(line)):
+            current['cpu'] = int(match.group(1))
+    return inventory
+
+
+def get_agent_inventory(vms):
+    """
+    Turn the agent's list of VMs (see agent.py) into the inventory parse_inventory() returns.
+    """
+    inventory = {}
+    for vm in vms:
+        inventory[vm['name']] = {'memory': vm['memory'], 'cpu': vm['cpu']}
+        status = get_status(vm['state'], AGENT_RUNNING_STATES, AGENT_STOPPED_STATES)
+        if status:
+            inventory[vm['name']]['status'] = status
+    return inventory
+
+
+def reconcile(host=None, dry_run=False):
+    """
+    Bring the status, memory and CPU count of every VM row in line with the host.
+
+    Parameters:
+        host (str): Host to read the inventory of, HOST_IP by default.
+        dry_run (bool): Only report the drift.
+
+    Returns:
+        ReconcileReport
+    """
+    host = host or host_ip
+    vms = list(VM.objects.only('id', 'name', 'user_id', 'status', 'memory', 'cpu', 'disk_size'))
+    agent = get_agent(host)
+    if agent:
+        inventory = get_agent_inventory(agent.call('list'))
+    else:
+        inventory = parse_inventory(run_vboxmanage_command(host, host_username, host_password, INVENTORY_COMMAND))
+    report = ReconcileReport(host=host, checked=len(vms))
+
+    known_names = set()
+    for vm in vms:
+        known_names.add(vm.name)
+        actual = inventory.get(vm.name)
+        if actual is None:
+            report.missing_on_host.append(vm)
+            continue
+        diff = {name: (getattr(vm, name), value) for name, value in actual.items() if getattr(vm, name) != value}
+        if diff:
+            report.updated.append((vm, diff))
+    report.unmanaged_on_host = sorted(set(inventory) - known_names)
+
+    if report.updated and not dry_run:
+        _write_corrections(report)
+    return report
+
+
+def _write_corrections(report):
+    transitions = defaultdict(list)  # {(status read, status on the host): [VM id]}
+    for vm, diff in report.updated:
+        if 'status' in diff:
+            transitions[diff['status']].append(vm.id)
+
+    with transaction.atomic():
+        corrected_ids = set()
+        for (old, new), ids in transitions.items():
+            # Only the rows still in the status read before the inventory
+            current_ids = list(VM.objects.select_for_update().filter(id__in=ids, status=old).values_list('id', flat=True))
+            VM.objects.filter(id__in=current_ids).update(status=new)
+            corrected_ids.update(current_ids)
+
+        updated = []
+        for vm, diff in report.updated:
+            if 'status' in diff and vm.id not in corrected_ids:
+                del diff['status']
+                report.changed_meanwhile.append(vm)
+            for name, (_, value) in diff.items():
+                setattr(vm, name, value)
+            if diff:
+                updated.append((vm, diff))
+        report.updated = updated
+
+        resized = [vm for vm, diff in updated if 'memory' in diff or 'cpu' in diff]
+        if resized:
+            VM.objects.bulk_update(resized, ['memory', 'cpu'], batch_size=500)
+
+    changed = [vm for vm, _ in updated]
+    if changed:
+        # Bulk queries skip model signals
+        bump_user_version(*{vm.user_id for vm in changed})
+        bump_object_versions(changed)
+        publish([event for vm in changed for event in get_vm_events(vm)])
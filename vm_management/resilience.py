@@ -0,0 +1,230 @@
+"""
+Timeouts, retries and circuit breaking of hypervisor commands.
+
+Both hypervisor clients connect with HYPERVISOR_CONNECT_TIMEOUT and give up
+on a command that stays silent for HYPERVISOR_COMMAND_TIMEOUT seconds
+(HYPERVISOR_HEAVY_COMMAND_TIMEOUT for disk-heavy ones), raising
+HostConnectionError. Only read-only commands are retried, with jittered
+exponential backoff: retrying a startvm whose reply was lost could start
+the VM twice.
+
+A per-host circuit breaker counts consecutive connection failures. After
+HYPERVISOR_BREAKER_FAILURES it opens and every command fails at once with
+HypervisorUnavailable instead of tying up a worker on a dead host; after
+HYPERVISOR_BREAKER_RESET_SECONDS a single probe command is let through and
+closes it again if it succeeds. While the host is unavailable, the reads
+behind the VM pages (CACHED_SUBCOMMANDS) are answered with the last output
+the host gave for them, so the pages keep rendering the last known state.
+The inventory and metrics reads are not: the reconciler and the collector
+must never mistake old output for the host's current state.
+
+Breakers are kept per worker process, like the admission schedulers.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .admission import HEAVY_SUBCOMMANDS
+from .hypervisor_stats import get_subcommand
+from .metrics import increment
+
+logger = logging.getLogger(__name__)
+
+READ_ONLY_SUBCOMMANDS = {'showvminfo', 'list', 'snapshot list', 'metrics query', 'agent list', 'agent info', 'agent metrics'}
+CACHED_SUBCOMMANDS = {'showvminfo', 'snapshot list'}
+
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 2
+
+STALE_OUTPUT_KEY = 'vm_management:hypervisor_output:{}:{}'
+# Last known output of a read-only command is served for at most a day
+STALE_OUTPUT_TIMEOUT = 24 * 60 * 60
+
+
+class HostConnectionError(Exception):
+    """
+    The host could not be reached or did not answer in time (as opposed to vboxmanage exiting with an error).
+    """
+
+
+class HypervisorUnavailable(Exception):
+    """
+    The host is unreachable or its circuit breaker is open; retry_after is a hint in seconds.
+    """
+    def __init__(self, host, retry_after):
+        super().__init__(f'Hypervisor {host} is unavailable, retry in {retry_after}s')
+        self.host = host
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Closed, open or half-open state of one host.
+    """
+    def __init__(self, host):
+        self.host = host
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 1
+        remaining = settings.HYPERVISOR_BREAKER_RESET_SECONDS - (time.monotonic() - self.opened_at)
+        return max(1, math.ceil(remaining))
+
+    def allow(self):
+        """
+        Raises:
+            HypervisorUnavailable: If the breaker is open, or half-open with its probe still running.
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if time.monotonic() - self.opened_at >= settings.HYPERVISOR_BREAKER_RESET_SECONDS:
+                # Let this command through as the probe (again if the last probe never reported back)
+                self.state = 'half_open'
+                self.opened_at = time.monotonic()
+                return
+            increment('hypervisor_fast_failures_total', {'host': self.host})
+            raise HypervisorUnavailable(self.host, self.retry_after())
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f'Hypervisor {self.host} is reachable again, closing its circuit breaker')
+            self.state = 'closed'
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        increment('hypervisor_connection_failures_total', {'host': self.host})
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= settings.HYPERVISOR_BREAKER_FAILURES:
+                if self.state != 'open':
+                    logger.warning(f'Hypervisor {self.host} failed {self.failures} times in a row, opening its circuit breaker')
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host):
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def is_read_only(command):
+    return get_subcommand(command) in READ_ONLY_SUBCOMMANDS
+
+
+def get_command_timeout(command):
+    if get_subcommand(command) in HEAVY_SUBCOMMANDS:
+        return settings.HYPERVISOR_HEAVY_COMMAND_TIMEOUT
+    return settings.HYPERVISOR_COMMAND_TIMEOUT
+
+
+def get_backoff(attempt):
+    """
+    Delay before retry number attempt + 1: "full jitter", so retries of many workers spread out.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def get_stale_output_key(host, command):
+    return STALE_OUTPUT_KEY.format(host, hashlib.md5(command.encode()).hexdigest())
+
+
+def is_cached(command):
+    return get_subcommand(command) in CACHED_SUBCOMMANDS
+
+
+def _get_attempts(command):
+    return 1 + settings.HYPERVISOR_READ_RETRIES if is_read_only(command) else 1
+
+
+def _fail(breaker, host, command, error):
+    breaker.record_failure()
+    logger.warning(f'vboxmanage {get_subcommand(command)} on {host} failed: {error}')
+    return HypervisorUnavailable(host, breaker.retry_after())
+
+
+def _serve_stale(host, command, stale, error):
+    if stale is None:
+        raise error
+    increment('hypervisor_stale_reads_total', {'host': host})
+    logger.warning(f'Serving the last known output of vboxmanage {get_subcommand(command)}: {error}')
+    return stale
+
+
+def call(host, command, run_once):
+    """
+    Run a command through the host's breaker, retrying read-only commands.
+
+    Parameters:
+        run_once (callable): Runs the command once and returns its output; raises HostConnectionError.
+
+    Raises:
+        HypervisorUnavailable: If the host cannot be reached and there is no last known output.
+    """
+    breaker = get_breaker(host)
+    attempts = _get_attempts(command)
+    try:
+        for attempt in range(attempts):
+            breaker.allow()
+            try:
+                output = run_once()
+            except HostConnectionError as error:
+                unavailable = _fail(breaker, host, command, error)
+                if attempt + 1 == attempts:
+                    raise unavailable
+                increment('hypervisor_retries_total', {'host': host})
+                time.sleep(get_backoff(attempt))
+                continue
+            breaker.record_success()
+            if is_cached(command):
+                cache.set(get_stale_output_key(host, command), output, STALE_OUTPUT_TIMEOUT)
+            return output
+    except HypervisorUnavailable as error:
+        stale = cache.get(get_stale_output_key(host, command)) if is_cached(command) else None
+        return _serve_stale(host, command, stale, error)
+
+
+async def acall(host, command, run_once):
+    """
+    Async version of call(); run_once returns a coroutine.
+    """
+    breaker = get_breaker(host)
+    attempts = _get_attempts(command)
+    try:
+        for attempt in range(attempts):
+            breaker.allow()
+            try:
+                output = await run_once()
+            except HostConnectionError as error:
+                unavailable = _fail(breaker, host, command, error)
+                if attempt + 1 == attempts:
+                    raise unavailable
+                increment('hypervisor_retries_total', {'host': host})
+                await asyncio.sleep(get_backoff(attempt))
+                continue
+            breaker.record_success()
+            if is_cached(command):
+                await cache.aset(get_stale_output_key(host, command), output, STALE_OUTPUT_TIMEOUT)
+            return output
+    except HypervisorUnavailable as error:
+        stale = await cache.aget(get_stale_output_key(host, command)) if is_cached(command) else None
+        return _serve_stale(host, command, stale, error)
@@ -0,0 +1,79 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from accounts.models import CustomUser
+
+from .events import get_action_events, get_vm_events, publish
+from .fragment_cache import bump_object_version
+from .metrics import install_query_timer
+from .models import VM, ActionLog, Backup, Payment, Subscription
+from .versioning import bump_user_version
+
+
+@receiver(post_init, sender=VM)
+def remember_vm_owner(sender, instance, **kwargs):
+    """
+    Remember the owner a VM was loaded with so a transfer invalidates both users.
+    """
+    instance._loaded_user_id = instance.user_id
+
+
+@receiver(post_save, sender=VM)
+@receiver(post_delete, sender=VM)
+def publish_vm_change(sender, instance, signal, **kwargs):
+    """
+    Push the VM's new state to the live VM lists (runs before vm_changed resets the loaded owner).
+    """
+    publish(get_vm_events(instance, removed=signal is post_delete))
+
+
+@receiver(post_save, sender=VM)
+@receiver(post_delete, sender=VM)
+def vm_changed(sender, instance, **kwargs):
+    bump_user_version(instance.user_id, getattr(instance, '_loaded_user_id', None))
+    instance._loaded_user_id = instance.user_id
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+@receiver(post_save, sender=Backup)
+@receiver(post_delete, sender=Backup)
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def user_data_changed(sender, instance, **kwargs):
+    bump_user_version(instance.user_id)
+
+
+@receiver(post_save, sender=VM)
+@receiver(post_delete, sender=VM)
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+@receiver(post_save, sender=ActionLog)
+@receiver(post_delete, sender=ActionLog)
+def fragment_source_changed(sender, instance, **kwargs):
+    bump_object_version(instance)
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    """
+    Invalidate the log rows showing the user, except on the last_login update of every login.
+    """
+    if update_fields is None or set(update_fields) != {'last_login'}:
+        bump_object_version(instance)
+
+
+@receiver(post_save, sender=ActionLog)
+def publish_action(sender, instance, created, **kwargs):
+    if created:
+        publish(get_action_events(instance))
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    """
+    Record the queries of every database connection in the request metrics.
+    """
+    install_query_timer(connection)
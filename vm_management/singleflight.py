@@ -0,0 +1,138 @@
+"""
+Single-flight coalescing of identical read-only hypervisor commands.
+
+When several requests of one worker process run the same read-only
+command on the same host at the same time (ten tabs opening vm_details of
+one VM all ask for its showvminfo), only the first one reaches the host;
+the others wait for it and share its output, or its exception. A command
+that arrives after the first one finished runs again, so nothing is ever
+served from here that is older than the call it waited for.
+
+Sync callers (threads) and async callers (event loops) coalesce with each
+other. An async caller that goes away does not cancel the command the
+others are waiting for.
+"""
+import asyncio
+import shlex
+import threading
+
+from .metrics import increment, timed
+
+
+def get_flight_key(host, command):
+    """
+    Normalize a command line so that spacing and quoting differences don't keep identical commands apart.
+    """
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        args = command.split()
+    if args and args[0].lower() == 'vboxmanage':
+        args = ['vboxmanage', *args[1:]]
+    return host, tuple(args)
+
+
+class _Flight:
+    """
+    One command in progress and the callers waiting for its result.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.futures = []  # [(event loop, future)] of async waiters
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+        for loop, future in self.futures:
+            try:
+                loop.call_soon_threadsafe(_resolve, future, self)
+            except RuntimeError:  # the waiter's event loop has closed
+                pass
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _resolve(future, flight):
+    if not future.done():
+        future.set_result(flight)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def _join(self, key, loop=None):
+        """
+        Returns:
+            tuple: (flight, whether the caller leads it, the caller's future if it follows from an event loop)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                return flight, True, None
+            future = None
+            if loop is not None:
+                future = loop.create_future()
+                flight.futures.append((loop, future))
+            return flight, False, future
+
+    def _land(self, key, flight, result=None, error=None):
+        with self._lock:
+            del self._flights[key]
+        flight.finish(result, error)
+
+    def do(self, key, func):
+        """
+        Call func, or wait for the identical call already in progress.
+        """
+        flight, leader, _ = self._join(key)
+        if not leader:
+            increment('hypervisor_coalesced_commands_total', {'host': key[0]})
+            with timed('hypervisor'):
+                flight.done.wait()
+            return flight.get()
+
+        try:
+            result = func()
+        except Exception as error:
+            self._land(key, flight, error=error)
+            raise
+        self._land(key, flight, result)
+        return result
+
+    async def ado(self, key, func):
+        """
+        Async version of do(); func returns a coroutine, which runs as its own task.
+        """
+        loop = asyncio.get_running_loop()
+        flight, leader, future = self._join(key, loop)
+        if not leader:
+            increment('hypervisor_coalesced_commands_total', {'host': key[0]})
+            with timed('hypervisor'):
+                await future
+            return flight.get()
+
+        task = loop.create_task(func())
+
+        def land(task):
+            if task.cancelled():
+                self._land(key, flight, error=asyncio.CancelledError())
+            elif task.exception() is not None:
+                self._land(key, flight, error=task.exception())
+            else:
+                self._land(key, flight, task.result())
+
+        task.add_done_callback(land)
+        # Shielded: the leader's request going away must not cancel the command for the followers
+        return await asyncio.shield(task)
+
+
+flights = SingleFlight()
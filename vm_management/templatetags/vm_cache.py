@@ -0,0 +1,53 @@
+from django import template
+from django.core.cache import cache
+
+from vm_management.fragment_cache import get_fragment_timeout, make_fragment_key, record_lookup
+
+register = template.Library()
+
+
+class CachedFragmentNode(template.Node):
+    def __init__(self, nodelist, fragment_name, vary_on):
+        self.nodelist = nodelist
+        self.fragment_name = fragment_name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        fragment_name = self.fragment_name.resolve(context)
+        key = make_fragment_key(fragment_name, [var.resolve(context) for var in self.vary_on])
+
+        value = cache.get(key)
+        record_lookup(fragment_name, hit=value is not None)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(key, value, get_fragment_timeout())
+        return value
+
+
+@register.tag('cachedfragment')
+def do_cachedfragment(parser, token):
+    """
+    Cache a template fragment keyed by the versions of the objects it renders.
+
+    Usage::
+
+        {% load vm_cache %}
+        {% cachedfragment "vm_row" vm user.role %}
+            ...
+        {% endcachedfragment %}
+
+    Model instances are keyed by their current version, which the model signals
+    bump on every write, so the fragment never needs a timeout to stay fresh.
+    Any other value (e.g. user.role) is simply part of the key.
+    """
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' tag requires a fragment name and at least one value to vary on.")
+
+    nodelist = parser.parse(('endcachedfragment',))
+    parser.delete_first_token()
+    return CachedFragmentNode(
+        nodelist,
+        parser.compile_filter(bits[1]),
+        [parser.compile_filter(bit) for bit in bits[2:]],
+    )
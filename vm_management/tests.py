@@ -1,14 +1,50 @@
 from datetime import datetime, timedelta
 from django.utils import timezone
-from django.test import TestCase, Client
+from django.test import LiveServerTestCase, TestCase, Client, override_settings
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
-from unittest.mock import patch
-from .models import VM, Subscription, RatePlan, Payment, Backup, ActionLog
+from django.contrib.messages import get_messages
+from unittest.mock import MagicMock, patch
+from .models import VM, Subscription, RatePlan, Payment, Backup, ActionLog, RequestProfile, WarmVM
+from .hypervisor import SFTPReader, arun_vboxmanage_command, fake_hypervisor, find_vboxmanage, get_backend, host_ip, host_password, host_username, run_vboxmanage_command
+from .hypervisor_stats import get_subcommand
+from .metrics import METRICS_CACHE, SERIES_COUNT_KEY, SharedCounters
+from .loadtest import create_tenants, parse_mix, run_load, summarize
+from .vm_metrics import collect, get_buffer_key, get_series
+from .events import broker
+from .locks import VMLock, transition_status
+from .warm_pool import get_targets
+from .backup_store import iter_backup, sweep
+from .agent import RPCError, INVALID_PARAMS, make_server, sign
+from .agent_client import AgentClient, AgentError, get_agent
+from .reconcile import reconcile
+from .admission import HEAVY_SLOT_KEY, HostScheduler, HypervisorBusy, admit, get_current_tenant, get_host_slots, get_scheduler
+from .resilience import HypervisorUnavailable, get_breaker, get_stale_output_key
+from asgiref.sync import async_to_sync, sync_to_async
+import asyncio
+import contextlib
+import getpass
+from django.conf import settings
+from django.core.cache import cache, caches
 from django.core.mail import send_mail
 from accounts.models import CustomUser
 import paramiko
+import json
+import os
+import pstats
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 User = get_user_model()
 
@@ -125,3 +161,1069 @@ class VMManagementTests(TestCase):
         
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, 'completed')
+
+    def test_vm_list_conditional_get(self):
+        """
+        Test that vm_list answers a matching If-None-Match with 304 Not Modified.
+        Should return the full page again once one of the user's VMs changes.
+        """
+        response = self.client.get(reverse('vm_list'))
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(reverse('vm_list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        VM.objects.create(name='testvm', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+        response = self.client.get(reverse('vm_list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'testvm')
+
+    def test_vm_list_fragment_cache(self):
+        """
+        Test that VM and log rows are served from the fragment cache until their sources change.
+        Should count one miss, then a hit, then a miss again after the VM or the log's user is saved.
+        """
+        from .fragment_cache import get_stats, reset_stats
+
+        vm = VM.objects.create(name='testvm', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+        reset_stats()
+
+        self.client.get(reverse('vm_list'))
+        self.client.get(reverse('vm_list'))
+        self.assertEqual(get_stats()['vm_row'], {'hits': 1, 'misses': 1})
+
+        vm.status = 'running'
+        vm.save()
+        response = self.client.get(reverse('vm_list'))
+        self.assertContains(response, 'running')
+        self.assertEqual(get_stats()['vm_row'], {'hits': 1, 'misses': 2})
+
+        # Log rows show the user's name, so renaming the user invalidates them; logging in does not
+        ActionLog.objects.create(action_type='create', vm=vm, user=self.user)
+        CustomUser.objects.create_user(username='logadmin', password='12345', role='Admin')
+        self.client.login(username='logadmin', password='12345')
+        self.client.get(reverse('logs'))
+        self.client.login(username='testuser', password='12345')
+        self.client.login(username='logadmin', password='12345')
+        self.client.get(reverse('logs'))
+        self.assertEqual(get_stats()['log_row'], {'hits': 1, 'misses': 1})
+
+        self.user.username = 'renameduser'
+        self.user.save()
+        self.assertContains(self.client.get(reverse('logs')), 'renameduser')
+        self.assertEqual(get_stats()['log_row'], {'hits': 1, 'misses': 2})
+
+    def test_vm_list_api_authorizes_from_token_claims(self):
+        """
+        Test that the VM list API authorizes from the JWT claims.
+        Should only run the VM query, never loading the user row.
+        """
+        from rest_framework.test import APIClient
+
+        VM.objects.create(name='testvm', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+        api_client = APIClient()
+        tokens = api_client.post(reverse('token_obtain_pair'), {'username': 'testuser', 'password': '12345'}).json()
+        api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+
+        with self.assertNumQueries(1):
+            response = api_client.get(reverse('vm_list_api'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['vms'][0]['name'], 'testvm')
+
+        # Claims are reloaded on refresh
+        self.subscription.active = False
+        self.subscription.save()
+        access = api_client.post(reverse('token_refresh'), {'refresh': tokens['refresh']}).json()['access']
+        api_client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        self.assertEqual(api_client.get(reverse('vm_list_api')).status_code, 403)
+
+    @patch('vm_management.async_views.arun_vboxmanage_command')
+    def test_async_start_and_details(self, mock_run_command):
+        """
+        Test the async start_vm and vm_details views.
+        Should update the VM like the sync view, fetch info and snapshots from the host and
+        answer a matching If-None-Match on vm_details with 304 Not Modified.
+        """
+        mock_run_command.side_effect = lambda host, username, password, command: (
+            'Name: testvm\nMemory size: 256MB' if 'showvminfo' in command else '   Name: snap1 (UUID: 1)'
+        )
+        vm = VM.objects.create(name='testvm', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+
+        response = self.client.get(reverse('start_vm_async', args=[vm.id]))
+        self.assertEqual(response.status_code, 302)
+        vm.refresh_from_db()
+        self.assertEqual(vm.status, 'running')
+        self.assertTrue(ActionLog.objects.filter(action_type='start', vm=vm, user=self.user).exists())
+
+        response = self.client.get(reverse('vm_details_async', args=[vm.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '256MB')
+        self.assertContains(response, 'snap1')
+
+        # Revalidated like the sync view, without asking the host again
+        mock_run_command.reset_mock()
+        response = self.client.get(reverse('vm_details_async', args=[vm.id]), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        mock_run_command.assert_not_called()
+
+    @patch('paramiko.SSHClient')
+    def test_server_timing_and_metrics(self, mock_ssh_client):
+        """
+        Test the request metrics.
+        Should report database, hypervisor and template time in Server-Timing and in the /metrics histograms.
+        """
+        stdout = MagicMock()
+        stdout.read.return_value = b''
+        stdout.channel.recv_exit_status.return_value = 0
+        mock_ssh_client.return_value.exec_command.return_value = (MagicMock(), stdout, MagicMock())
+        vm = VM.objects.create(name='testvm', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+
+        response = self.client.get(reverse('start_vm', args=[vm.id]))
+        self.assertRegex(response['Server-Timing'], r'app;dur=[\d.]+, db;dur=[\d.]+;desc="\d+", hypervisor;dur=[\d.]+;desc="1"')
+
+        response = self.client.get(reverse('vm_list'))
+        self.assertRegex(response['Server-Timing'], r'template;dur=[\d.]+;desc="1"')
+
+        with self.settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('hynfratech_hypervisor_commands_bucket{view="start_vm",le="1"}', body)
+        self.assertRegex(body, r'hynfratech_request_duration_seconds_count\{view="vm_list"\} [1-9]')
+
+    @patch('paramiko.SSHClient')
+    def test_hypervisor_command_stats(self, mock_ssh_client):
+        """
+        Test the per-command hypervisor statistics.
+        Should record exit status, latency and output size per subcommand and host, log slow commands
+        and keep the rolling statistics out of reach of the default cache's culling.
+        """
+        stdout, stderr = MagicMock(), MagicMock()
+        stdout.read.return_value = b''
+        stdout.channel.recv_exit_status.return_value = 1
+        stderr.read.return_value = b'VBoxManage: error: Could not find a registered machine named \'ghost\''
+        mock_ssh_client.return_value.exec_command.return_value = (MagicMock(), stdout, stderr)
+
+        self.assertEqual(get_subcommand('vboxmanage snapshot ghost take ghost'), 'snapshot take')
+        self.assertEqual(get_subcommand('vboxmanage createhd --filename ~/VirtualBox\\ VMs/a/a.vdi --size 10'), 'createhd')
+
+        with self.settings(HYPERVISOR_SLOW_COMMAND_SECONDS=0), self.assertLogs('vm_management.slow_commands') as logs:
+            output = run_vboxmanage_command('10.0.0.7', 'user', 'password', 'vboxmanage snapshot ghost take ghost')
+        self.assertEqual(output, '')
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual((entry['subcommand'], entry['host'], entry['exit_status']), ('snapshot take', '10.0.0.7', 1))
+        self.assertIn('Could not find', entry['stderr'])
+
+        with self.settings(METRICS_TOKEN='secret'):
+            body = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').content.decode()
+        self.assertRegex(body, r'hynfratech_vboxmanage_command_failures_total\{subcommand="snapshot take",host="10.0.0.7"\} [1-9]')
+
+        # However full the default cache gets
+        crowded = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'crowded', 'OPTIONS': {'MAX_ENTRIES': 10}}
+        with self.settings(CACHES={'default': crowded, 'metrics': settings.CACHES['metrics']}):
+            cache.set_many({f'fragment{index}': index for index in range(100)})
+            out = StringIO()
+            call_command('hypervisor_stats', stdout=out)
+        self.assertRegex(out.getvalue(), r'snapshot take\s+10.0.0.7\s+\d+\s+[1-9]')
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'crowded', 'OPTIONS': {'MAX_ENTRIES': 10}},
+        'metrics': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'metric-series', 'TIMEOUT': None, 'OPTIONS': {'MAX_ENTRIES': sys.maxsize}},
+    })
+    def test_metric_series_survive_concurrent_flushes(self):
+        """
+        Test the shared metric counters written by several workers at once.
+        Should list every series any worker flushed, however the flushes interleave, flush from a
+        background thread when counting and keep the counters however full the default cache gets.
+        """
+        workers = [SharedCounters('series_test', flush_interval=3600) for _ in range(8)]
+        barrier = threading.Barrier(len(workers))
+        def flush(index):
+            workers[index].add((f'series{index}',), {'value': 1})
+            barrier.wait()
+            workers[index].flush()
+        threads = [threading.Thread(target=flush, args=(index,)) for index in range(len(workers))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(workers[0].get_series(), sorted((f'series{index}',) for index in range(len(workers))))
+
+        writers = []
+        counters = SharedCounters('series_test', flush_interval=0)
+        write = counters._write
+        with patch.object(counters, '_write', side_effect=lambda pending: (writers.append(threading.current_thread()), write(pending))):
+            counters.add(('series0',), {'value': 2})
+            counters.flush()
+        self.assertIsNot(writers[0], threading.current_thread())
+        self.assertEqual(counters.get_values([('series0',)], ['value']), {(('series0',), 'value'): 3})
+
+        # Culling the default cache leaves the metrics alone
+        cache.set_many({f'fragment{index}': index for index in range(100)})
+        self.assertEqual(len(counters.get_series()), len(workers))
+        self.assertEqual(counters.get_values([('series0',)], ['value']), {(('series0',), 'value'): 3})
+
+        # A lost series count (expired by a local backend's incr) registers the series again
+        caches[METRICS_CACHE].delete(SERIES_COUNT_KEY.format('series_test'))
+        counters.add(('series1',), {'value': 1})
+        self.assertEqual(counters.get_series(), [('series1',)])
+
+    @override_settings(HYPERVISOR_BREAKER_FAILURES=3, HYPERVISOR_BREAKER_RESET_SECONDS=0.2)
+    @patch('paramiko.SSHClient')
+    def test_hypervisor_timeouts_and_circuit_breaker(self, mock_ssh_client):
+        """
+        Test hypervisor commands against a host that stops answering.
+        Should connect and read with timeouts, retry only read-only commands, open the breaker after
+        repeated failures, answer reads with the last known output meanwhile and close once the host is back.
+        """
+        host = '10.0.0.45'
+        read_command = 'vboxmanage showvminfo testvm'
+        start_command = 'vboxmanage startvm testvm --type headless'
+        cache.delete(get_stale_output_key(host, read_command))
+        stdout = MagicMock()
+        stdout.read.return_value = b'State: running'
+        stdout.channel.recv_exit_status.return_value = 0
+        ssh = mock_ssh_client.return_value
+        ssh.exec_command.return_value = (MagicMock(), stdout, MagicMock())
+
+        self.assertEqual(run_vboxmanage_command(host, 'user', 'password', read_command), 'State: running')
+        self.assertEqual(ssh.connect.call_args.kwargs['timeout'], settings.HYPERVISOR_CONNECT_TIMEOUT)
+        self.assertEqual(ssh.exec_command.call_args.kwargs['timeout'], settings.HYPERVISOR_COMMAND_TIMEOUT)
+
+        ssh.exec_command.reset_mock()
+        ssh.exec_command.side_effect = socket.timeout('timed out')
+        with self.assertLogs('vm_management.hypervisor_stats', 'WARNING') as logs:
+            self.assertEqual(run_vboxmanage_command(host, 'user', 'password', read_command), 'State: running')
+        self.assertEqual(ssh.exec_command.call_count, 3)
+        self.assertEqual(get_breaker(host).state, 'open')
+        self.assertIn(f'vboxmanage showvminfo on {host} failed', logs.output[0])
+
+        # Open: fail at once without touching the host
+        with self.assertRaises(HypervisorUnavailable):
+            run_vboxmanage_command(host, 'user', 'password', start_command)
+        self.assertEqual(ssh.exec_command.call_count, 3)
+
+        time.sleep(0.2)
+        ssh.exec_command.side_effect = None
+        self.assertEqual(run_vboxmanage_command(host, 'user', 'password', start_command), 'State: running')
+        self.assertEqual(get_breaker(host).state, 'closed')
+
+        # The timed out attempts count as failed commands
+        with self.settings(METRICS_TOKEN='secret'):
+            body = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').content.decode()
+        failures = re.search(rf'hynfratech_vboxmanage_command_failures_total\{{subcommand="showvminfo",host="{host}"\}} (\d+)', body)
+        self.assertGreaterEqual(int(failures.group(1)), 3)
+
+    @override_settings(HYPERVISOR_BACKEND='fake')
+    def test_identical_reads_are_coalesced(self):
+        """
+        Test single-flight coalescing of hypervisor commands.
+        Should run concurrent identical read-only commands once, from threads and event loops alike,
+        while mutating commands always run.
+        """
+        host = '10.0.0.46'
+        calls = []
+        def slow_run(command):
+            calls.append(command)
+            time.sleep(0.2)
+            return 0, f'output of {command}', ''
+        async def slow_arun(command):
+            calls.append(command)
+            await asyncio.sleep(0.2)
+            return 0, f'output of {command}', ''
+
+        def run_in_threads(commands):
+            results = []
+            threads = [
+                threading.Thread(target=lambda command=command: results.append(run_vboxmanage_command(host, 'user', 'password', command)))
+                for command in commands
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return results
+
+        with patch.object(fake_hypervisor, 'run', side_effect=slow_run):
+            results = run_in_threads(['vboxmanage showvminfo vm1', 'vboxmanage  showvminfo "vm1"'] * 3)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(set(results), {'output of vboxmanage showvminfo vm1'})
+
+            calls.clear()
+            run_in_threads(['vboxmanage controlvm vm1 acpipowerbutton'] * 2)
+            self.assertEqual(len(calls), 2)
+
+        calls.clear()
+        async def read_concurrently():
+            return await asyncio.gather(*[
+                arun_vboxmanage_command(host, 'user', 'password', 'vboxmanage snapshot vm1 list') for _ in range(4)
+            ])
+        with patch.object(fake_hypervisor, 'arun', side_effect=slow_arun):
+            results = async_to_sync(read_concurrently)()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(results)), 1)
+
+    @override_settings(WARM_POOL_SHAPES='2:1024:2048', WARM_POOL_MIN_PER_SHAPE=1, WARM_POOL_MAX_PER_SHAPE=3)
+    @patch('vm_management.warm_pool.run_vboxmanage_command')
+    @patch('vm_management.views.run_vboxmanage_command')
+    def test_warm_pool(self, mock_view_command, mock_pool_command):
+        """
+        Test the warm pool of pre-provisioned VMs.
+        Should size the pool of each shape by recent demand, fill it with linked clones and hand
+        a ready VM to create_vm by renaming it instead of building one.
+        """
+        self.rate_plan.max_vms = 100
+        self.rate_plan.save()
+        other = CustomUser.objects.create_user(username='other', password='12345')
+        VM.objects.bulk_create([
+            VM(name=f'recent{index}', user=other, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+            for index in range(20)
+        ])
+        self.assertEqual(get_targets(), {(1, 256, 1024): 3, (2, 1024, 2048): 1})
+
+        out = StringIO()
+        call_command('refill_warm_pool', stdout=out)
+        self.assertIn('4 cloned', out.getvalue())
+        clone_commands = [call.args[3] for call in mock_pool_command.call_args_list if 'clonevm' in call.args[3]]
+        self.assertEqual(len(clone_commands), 4)
+        self.assertTrue(all('--options link' in command for command in clone_commands))
+        self.assertEqual(sum(command.startswith('vboxmanage clonevm template-1024 --snapshot base ') for command in clone_commands), 3)
+        self.assertEqual(WarmVM.objects.filter(status='ready').count(), 4)
+
+        mock_pool_command.reset_mock()
+        warm = WarmVM.objects.filter(cpu=1, memory=256, disk_size=1024).order_by('created_at').first()
+        self.client.post(reverse('create_vm'), {'name': 'instantvm', 'disk_size': 1024, 'cpu': 1, 'memory': 256})
+        mock_view_command.assert_not_called()
+        mock_pool_command.assert_called_once_with(host_ip, host_username, host_password, f'vboxmanage modifyvm {warm.name} --name instantvm')
+        self.assertTrue(VM.objects.filter(name='instantvm', user=self.user, cpu=1, memory=256).exists())
+        self.assertFalse(WarmVM.objects.filter(id=warm.id).exists())
+
+        # No VM of this shape in the pool: built from scratch
+        self.client.post(reverse('create_vm'), {'name': 'coldvm', 'disk_size': 1536, 'cpu': 1, 'memory': 256})
+        commands = [call.args[3] for call in mock_view_command.call_args_list]
+        self.assertIn('vboxmanage createvm --name coldvm --register', commands)
+        self.assertEqual(commands[-1], 'vboxmanage storageattach coldvm --storagectl SATA --port 0 --device 0 --type hdd --medium ~/VirtualBox\\ VMs/coldvm/coldvm.vdi')
+
+    def test_local_backend(self):
+        """
+        Test the local execution backend.
+        Should run vboxmanage as a local process from an argument list, without a shell, when the
+        host is this machine, vboxmanage is installed and the app runs as the host user, and over SSH otherwise.
+        """
+        user = getpass.getuser()
+        self.assertEqual(get_backend('127.0.0.1', user), 'ssh')  # vboxmanage is not installed here
+
+        bin_dir = tempfile.mkdtemp()
+        executable = os.path.join(bin_dir, 'vboxmanage')
+        with open(executable, 'w') as script:
+            script.write('#!/bin/sh\nprintf "%s\\n" "$@"\n')
+        os.chmod(executable, 0o755)
+        find_vboxmanage.cache_clear()
+        self.addCleanup(find_vboxmanage.cache_clear)
+
+        with patch.dict(os.environ, {'PATH': bin_dir + os.pathsep + os.environ['PATH']}):
+            find_vboxmanage.cache_clear()
+            self.assertEqual(get_backend('127.0.0.1', user), 'local')
+            self.assertEqual(get_backend('10.0.0.7', user), 'ssh')
+
+            # Another user's VMs are registered under that user: only SSH as them reaches those
+            self.assertEqual(get_backend('127.0.0.1', 'someone-else'), 'ssh')
+            with self.settings(HYPERVISOR_BACKEND='local'), self.assertRaisesRegex(ValueError, 'not as HOST_USER someone-else'):
+                run_vboxmanage_command('127.0.0.1', 'someone-else', 'password', 'vboxmanage list vms')
+
+            output = run_vboxmanage_command('127.0.0.1', user, 'password', 'vboxmanage createhd --filename ~/VirtualBox\\ VMs/a/a.vdi --size 10')
+            self.assertEqual(output.splitlines(), ['createhd', '--filename', os.path.expanduser('~/VirtualBox VMs/a/a.vdi'), '--size', '10'])
+
+            # Shell syntax in a VM name stays part of one argument
+            output = async_to_sync(arun_vboxmanage_command)('127.0.0.1', user, 'password', 'vboxmanage startvm "a;touch pwned"')
+            self.assertEqual(output.splitlines(), ['startvm', 'a;touch pwned'])
+            self.assertFalse(os.path.exists('pwned'))
+
+    def test_hypervisor_agent(self):
+        """
+        Test the hypervisor-side agent and its client.
+        Should answer a signed batch of calls in one request, refuse unsigned and replayed ones, serve the
+        reconciler's inventory of 500 VMs and the collector's metrics without running vboxmanage and
+        record the agent's calls in the command statistics.
+        """
+        class StandInVirtualBox:
+            requests = 0
+
+            def init_thread(self):
+                self.requests += 1
+
+            def deinit_thread(self):
+                pass
+
+            def list(self):
+                return [{'name': f'agent-{i}', 'id': str(i), 'state': 'running', 'memory': 256, 'cpu': 1} for i in range(500)]
+
+            def info(self, name):
+                if name != 'agent-0':
+                    raise RPCError(INVALID_PARAMS, f'No VM named {name!r}')
+                return {'name': name, 'state': 'poweredoff', 'memory': 256, 'cpu': 1, 'snapshots': 0}
+
+            def metrics(self, names):
+                return {'agent-0': {'Guest/CPU/Load/User': 10.0, 'Guest/CPU/Load/Kernel': 2.0}, 'host': {'CPU/Load/User': 1.0}}
+
+        virtualbox = StandInVirtualBox()
+        server = make_server(('127.0.0.1', 0), 'secret', session=virtualbox)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f'http://127.0.0.1:{server.server_address[1]}/rpc'
+
+        with self.settings(HYPERVISOR_AGENT_URL=url, HYPERVISOR_AGENT_SECRET='secret'):
+            agent = get_agent('127.0.0.1')
+            info, missing, unknown = agent.batch([('info', {'name': 'agent-0'}), ('info', {'name': 'ghost'}), ('reboot', {})])
+            self.assertEqual(info['state'], 'poweredoff')
+            self.assertIsInstance(missing, AgentError)
+            self.assertEqual(unknown.code, -32601)
+            self.assertEqual(virtualbox.requests, 1)
+
+            with self.assertRaises(AgentError) as refused:
+                AgentClient(url, 'wrong', 5).call('list')
+            self.assertEqual(refused.exception.code, 401)
+
+            # A captured request is refused when sent again, however soon
+            body = json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'list'}).encode()
+            timestamp = int(time.time())
+            handler = server.RequestHandlerClass.agent
+            self.assertEqual(handler.handle(body, timestamp, sign('secret', timestamp, body))[0], 200)
+            self.assertEqual(handler.handle(body, timestamp, sign('secret', timestamp, body))[0], 401)
+
+            vms = VM.objects.bulk_create([
+                VM(name=f'agent-{i}', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+                for i in range(500)
+            ])
+            with patch('vm_management.reconcile.run_vboxmanage_command') as mock_reconcile_command:
+                report = reconcile()
+            mock_reconcile_command.assert_not_called()
+            self.assertEqual(len(report.updated), 500)
+            self.assertEqual(virtualbox.requests, 3)
+
+            cache.delete(get_buffer_key(vms[0].id))
+            with patch('vm_management.vm_metrics.run_vboxmanage_command') as mock_collect_command:
+                self.assertEqual(collect(), 1)
+            mock_collect_command.assert_not_called()
+            self.assertEqual(get_series(vms[0].id)['points'][-1][1], 12.0)
+
+        # The agent's answers count in the command statistics like vboxmanage's
+        out = StringIO()
+        call_command('hypervisor_stats', stdout=out)
+        self.assertRegex(out.getvalue(), rf'agent list\s+{re.escape(host_ip)}\s+[1-9]')
+        self.assertRegex(out.getvalue(), rf'agent metrics\s+{re.escape(host_ip)}\s+[1-9]')
+
+    @patch('vm_management.backup_store.open_host_file')
+    @patch('vm_management.backup_store.run_vboxmanage_command')
+    @patch('vm_management.views.run_vboxmanage_command')
+    def test_backup_export(self, mock_view_command, mock_store_command, mock_open_host_file):
+        """
+        Test the export of backups into the chunked backup store.
+        Should store the disk as of the snapshot in compressed chunks named by their hash, write
+        only the chunks that changed on the next backup of the VM, read the disk back intact and
+        export the disk file of a VM without an attached disk and fail the export when there is none.
+        """
+        store_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store_root)
+        self.rate_plan.max_backups = 3
+        self.rate_plan.save()
+        vm = VM.objects.create(name='backupvm', user=self.user, disk_size=1024, status='running', cpu=1, memory=256, price=0)
+        snapshot_uuid, disk_uuid = '11111111-1111-1111-1111-111111111111', '22222222-2222-2222-2222-222222222222'
+        mock_view_command.return_value = f'0%...10%...100%\nSnapshot taken. UUID: {snapshot_uuid}\n'
+        mock_store_command.return_value = f'SATA (0, 0): /home/u/VirtualBox VMs/backupvm/backupvm.vdi (UUID: {disk_uuid})\n'
+        disk = bytearray(os.urandom(4096) + bytes(4096))  # 8 chunks: 4 random, 4 zeroed
+        mock_open_host_file.side_effect = lambda *args: contextlib.nullcontext(BytesIO(bytes(disk)))
+
+        with override_settings(BACKUP_STORE_ROOT=store_root, BACKUP_CHUNK_SIZE=1024, BACKUP_COMPRESS_THREADS=2):
+            self.client.post(reverse('backup_vm', args=[vm.id]))
+            first = Backup.objects.get(vm=vm)
+            self.assertEqual((first.snapshot_uuid, first.export_status), (snapshot_uuid, 'pending'))
+
+            out = StringIO()
+            call_command('export_backups', stdout=out)
+            self.assertIn('5 chunks written', out.getvalue())
+            self.assertIn('3 already stored', out.getvalue())
+            target = f'~/VirtualBox\\ VMs/backupvm/backup-{first.id}.raw'
+            self.assertEqual([call.args[3] for call in mock_store_command.call_args_list], [
+                f'vboxmanage snapshot backupvm showvminfo {snapshot_uuid}',
+                f'vboxmanage clonemedium disk {disk_uuid} {target} --format RAW',
+                f'vboxmanage closemedium disk {target} --delete',
+            ])
+            first.refresh_from_db()
+            self.assertEqual(first.export_status, 'exported')
+            self.assertEqual((first.manifest['size'], len(first.manifest['chunks'])), (8192, 8))
+            self.assertLess(first.stored_size, 4096 + 1024)
+
+            # One block written since the first backup
+            disk[1500] ^= 0xff
+            self.client.post(reverse('backup_vm', args=[vm.id]))
+            out = StringIO()
+            call_command('export_backups', stdout=out)
+            self.assertIn('1 chunks written', out.getvalue())
+            self.assertIn('7 already stored', out.getvalue())
+            second = Backup.objects.exclude(id=first.id).get()
+            self.assertEqual(b''.join(iter_backup(second)), bytes(disk))
+
+            # Only the chunk no other backup shares goes with the first backup, once past the grace period
+            first.delete()
+            self.assertEqual(sweep(now=timezone.now() + timedelta(days=2)), 1)
+            self.assertEqual(b''.join(iter_backup(second)), bytes(disk))
+
+            # A VM built before create_vm attached its disk: its disk file is exported
+            medium_uuid = '33333333-3333-3333-3333-333333333333'
+            mock_store_command.reset_mock()
+            mock_store_command.side_effect = ['Name: backupvm\n', f'UUID:           {medium_uuid}\nParent UUID:    base\n', '', '']
+            self.client.post(reverse('backup_vm', args=[vm.id]))
+            call_command('export_backups', stdout=StringIO())
+            third = Backup.objects.latest('id')
+            self.assertEqual(third.export_status, 'exported')
+            self.assertEqual(mock_store_command.call_args_list[1].args[3], 'vboxmanage showmediuminfo disk ~/VirtualBox\\ VMs/backupvm/backupvm.vdi')
+            self.assertTrue(mock_store_command.call_args_list[2].args[3].startswith(f'vboxmanage clonemedium disk {medium_uuid} '))
+
+            # Neither an attached disk nor the disk file: the export fails instead of cloning a guessed path
+            mock_store_command.reset_mock()
+            mock_store_command.side_effect = ['Name: backupvm\n', 'VBoxManage: error: Could not find file\n']
+            self.client.post(reverse('backup_vm', args=[vm.id]))
+            call_command('export_backups', stdout=StringIO())
+            fourth = Backup.objects.latest('id')
+            self.assertEqual(fourth.export_status, 'failed')
+            self.assertIn('has no disk attached', fourth.export_error)
+            self.assertEqual(mock_store_command.call_count, 2)
+
+        # Over SSH the disk is read a window at a time, never all at once
+        stream = MagicMock()
+        stream.stat.return_value.st_size = len(disk)
+        stream.readv.side_effect = lambda chunks, limit: [bytes(disk[offset:offset + length]) for offset, length in chunks]
+        reader = SFTPReader(stream, read_ahead=3000)
+        self.assertEqual(b''.join(iter(lambda: reader.read(1024), b'')), bytes(disk))
+        self.assertEqual([call.args[0] for call in stream.readv.call_args_list], [[(0, 3000)], [(3000, 3000)], [(6000, 2192)]])
+
+    def test_request_profiling(self):
+        """
+        Test on-demand request profiling.
+        Should profile flagged requests from admins only, under WSGI and ASGI alike, store their SQL,
+        let admins download the stats and keep only the latest profiles.
+        """
+        response = self.client.get(reverse('vm_list') + '?_profile=1')
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertFalse(RequestProfile.objects.exists())
+
+        admin = CustomUser.objects.create_user(username='admin', password='12345', role='Admin')
+        self.client.login(username='admin', password='12345')
+        response = self.client.get(reverse('logs'), HTTP_X_PROFILE='1')
+        profile = RequestProfile.objects.get(id=response['X-Profile-Id'])
+        self.assertEqual((profile.user, profile.view_name, profile.status_code), (admin, 'logs', 200))
+        self.assertEqual(profile.query_count, len(profile.queries))
+        self.assertTrue(any('vm_management_actionlog' in query['sql'] for query in profile.queries))
+        self.assertIn('get_logs', profile.summary)
+
+        response = self.client.get(reverse('request_profiles'))
+        self.assertContains(response, reverse('request_profile_detail', args=[profile.id]))
+
+        response = self.client.get(reverse('download_request_profile', args=[profile.id]))
+        with tempfile.NamedTemporaryFile(suffix='.prof') as f:
+            f.write(response.content)
+            f.flush()
+            self.assertTrue(pstats.Stats(f.name).stats)
+
+        # Under ASGI the sync view runs in a worker thread, which is profiled too
+        self.async_client.force_login(admin)
+        response = async_to_sync(self.async_client.get)(reverse('logs') + '?_profile=1')
+        self.assertIn('get_logs', RequestProfile.objects.get(id=response['X-Profile-Id']).summary)
+
+        # Only an exact ?_profile=1 asks for a profile, and old profiles are pruned
+        response = self.client.get(reverse('logs') + '?x_profile=10')
+        self.assertNotIn('X-Profile-Id', response)
+        with patch('vm_management.profiling.MAX_PROFILES', 2):
+            latest = [self.client.get(reverse('logs') + '?_profile=1')['X-Profile-Id'] for _ in range(2)]
+        self.assertEqual(sorted(RequestProfile.objects.values_list('id', flat=True)), sorted(int(id) for id in latest))
+
+    @patch('vm_management.views.run_vboxmanage_command')
+    @patch('vm_management.vm_metrics.run_vboxmanage_command')
+    def test_vm_resource_metrics(self, mock_metrics_command, mock_run_command):
+        """
+        Test the VM metrics collector and the views reading its buffers.
+        Should store one query of all VMs per sample, downsample it into the 1m tier, keep the raw tier
+        bounded, and serve the series without calling the hypervisor again.
+        """
+        from django.core.cache import cache
+        from rest_framework.test import APIClient
+
+        vm = VM.objects.create(name='metricsvm', user=self.user, disk_size=1024, status='running', cpu=1, memory=256, price=0)
+        cache.delete(get_buffer_key(vm.id))
+        mock_metrics_command.return_value = (
+            'Object          Metric                                   Values\n'
+            '--------------- ---------------------------------------- ------------\n'
+            'host            Guest/CPU/Load/User                      1.00%\n'
+            'metricsvm       Guest/CPU/Load/User                      10.00%\n'
+            'metricsvm       Guest/CPU/Load/Kernel                    5.00%\n'
+            'metricsvm       Guest/RAM/Usage/Total                    262144 kB\n'
+            'metricsvm       Guest/RAM/Usage/Free                     131072 kB\n'
+            'metricsvm       Net/Rate/Rx                              300 B/s\n'
+            'unknownvm       Net/Rate/Rx                              1 B/s\n'
+        )
+
+        start = (int(time.time()) - 4000) // 60 * 60  # a minute boundary, so the last sample is recent
+        for i in range(400):
+            self.assertEqual(collect(timestamp=start + i * 10), 1)
+        self.assertEqual(mock_metrics_command.call_count, 400)
+        now = start + 399 * 10
+
+        raw = get_series(vm.id, 'raw', now)
+        self.assertEqual(len(raw['points']), 360)  # one hour of 10s samples
+        self.assertEqual(raw['points'][-1], [now, 15.0, 128.0, 300.0, None])
+        minutes = get_series(vm.id, '1m', now)
+        self.assertEqual(len(minutes['points']), 67)
+        self.assertEqual(minutes['points'][0][:2], [start, 15.0])
+
+        mock_run_command.return_value = 'Name: metricsvm'
+        response = self.client.get(reverse('vm_details', args=[vm.id]))
+        self.assertContains(response, 'Resource usage')
+        self.assertContains(response, '128.0 MB')
+        self.assertEqual(mock_metrics_command.call_count, 400)
+
+        # The page is revalidated against the collection interval, not only the user's data version
+        with patch('vm_management.versioning.time.time', return_value=time.time() + 10):
+            response = self.client.get(reverse('vm_details', args=[vm.id]), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+        api_client = APIClient()
+        tokens = api_client.post(reverse('token_obtain_pair'), {'username': 'testuser', 'password': '12345'}).json()
+        api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        response = api_client.get(reverse('vm_metrics_api', args=[vm.id]), {'resolution': '1h'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['fields'], ['cpu', 'ram_used', 'net_rx', 'net_tx'])
+        self.assertEqual(api_client.get(reverse('vm_metrics_api', args=[vm.id]), {'resolution': '5s'}).status_code, 400)
+
+    @patch('vm_management.views.run_vboxmanage_command')
+    def test_live_vm_events(self, mock_run_command):
+        """
+        Test the server-sent event stream of the VM list.
+        Should push the job start, the VM's new status and its action log as soon as start_vm commits.
+        """
+        vm = VM.objects.create(name='testvm', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+        self.async_client.cookies = self.client.cookies
+
+        def start_vm():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.get(reverse('start_vm', args=[vm.id]))
+
+        async def listen():
+            response = await self.async_client.get(reverse('vm_events'))
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            chunks = aiter(response.streaming_content)
+            self.assertIn(b'retry:', await anext(chunks))
+            self.assertEqual(broker.subscriber_count(), 1)
+
+            await sync_to_async(start_vm)()
+            events = [(await asyncio.wait_for(anext(chunks), 5)).decode() for _ in range(3)]
+            await chunks.aclose()
+            return events
+
+        events = async_to_sync(listen)()
+        self.assertTrue(events[0].startswith('event: job\n'))
+        self.assertIn('"action": "start"', events[0])
+        self.assertTrue(events[1].startswith('event: vm\n'))
+        self.assertIn('"status": "running"', events[1])
+        self.assertTrue(events[2].startswith('event: action\n'))
+        self.assertEqual(broker.subscriber_count(), 0)
+
+        self.assertContains(self.client.get(reverse('vm_list')), f'data-vm-id="{vm.id}"')
+
+    @patch('vm_management.reconcile.run_vboxmanage_command')
+    def test_reconcile_vms(self, mock_run_command):
+        """
+        Test the reconcile_vms command.
+        Should read the inventory with one command, fix drifted rows in a few bulk queries, report
+        orphans and leave VMs alone that are in a transitional state or changed during the run.
+        """
+        VM.objects.bulk_create([
+            VM(name=f'bulk-{i}', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+            for i in range(1000)
+        ])
+        ghost = VM.objects.create(name='ghost', user=self.user, disk_size=1024, status='running', cpu=1, memory=256, price=0)
+        blocks = [
+            f'Name:                        bulk-{i}\n'
+            f'Groups:                      /\n'
+            f'Memory size:                 {512 if i == 7 else 256}MB\n'
+            f'Number of CPUs:              1\n'
+            f'State:                       {"running" if i % 2 else "powered off"} (since 2024-09-01T10:00:00.000000000)\n'
+            f"Name: 'share', Host path: '/srv/share' (machine mapping), writable\n"
+            f'Snapshots:\n\n   Name: snap (UUID: 1234) *\n'
+            for i in range(1000)
+        ]
+        blocks.append('Name:                        stray\nState:                       running (since 2024-09-01)\n')
+        # Mid-snapshot (backup_vm) and being started while the inventory is read
+        snapshotting = VM.objects.create(name='snapshotting', user=self.user, disk_size=1024, status='running', cpu=1, memory=256, price=0)
+        starting = VM.objects.create(name='starting', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+        blocks.append('Name:                        snapshotting\nState:                       live snapshotting (since 2024-09-01)\n')
+        blocks.append('Name:                        starting\nState:                       running (since 2024-09-01)\n')
+        def list_vms(*args):
+            VM.objects.filter(id=starting.id).update(status='running')
+            return '\n'.join(blocks)
+        mock_run_command.side_effect = list_vms
+
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('reconcile_vms', stdout=out)
+        # One select, a locked select and update per kind of status change, batched updates and the
+        # concurrent start: never a query per VM
+        self.assertLessEqual(len(queries), 7)
+
+        mock_run_command.assert_called_once()
+        self.assertEqual(VM.objects.filter(name__startswith='bulk-', status='running').count(), 500)
+        self.assertEqual(VM.objects.get(name='bulk-7').memory, 512)
+        self.assertEqual(VM.objects.get(name='bulk-8').status, 'stopped')
+        ghost.refresh_from_db()
+        self.assertEqual(ghost.status, 'running')
+        snapshotting.refresh_from_db()
+        self.assertEqual(snapshotting.status, 'running')
+        self.assertIn('Left starting', out.getvalue())
+        self.assertIn('Missing on', out.getvalue())
+        self.assertIn('Not in the database: stray', out.getvalue())
+        self.assertIn('Checked 1003 VMs', out.getvalue())
+        self.assertIn('500 drifted', out.getvalue())
+
+        out = StringIO()
+        call_command('reconcile_vms', stdout=out)
+        self.assertIn('0 drifted', out.getvalue())
+
+    @override_settings(VM_LOCK_TIMEOUT=0.05)
+    @patch('vm_management.views.run_vboxmanage_command')
+    def test_vm_operations_are_locked_per_vm(self, mock_run_command):
+        """
+        Test the per-VM operation locks.
+        Should reject an operation on a locked VM after the timeout while other VMs proceed,
+        and only write status transitions that still apply.
+        """
+        locked_vm = VM.objects.create(name='lockedvm', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+        other_vm = VM.objects.create(name='othervm', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+
+        lock = VMLock(locked_vm.id, 'test')
+        lock.acquire(0)
+        try:
+            response = self.client.get(reverse('start_vm', args=[locked_vm.id]))
+            self.assertRedirects(response, reverse('vm_list'), fetch_redirect_response=False)
+            self.assertIn('Another operation on this VM', str(list(get_messages(response.wsgi_request))[0]))
+            mock_run_command.assert_not_called()
+
+            response = self.client.get(reverse('start_vm', args=[other_vm.id]))
+            self.assertIn('lock;dur=', response['Server-Timing'])
+            other_vm.refresh_from_db()
+            self.assertEqual(other_vm.status, 'running')
+        finally:
+            lock.release()
+
+        self.client.get(reverse('start_vm', args=[locked_vm.id]))
+        locked_vm.refresh_from_db()
+        self.assertEqual(locked_vm.status, 'running')
+
+        # A transition whose precondition no longer holds changes nothing
+        VM.objects.filter(id=other_vm.id).update(status='stopped', memory=512)
+        self.assertFalse(transition_status(other_vm, 'stopped', from_statuses=['running']))
+        self.assertTrue(transition_status(other_vm, 'running', from_statuses=['stopped']))
+        other_vm.refresh_from_db()
+        self.assertEqual((other_vm.status, other_vm.memory), ('running', 512))
+
+    def test_hypervisor_fair_scheduling(self):
+        """
+        Test the per-host admission scheduler.
+        Should hand free slots to waiting tenants in proportion to their plan weight, keep a
+        slot for quick commands while heavy ones are capped, and reject a tenant whose queue is full.
+        """
+        scheduler = HostScheduler('testhost', max_concurrent=1, max_heavy=1, max_queued=100, max_queued_per_tenant=3)
+        scheduler.acquire('system', 1, 1, False, timeout=0)
+        bronze = [scheduler._enqueue('bronze', 1, 1, False) for _ in range(3)]
+        gold = [scheduler._enqueue('gold', 4, 1, False) for _ in range(3)]
+        with self.assertRaises(HypervisorBusy) as rejected:
+            scheduler._enqueue('bronze', 1, 1, False)
+        self.assertGreaterEqual(rejected.exception.retry_after, 1)
+
+        order = []
+        for _ in range(6):
+            scheduler.release(False)
+            granted = next(waiter for waiter in bronze + gold if waiter.event.is_set() and waiter not in order)
+            order.append(granted)
+        self.assertEqual(order, gold + bronze)
+        scheduler.release(False)
+        self.assertEqual(scheduler.stats(), {'running': 0, 'running_heavy': 0, 'queued': 0})
+
+        # Backups fill the heavy slot; a quick command still gets in immediately
+        scheduler = HostScheduler('testhost', max_concurrent=2, max_heavy=1, max_queued=100, max_queued_per_tenant=10)
+        scheduler.acquire('bronze', 1, 20, True, timeout=0)
+        backup = scheduler._enqueue('bronze', 1, 20, True)
+        self.assertIsNone(scheduler._enqueue('gold', 4, 1, False))
+        with self.assertRaises(HypervisorBusy):
+            scheduler.acquire('gold', 4, 20, True, timeout=0.01)
+        scheduler.release(True)
+        self.assertTrue(backup.event.is_set())
+
+    @override_settings(HYPERVISOR_MAX_HEAVY_COMMANDS=1, HYPERVISOR_QUEUE_TIMEOUT=0.2)
+    def test_heavy_commands_are_capped_host_wide(self):
+        """
+        Test the host-wide cap of heavy hypervisor commands.
+        Should reject a heavy command while other workers hold every heavy slot of the host,
+        still admit quick commands, and admit heavy ones again once a slot is free.
+        """
+        host = 'slots-host'
+        cache.delete_many([HEAVY_SLOT_KEY.format(host, index) for index in range(2)])
+        other_worker = get_host_slots(host).try_acquire()
+        self.assertIsNotNone(other_worker)
+
+        with self.assertRaises(HypervisorBusy):
+            with admit(host, 'vboxmanage snapshot a take a'):
+                pass
+        with admit(host, 'vboxmanage showvminfo a'):
+            pass
+        self.assertEqual(get_scheduler(host).stats(), {'running': 0, 'running_heavy': 0, 'queued': 0})
+
+        get_host_slots(host).release(other_worker)
+        with admit(host, 'vboxmanage snapshot a take a'):
+            self.assertIsNone(get_host_slots(host).try_acquire())
+        slot = get_host_slots(host).try_acquire()
+        self.assertIsNotNone(slot)
+        get_host_slots(host).release(slot)
+
+    @patch('vm_management.views.run_vboxmanage_command')
+    def test_hypervisor_busy_returns_503(self, mock_run_command):
+        """
+        Test a hypervisor command rejected by admission control.
+        Should answer 503 with a Retry-After hint, with the command attributed to the user's plan.
+        """
+        tenants = []
+        def reject(*args):
+            tenants.append(get_current_tenant())
+            raise HypervisorBusy('127.0.0.1', 7)
+        mock_run_command.side_effect = reject
+        vm = VM.objects.create(name='busyvm', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+
+        response = self.client.get(reverse('start_vm', args=[vm.id]))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertEqual(tenants, [(self.user.id, 1)])
+        vm.refresh_from_db()
+        self.assertEqual(vm.status, 'stopped')
+
+class OutboundEmailQueueTests(TestCase):
+    def setUp(self):
+        """
+        Start a local SMTP stand-in (aiosmtpd) that records every message it receives.
+        """
+        try:
+            from aiosmtpd.controller import Controller
+        except ImportError:
+            self.skipTest('aiosmtpd is not installed')
+
+        class RecordingHandler:
+            def __init__(self):
+                self.messages = []
+
+            async def handle_DATA(self, server, session, envelope):
+                self.messages.append(envelope)
+                return '250 OK'
+
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.smtp_port = sock.getsockname()[1]
+
+        self.handler = RecordingHandler()
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=self.smtp_port)
+        self.controller.start()
+        self.addCleanup(self.controller.stop)
+
+        self.user = CustomUser.objects.create_user(username='owner', password='12345', email='owner@example.com')
+        self.new_user = CustomUser.objects.create_user(username='newowner', password='12345', email='new@example.com')
+
+    def test_transfer_emails_queued_after_commit_and_sent_on_one_connection(self):
+        """
+        Test that transfer_vm only queues its notifications once the transaction commits.
+        Should then deliver both emails over a single SMTP connection.
+        """
+        import smtplib
+        from django.test import override_settings
+        from .mail import deliver_pending_emails
+        from .models import OutboundEmail
+        from .views import transfer_vm
+
+        vm = VM.objects.create(name='testvm', user=self.user, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            transfer_vm(vm.id, self.new_user.id, self.user)
+            self.assertFalse(OutboundEmail.objects.exists())
+        self.assertEqual(len(callbacks), 4)  # two emails, and the live events of the VM and its ActionLog
+        self.assertEqual(OutboundEmail.objects.filter(status='pending').count(), 2)
+
+        with override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.smtp_port,
+            EMAIL_USE_TLS=False, EMAIL_HOST_USER='noreply@example.com', EMAIL_HOST_PASSWORD='',
+        ), patch.object(smtplib.SMTP, 'connect', autospec=True, side_effect=smtplib.SMTP.connect) as mock_connect:
+            sent, failed = deliver_pending_emails()
+
+        self.assertEqual((sent, failed), (2, 0))
+        self.assertEqual(mock_connect.call_count, 1)
+        self.assertEqual(sorted(envelope.rcpt_tos[0] for envelope in self.handler.messages), ['new@example.com', 'owner@example.com'])
+        self.assertEqual(OutboundEmail.objects.filter(status='sent').count(), 2)
+
+    def test_failed_delivery_is_retried_with_backoff(self):
+        """
+        Test that an unreachable SMTP server reschedules the email instead of dropping it.
+        """
+        from django.test import override_settings
+        from .mail import deliver_pending_emails, queue_email
+        from .models import OutboundEmail
+
+        with self.captureOnCommitCallbacks(execute=True):
+            queue_email('Subject', 'Body', 'owner@example.com')
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                               EMAIL_HOST='127.0.0.1', EMAIL_PORT=1, EMAIL_USE_TLS=False):
+            self.assertEqual(deliver_pending_emails(), (0, 1))
+
+        email = OutboundEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), ('pending', 1))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+
+    def test_bulk_transfer_sends_one_digest_per_user(self):
+        """
+        Test that bulk_transfer_vms moves every VM and logs each transfer.
+        Should queue exactly one digest email per affected user.
+        """
+        from .models import OutboundEmail
+        from .views import bulk_transfer_vms
+
+        other_owner = CustomUser.objects.create_user(username='other', password='12345', email='other@example.com')
+        admin = CustomUser.objects.create_user(username='admin', password='12345', email='admin@example.com', role='Admin')
+        vms = [
+            VM.objects.create(name=f'vm{i}', user=owner, disk_size=1024, status='stopped', cpu=1, memory=256, price=0)
+            for i, owner in enumerate([self.user, self.user, other_owner])
+        ]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            transferred = bulk_transfer_vms([vm.id for vm in vms], self.new_user.id, admin)
+
+        self.assertEqual(len(transferred), 3)
+        self.assertEqual(VM.objects.filter(user=self.new_user).count(), 3)
+        self.assertEqual(ActionLog.objects.filter(action_type='transfer', user=admin).count(), 3)
+        self.assertEqual(
+            sorted(OutboundEmail.objects.values_list('to_email', flat=True)),
+            ['admin@example.com', 'new@example.com', 'other@example.com', 'owner@example.com'],
+        )
+
+
+class StartupCommandTests(TestCase):
+    def test_prestart_skips_unchanged_steps(self):
+        """
+        Test the prestart command.
+        Should skip migrate when nothing is pending and run collectstatic only when static files changed.
+        """
+        with tempfile.TemporaryDirectory() as static_root, self.settings(STATIC_ROOT=static_root):
+            with patch('vm_management.management.commands.prestart.call_command') as mock_call_command:
+                call_command('prestart', stdout=StringIO())
+                mock_call_command.assert_called_once_with('collectstatic', interactive=False, verbosity=1)
+
+                mock_call_command.reset_mock()
+                out = StringIO()
+                call_command('prestart', stdout=out)
+                mock_call_command.assert_not_called()
+                self.assertIn('Migrations up to date', out.getvalue())
+                self.assertIn('Static files unchanged', out.getvalue())
+
+    def test_profile_startup_reports_imports(self):
+        """
+        Test the profile_startup command.
+        Should report the start-up time and the most expensive imports, without importing paramiko.
+        """
+        out = StringIO()
+        call_command('profile_startup', limit=500, stdout=out)
+        self.assertIn('Worker start-up:', out.getvalue())
+        self.assertIn('django', out.getvalue())
+        self.assertNotIn('paramiko', out.getvalue())
+
+
+class StaticAssetPipelineTests(TestCase):
+    def setUp(self):
+        self.source_dir = tempfile.TemporaryDirectory()
+        self.static_root = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.source_dir.name, 'images'))
+        with open(os.path.join(self.source_dir.name, 'styles.css'), 'w') as f:
+            f.write('.logo { background: url("images/logo.png"); }\n' * 200)
+        with open(os.path.join(self.source_dir.name, 'images', 'logo.png'), 'wb') as f:
+            f.write(os.urandom(2048))
+
+        self.settings_override = self.settings(
+            STATIC_ROOT=self.static_root.name,
+            STATICFILES_DIRS=[self.source_dir.name],
+            STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder'],
+            STATIC_ASSET_BUDGETS={'*.css': 1024, '*.png': 1024},
+        )
+        self.settings_override.enable()
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.source_dir.cleanup()
+        self.static_root.cleanup()
+
+    def test_collectstatic_hashes_and_precompresses(self):
+        """
+        Test the static files storage.
+        Should write hashed, gzip and brotli compressed assets and serve them with immutable caching.
+        """
+        from django.templatetags.static import static
+
+        css_url = static('styles.css')
+        self.assertRegex(css_url, r'^/static/styles\.[0-9a-f]{12}\.css$')
+        css_path = os.path.join(self.static_root.name, css_url[len('/static/'):])
+        self.assertTrue(os.path.exists(css_path + '.gz'))
+        self.assertTrue(os.path.exists(css_path + '.br'))
+        with open(css_path) as f:
+            self.assertIn(static('images/logo.png').rsplit('/', 1)[1], f.read())
+
+        response = Client().get(css_url, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_static_budget(self):
+        """
+        Test the static_budget command.
+        Should measure the compressed size and fail in strict mode only for assets over budget.
+        """
+        out = StringIO()
+        call_command('static_budget', stdout=out)
+        self.assertIn('2 assets', out.getvalue())
+        self.assertIn('images/logo.png', out.getvalue())  # incompressible, over its 1 KiB budget
+        self.assertNotIn('styles.css', out.getvalue())  # 9 KiB raw, well under 1 KiB compressed
+
+        with self.assertRaises(CommandError):
+            call_command('static_budget', strict=True, stdout=StringIO())
+
+
+@override_settings(HYPERVISOR_BACKEND='fake', HYPERVISOR_FAKE_LATENCY_SCALE=0)
+class LoadTestTests(LiveServerTestCase):
+    def test_tenants_run_scenarios_against_live_server(self):
+        """
+        Test the load generator against a live server with the fake hypervisor.
+        Should log the tenants in, run every action of the mix without errors and summarize them per action.
+        """
+        usernames = create_tenants(2)
+        mix = parse_mix('vm_list=1,create_vm=2,start_vm=1,vm_details=1')
+        samples = run_load(self.live_server_url, usernames, duration=2, mix=mix, think_time=0)
+
+        self.assertTrue(samples)
+        self.assertEqual([sample for sample in samples if sample.error], [])
+        self.assertTrue(VM.objects.filter(user__username__in=usernames).exists())
+
+        summary = summarize(samples, 2)
+        self.assertEqual(summary['login']['count'], 2)
+        self.assertIn('create_vm', summary)
+        self.assertEqual(summary['all']['count'], len(samples))
+        self.assertLessEqual(summary['all']['p50'], summary['all']['p99'])
+
+        with self.assertRaises(ValueError):
+            parse_mix('reboot_everything=1')
@@ -1,16 +1,22 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+# Under an ASGI server the hypervisor-bound pages are served by their async versions
+hypervisor_views = async_views if settings.ASYNC_HYPERVISOR_VIEWS else views
 
 urlpatterns = [
     path('', views.vm_list, name='vm_list'),
-    path('create/', views.create_vm, name='create_vm'),
+    path('events/', async_views.vm_events, name='vm_events'),
+    path('create/', hypervisor_views.create_vm, name='create_vm'),
     path('delete/<int:vm_id>/', views.delete_vm, name='delete_vm'),
-    path('backup/<int:vm_id>/', views.backup_vm, name='backup_vm'),
-    path('start/<int:vm_id>/', views.start_vm, name='start_vm'),
-    path('stop/<int:vm_id>/', views.stop_vm, name='stop_vm'),
-    path('details/<int:vm_id>/', views.vm_details, name='vm_details'),
+    path('backup/<int:vm_id>/', hypervisor_views.backup_vm, name='backup_vm'),
+    path('start/<int:vm_id>/', hypervisor_views.start_vm, name='start_vm'),
+    path('stop/<int:vm_id>/', hypervisor_views.stop_vm, name='stop_vm'),
+    path('details/<int:vm_id>/', hypervisor_views.vm_details, name='vm_details'),
     path('configure/<int:vm_id>/', views.configure_vm, name='configure_vm'),
     path('transfer_vm/<int:vm_id>/', views.transfer_vm_view, name='transfer_vm'),
+    path('transfer_vms/', views.bulk_transfer_vm_view, name='bulk_transfer_vms'),
     path('payment/', views.payment_page, name='payment_page'),
     path('payments/admin/', views.get_all_payments, name='admin_payments'),
     path('payments/user/', views.get_user_payments, name='user_payments'),
@@ -31,8 +37,24 @@ urlpatterns = [
     # Action logs
     path('logs/', views.get_logs, name='logs'),
 
+    # Request profiles (admins add ?_profile=1 to any request)
+    path('profiles/', views.request_profiles, name='request_profiles'),
+    path('profiles/<int:profile_id>/', views.request_profile_detail, name='request_profile_detail'),
+    path('profiles/<int:profile_id>/download/', views.download_request_profile, name='download_request_profile'),
+
     # Services page
     path('services/', views.services_pricing, name='services'),
+
+    # Async versions of the hypervisor-bound views, always available
+    path('async/create/', async_views.create_vm, name='create_vm_async'),
+    path('async/backup/<int:vm_id>/', async_views.backup_vm, name='backup_vm_async'),
+    path('async/start/<int:vm_id>/', async_views.start_vm, name='start_vm_async'),
+    path('async/stop/<int:vm_id>/', async_views.stop_vm, name='stop_vm_async'),
+    path('async/details/<int:vm_id>/', async_views.vm_details, name='vm_details_async'),
+
+    # API
+    path('api/vms/', views.vm_list_api, name='vm_list_api'),
+    path('api/vms/<int:vm_id>/metrics/', views.vm_metrics_api, name='vm_metrics_api'),
 ]
 
 
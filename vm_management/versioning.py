@@ -0,0 +1,121 @@
+import hashlib
+import time
+from datetime import datetime, timezone as dt_timezone
+from functools import partial, wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+USER_VERSION_KEY = 'vm_management:user_version:{}'
+
+
+def _new_stamp():
+    """
+    Return a new version stamp (nanoseconds since the epoch).
+    """
+    return time.time_ns()
+
+
+def get_user_version(user_id):
+    """
+    Get the current version stamp for a user's VM and billing data.
+
+    The stamp lives in the shared cache so every worker sees the same value.
+    If the cache has no stamp yet (first request or eviction) a fresh one is
+    stored, which only ever causes a cache miss on the client, never a stale hit.
+
+    Parameters:
+        user_id (int): ID of the user.
+
+    Returns:
+        int: The version stamp.
+    """
+    key = USER_VERSION_KEY.format(user_id)
+    stamp = cache.get(key)
+    if stamp is None:
+        cache.add(key, _new_stamp(), None)
+        stamp = cache.get(key) or _new_stamp()
+    return stamp
+
+
+def bump_user_version(*user_ids):
+    """
+    Invalidate the cached pages of one or more users.
+
+    Called from model signals whenever a VM, Payment, Backup or Subscription is written.
+    """
+    stamp = _new_stamp()
+    cache.set_many({USER_VERSION_KEY.format(user_id): stamp for user_id in set(user_ids) if user_id}, None)
+
+
+def get_refresh_period(refresh_interval):
+    return int(time.time() // refresh_interval) if refresh_interval else 0
+
+
+def user_etag(request, *args, refresh_interval=None, **kwargs):
+    """
+    Build the ETag of a per-user page from the user's version stamp.
+
+    The path, role and current date are mixed in so that different pages,
+    role changes and date-dependent fields (e.g. overdue payments) never share a tag.
+    Pages that also show data refreshed in the background change tag every refresh_interval seconds.
+    """
+    user = request.user
+    raw = (
+        f'{user.pk}:{get_user_version(user.pk)}:{user.role}:{request.get_full_path()}:{timezone.localdate()}'
+        f':{get_refresh_period(refresh_interval)}'
+    )
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def user_last_modified(request, *args, refresh_interval=None, **kwargs):
+    """
+    Return the time the user's data last changed, for the Last-Modified header.
+    """
+    stamp = get_user_version(request.user.pk) / 1e9
+    if refresh_interval:
+        stamp = max(stamp, get_refresh_period(refresh_interval) * refresh_interval)
+    return datetime.fromtimestamp(stamp, tz=dt_timezone.utc)
+
+
+def user_versioned(view_func=None, *, refresh_interval=None):
+    """
+    Decorator for pages that only depend on the logged-in user's VMs, payments,
+    backups and subscription.
+
+    Emits ETag/Last-Modified and answers conditional GETs with 304 Not Modified
+    before the view (and therefore the ORM or the hypervisor) is touched.
+    Must be applied after the login check so request.user is authenticated.
+
+    Async views are wrapped as async views; the async admin_or_standard_user_required
+    loads request.user for them.
+
+    Use @user_versioned(refresh_interval=seconds) for pages that also show data
+    updated in the background (e.g. VM metrics), so they are revalidated at most that often.
+    """
+    if view_func is None:
+        return partial(user_versioned, refresh_interval=refresh_interval)
+
+    conditional_view = condition(
+        etag_func=partial(user_etag, refresh_interval=refresh_interval),
+        last_modified_func=partial(user_last_modified, refresh_interval=refresh_interval),
+    )(view_func)
+
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def _wrapped_async_view(request, *args, **kwargs):
+            response = await conditional_view(request, *args, **kwargs)
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return _wrapped_async_view
+
+    @wraps(view_func)
+    def _wrapped_view(request, *args, **kwargs):
+        response = conditional_view(request, *args, **kwargs)
+        # Pages are per user: never share them between users and always revalidate
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+    return _wrapped_view
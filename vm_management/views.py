@@ -1,46 +1,44 @@
+from collections import defaultdict
 from datetime import datetime, timedelta
 from django.utils import timezone
 from functools import wraps
-import os
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, render, redirect
 from django.contrib.auth.decorators import login_required
-from .models import VM, ActionLog, Payment, Subscription, RatePlan, Backup
-import subprocess
+from .models import VM, ActionLog, Payment, Subscription, RatePlan, Backup, RequestProfile
 
 import logging
 
-from django.core.mail import send_mail
 from django.db import transaction
 
 from accounts.models import CustomUser, UserRole
 
 from django.contrib import messages
 
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from django.conf import settings
 
-import paramiko
+from .hypervisor import run_vboxmanage_command, host_username, host_password, host_ip
 
 from accounts.views import admin_or_standard_user_required, admin_required
-
-from dotenv import load_dotenv, find_dotenv
-
-# Load environment definition file
-ENV_FILE = find_dotenv()
-if ENV_FILE:
-    load_dotenv(ENV_FILE)
+from accounts.permissions import HasActiveSubscription, IsAdminOrStandardUser
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from .versioning import bump_user_version, user_versioned
+from .fragment_cache import bump_object_versions, prefetch_object_versions
+from .mail import queue_email
+from .events import get_action_events, get_vm_events, publish, publish_job
+from .locks import VMLock, VMLockTimeout, transition_status
+from .admission import get_plan_weight, reset_current_tenant, set_current_tenant
+from .metrics import render_prometheus
+from .profiling import MAX_PROFILES
+from .warm_pool import claim
+from .backup_store import get_snapshot_uuid
+from .vm_metrics import COLLECT_INTERVAL, TIER_NAMES, get_series, get_summary
+from django.utils.crypto import constant_time_compare
 
 logger = logging.getLogger(__name__)
 
-host_username = os.environ.get('HOST_USER')
-host_home = os.environ.get('HOST_HOME')
-host_password = os.environ.get('HOST_PASSWORD')
-home_dir = os.getenv('HOST_HOME', '/root')  # Default to '/root' if HOME is not set
-host_ip = os.getenv('HOST_IP')
-
 def services_pricing(request):
     """
     Page with pricing and services information.
@@ -53,54 +51,54 @@ def subscription_required(view_func):
     """
     Decorator to check if the user has an active subscription.
     If not, they are redirected to the 'services' page.
+    The view's hypervisor commands are attributed to the user's plan.
     """
     @wraps(view_func)
     def _wrapped_view(request, *args, **kwargs):
         try:
-            subscription = Subscription.objects.get(user=request.user)
+            subscription = Subscription.objects.select_related('rate_plan').get(user=request.user)
         except Subscription.DoesNotExist:
             return redirect('services')
 
         if not subscription.active:
             return redirect('user_payments')
 
-        return view_func(request, *args, **kwargs)
+        # Hypervisor commands of the request are queued fairly by tenant and plan (see admission.py)
+        token = set_current_tenant(request.user.id, get_plan_weight(subscription.rate_plan))
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            reset_current_tenant(token)
     return _wrapped_view
 
-def run_vboxmanage_command(host, username, password, command):
+def vm_locked(operation):
     """
-    Run a vboxmanage command on the remote host.
-
-    Parameters:
-        host (str): IP address of the host running VirtualBox.
-        username (str): Username to log in to the host.
-        password (str): Password to log in to the host.
-        command (str): vboxmanage command to run, e.g. "startvm myvm".
-
-    Returns:
-        str: Output of the vboxmanage command.
+    Decorator running a view that operates on one VM (its vm_id argument) under that VM's lock.
+    If another operation holds the lock longer than VM_LOCK_TIMEOUT, the user is sent back to the VM list.
     """
-    print(f"HOST: {host}, USERNAME: {username}, PASSWORD: {password}, COMMAND: {command}")
-    print(f"HOST: {os.getenv('HOST_IP')}, USERNAME: {os.getenv('HOST_USER')}, PASSWORD: {os.getenv('PASSWORD')},")
-    # port = 2112
-    port = os.getenv('HOST_PORT')
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-    # Connect using the password
-    ssh.connect(host, port, username=username, password=password)
-
-    stdin, stdout, stderr = ssh.exec_command(command)
-    output = stdout.read().decode()
-    error = stderr.read().decode()
-
-    ssh.close()
-    
-    return output
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped_view(request, vm_id, *args, **kwargs):
+            lock = VMLock(vm_id, operation)
+            try:
+                lock.acquire(settings.VM_LOCK_TIMEOUT)
+            except VMLockTimeout:
+                messages.error(request, "Another operation on this VM is still in progress. Please try again shortly.")
+                return redirect('vm_list')
+            try:
+                return view_func(request, vm_id, *args, **kwargs)
+            finally:
+                lock.release()
+        return _wrapped_view
+    return decorator
 
 def send_smtp_email(subject, body, to_email):
     """
-    Send an email via SMTP.
+    Queue an email for delivery via SMTP.
+
+    The message is stored once the current transaction commits and delivered
+    by the send_queued_emails worker over a shared SMTP connection, so callers
+    never wait on (or hold database locks across) SMTP round-trips.
 
     Parameters:
         subject (str): Subject line of the email.
@@ -110,23 +108,10 @@ def send_smtp_email(subject, body, to_email):
     Returns:
         None
     """
-    msg = MIMEMultipart()
-    msg['From'] = settings.EMAIL_HOST_USER
-    msg['To'] = to_email
-    msg['Subject'] = subject
-
-    msg.attach(MIMEText(body, 'plain'))
-
-    try:
-        with smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT) as server:
-            if settings.EMAIL_USE_TLS:
-                server.starttls()
-            server.login(settings.EMAIL_HOST_USER, settings.EMAIL_HOST_PASSWORD)
-            server.sendmail(settings.EMAIL_HOST_USER, to_email, msg.as_string())
-    except Exception as e:
-        print(f"An error occurred while sending email: {e}")
+    queue_email(subject, body, to_email)
 
 @admin_or_standard_user_required
+@user_versioned
 def vm_list(request):
     # Check if the user is an admin
     """
@@ -145,12 +130,48 @@ def vm_list(request):
     #     # Fetch only VMs belonging to the logged-in user for standard users
     #     user_vms = VM.objects.filter(user=request.user)
     
-    user_vms = VM.objects.filter(user=request.user)
+    user_vms = prefetch_object_versions(VM.objects.filter(user=request.user))
 
     # Pass the VMs to the template
     return render(request, 'vm_management/vm_list_clean.html', {'vms': user_vms})
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminOrStandardUser, HasActiveSubscription])
+def vm_list_api(request):
+    """
+    List the VMs of the authenticated API user.
+
+    Authorization comes from the JWT claims (role, subscription status), so the
+    only query is the VM lookup itself.
+
+    Returns:
+        Response: JSON with the user's VMs.
+    """
+    vms = VM.objects.filter(user_id=request.user.id).values(
+        'id', 'name', 'status', 'disk_size', 'cpu', 'memory', 'price', 'created_at'
+    )
+    return Response({'vms': list(vms)})
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminOrStandardUser, HasActiveSubscription])
+def vm_metrics_api(request, vm_id):
+    """
+    Time series of a VM's resource metrics, read from the collector's buffers.
+
+    The resolution query parameter picks the tier: raw (last hour), 1m (last day) or 1h (last 30 days).
+
+    Returns:
+        Response: JSON with the resolution, step in seconds, field names and [timestamp, values...] points.
+    """
+    resolution = request.query_params.get('resolution', 'raw')
+    if resolution not in TIER_NAMES:
+        return Response({'detail': f"resolution must be one of {', '.join(TIER_NAMES)}"}, status=400)
+    if not VM.objects.filter(id=vm_id, user_id=request.user.id).exists():
+        return Response({'detail': 'Not found.'}, status=404)
+    return Response(get_series(vm_id, resolution))
+
 @admin_or_standard_user_required
 @subscription_required
 def create_vm(request):
@@ -162,7 +183,8 @@ def create_vm(request):
 
     Otherwise, the user is prompted to enter the name, disk size, CPU count, and memory size of the VM.
     The price of the VM is calculated based on the disk size and a payment entry is created in the database.
-    The VM is created with VBoxManage and the details are saved in the database.
+    The VM is taken from the warm pool if it has one of the requested shape (see warm_pool.py),
+    otherwise created with VBoxManage, and the details are saved in the database.
 
     Returns:
         HttpResponse: The rendered template with a form to create a new VM or an error message.
@@ -221,13 +243,20 @@ def create_vm(request):
         if not host_username or not host_ip or not host_password:
             raise ValueError("Environment variables for host connection are not set.")
 
-        create_vm_cmd = f'vboxmanage createvm --name {name} --register'
-        modify_vm_cmd = f'vboxmanage modifyvm {name} --memory {memory} --cpus {cpu} --vram 16 --nic1 nat'
-        create_hd_cmd = f'vboxmanage createhd --filename ~/VirtualBox\\ VMs/{name}/{name}.vdi --size {disk_size}'
-
-        run_vboxmanage_command(host_ip, host_username, host_password, create_vm_cmd)
-        run_vboxmanage_command(host_ip, host_username, host_password, modify_vm_cmd)
-        run_vboxmanage_command(host_ip, host_username, host_password, create_hd_cmd)
+        # Hand out a pre-provisioned VM of this shape if the warm pool has one, else build it
+        if not claim(name, cpu, memory, disk_size):
+            create_vm_cmd = f'vboxmanage createvm --name {name} --register'
+            modify_vm_cmd = f'vboxmanage modifyvm {name} --memory {memory} --cpus {cpu} --vram 16 --nic1 nat'
+            create_hd_cmd = f'vboxmanage createhd --filename ~/VirtualBox\\ VMs/{name}/{name}.vdi --size {disk_size}'
+            # Attached, so the VM boots from it and its snapshots cover it (see backup_store.py)
+            add_controller_cmd = f'vboxmanage storagectl {name} --name SATA --add sata --controller IntelAhci'
+            attach_hd_cmd = f'vboxmanage storageattach {name} --storagectl SATA --port 0 --device 0 --type hdd --medium ~/VirtualBox\\ VMs/{name}/{name}.vdi'
+
+            run_vboxmanage_command(host_ip, host_username, host_password, create_vm_cmd)
+            run_vboxmanage_command(host_ip, host_username, host_password, modify_vm_cmd)
+            run_vboxmanage_command(host_ip, host_username, host_password, create_hd_cmd)
+            run_vboxmanage_command(host_ip, host_username, host_password, add_controller_cmd)
+            run_vboxmanage_command(host_ip, host_username, host_password, attach_hd_cmd)
 
         # Save VM in database
         vm = VM.objects.create(name=name, user=user, disk_size=disk_size, status='stopped', cpu=cpu, memory=memory, price=price)
@@ -239,6 +268,7 @@ def create_vm(request):
 
 @admin_or_standard_user_required
 @subscription_required
+@vm_locked('configure')
 def configure_vm(request, vm_id):
     """
     Configure an existing VM.
@@ -265,6 +295,7 @@ def configure_vm(request, vm_id):
         # If VM is running, stop it before making modifications
         stop_vm_cmd = f'vboxmanage controlvm {vm.name} poweroff'
         run_vboxmanage_command(host_ip, host_username, host_password, stop_vm_cmd)
+        transition_status(vm, 'stopped', from_statuses=['running'])
 
     if request.method == 'POST':
         # Get the configuration data from the form
@@ -288,7 +319,7 @@ def configure_vm(request, vm_id):
         vm.memory = int(new_memory)
         vm.cpu = int(new_cpu)
         try:
-            vm.save()
+            vm.save(update_fields=['memory', 'cpu'])
             logger.debug(f"After saving: {vm.to_dict()}")
         except Exception as e:
             logger.error(f"Error saving VM: {e}", exc_info=True)
@@ -301,6 +332,7 @@ def configure_vm(request, vm_id):
 
 @admin_or_standard_user_required
 @subscription_required
+@vm_locked('delete')
 def delete_vm(request, vm_id):
     """
     Delete a VM.
@@ -329,6 +361,7 @@ def delete_vm(request, vm_id):
     return redirect('vm_list')
 
 @subscription_required
+@vm_locked('backup')
 def backup_vm(request, vm_id):
     """
     Create a backup of a VM.
@@ -363,12 +396,14 @@ def backup_vm(request, vm_id):
     if not host_username or not host_ip or not host_password:
         raise ValueError("HOST_USER, HOST_IP, or HOST_PASSWORD environment variables are not set.")
 
+    publish_job(vm.user_id, vm, 'backup')
+
     # Use vboxmanage to take a snapshot (backup)
     snapshot_cmd = f'vboxmanage snapshot {vm.name} take {vm.name}'
-    run_vboxmanage_command(host_ip, host_username, host_password, snapshot_cmd)
+    output = run_vboxmanage_command(host_ip, host_username, host_password, snapshot_cmd)
 
-    # Create a Backup record in the database
-    Backup.objects.create(vm=vm, user=request.user)
+    # Create a Backup record in the database; export_backups copies its disk into the backup store
+    Backup.objects.create(vm=vm, user=request.user, snapshot_uuid=get_snapshot_uuid(output))
 
     # Log the action
     ActionLog.objects.create(action_type='backup', vm=vm, user=request.user)
@@ -378,6 +413,7 @@ def backup_vm(request, vm_id):
 
 @admin_or_standard_user_required
 @subscription_required
+@vm_locked('start')
 def start_vm(request, vm_id):
     """
     Start a VM.
@@ -394,11 +430,11 @@ def start_vm(request, vm_id):
         raise ValueError("HOST_USER or HOST_PASSWORD environment variables are not set.")
 
     if vm.user == request.user:  # Ensure user owns the VM
+        publish_job(vm.user_id, vm, 'start')
         start_vm_cmd = f'vboxmanage startvm {vm.name} --type headless'
         run_vboxmanage_command(host_ip, host_username, host_password, start_vm_cmd)
 
-        vm.status = 'running'
-        vm.save()
+        transition_status(vm, 'running', from_statuses=['stopped'])
 
         ActionLog.objects.create(action_type='start', vm=vm, user=request.user)
     
@@ -406,6 +442,7 @@ def start_vm(request, vm_id):
 
 @admin_or_standard_user_required
 @subscription_required
+@vm_locked('stop')
 def stop_vm(request, vm_id):
     """
     Stop a VM.
@@ -422,17 +459,18 @@ def stop_vm(request, vm_id):
         raise ValueError("HOST_USER or HOST_PASSWORD environment variables are not set.")
 
     if vm.user == request.user:  # Ensure user owns the VM
+        publish_job(vm.user_id, vm, 'stop')
         stop_vm_cmd = f'vboxmanage controlvm {vm.name} acpipowerbutton'
         run_vboxmanage_command(host_ip, host_username, host_password, stop_vm_cmd)
 
-        vm.status = 'stopped'
-        vm.save()
+        transition_status(vm, 'stopped', from_statuses=['running'])
 
         ActionLog.objects.create(action_type='stop', vm=vm, user=request.user)
     
     return redirect('vm_list')
 
 @admin_or_standard_user_required
+@user_versioned(refresh_interval=COLLECT_INTERVAL)
 @subscription_required
 def vm_details(request, vm_id):
     """
@@ -476,6 +514,7 @@ def vm_details(request, vm_id):
         return render(request, 'vm_management/vm_details_clean.html', {
             'vm': vm,
             'vm_details': vm_details_dict,
+            'resource_metrics': get_summary(vm.id),
         })
     
     return redirect('vm_list')
@@ -528,6 +567,75 @@ def transfer_vm(vm_id, new_user_id, original_user):
     except Exception as e:
         print(f"An error occurred: {e}")
 
+def bulk_transfer_vms(vm_ids, new_user_id, original_user):
+    """
+    Transfer many VMs to a new user in a single transaction.
+
+    VMs are moved with one bulk_update and logged with one bulk_create instead
+    of a save and an insert per VM. Each affected user (the new owner, every
+    previous owner and the initiator) gets a single digest email, queued for
+    delivery once the transaction commits.
+
+    Args:
+        vm_ids (iterable): The IDs of the VMs to transfer
+        new_user_id (int): The ID of the user to transfer the VMs to
+        original_user (CustomUser): The user who initiated the transfer
+
+    Returns:
+        list: The transferred VMs (VMs already owned by the new user are skipped)
+
+    Raises:
+        CustomUser.DoesNotExist: If the new user does not exist
+    """
+    with transaction.atomic():
+        new_user = CustomUser.objects.get(id=new_user_id)
+        vms = list(
+            VM.objects.select_for_update(of=('self',)).select_related('user')
+            .filter(id__in=vm_ids).exclude(user=new_user).order_by('name')
+        )
+
+        previous_owners = defaultdict(list)
+        for vm in vms:
+            previous_owners[vm.user].append(vm.name)
+            vm.user = new_user
+
+        VM.objects.bulk_update(vms, ['user'], batch_size=500)
+        logs = ActionLog.objects.bulk_create(
+            [ActionLog(action_type='transfer', vm=vm, user=original_user) for vm in vms], batch_size=500
+        )
+
+        # Bulk queries skip model signals: invalidate cached pages and rows once for everyone affected
+        bump_user_version(new_user.id, *[owner.id for owner in previous_owners])
+        bump_object_versions(vms)
+        publish(
+            [event for vm in vms for event in get_vm_events(vm)]
+            + [event for log in logs for event in get_action_events(log)]
+        )
+
+        if not vms:
+            return vms
+
+        # One digest per affected user
+        send_smtp_email(
+            'VM Transfer Notification',
+            f'The following {len(vms)} VM(s) have been transferred to you:\n' + '\n'.join(f'- {vm.name}' for vm in vms),
+            new_user.email
+        )
+        for owner, names in previous_owners.items():
+            send_smtp_email(
+                'VM Transfer Notification',
+                f'The following {len(names)} VM(s) have been transferred to {new_user.username}:\n' + '\n'.join(f'- {name}' for name in names),
+                owner.email
+            )
+        if original_user not in previous_owners and original_user != new_user:
+            send_smtp_email(
+                'VM Transfer Notification',
+                f'You have transferred {len(vms)} VM(s) to {new_user.username}:\n' + '\n'.join(f'- {vm.name}' for vm in vms),
+                original_user.email
+            )
+
+    return vms
+
 @admin_required
 def transfer_vm_view(request, vm_id):
     """
@@ -559,6 +667,37 @@ def transfer_vm_view(request, vm_id):
     users = CustomUser.objects.exclude(id=vm.user.id)  # Exclude the current owner
     return render(request, 'vm_management/transfer_vm_clean.html', {'vm': vm, 'users': users})
 
+@admin_required
+def bulk_transfer_vm_view(request):
+    """
+    Handle bulk VM transfer requests.
+
+    This view is accessible only to administrators.
+    If the request is a GET, it renders a form to pick VMs (individually or all VMs of a user) and the new owner.
+    If the request is a POST, it calls the bulk_transfer_vms function with the selected VMs and user.
+    If the transfer is successful, it redirects to the VM list page with a success message.
+    If the selected user ID is invalid, it renders an error page.
+    """
+    if request.method == 'POST':
+        new_user_id = request.POST.get('new_user_id')
+
+        # Validate the new user ID
+        if not CustomUser.objects.filter(id=new_user_id).exists():
+            return render(request, 'accounts/access_denied.html', {'error': 'Invalid user selected.'})
+
+        vm_ids = set(request.POST.getlist('vm_ids'))
+        from_user_id = request.POST.get('from_user_id')
+        if from_user_id:
+            vm_ids.update(VM.objects.filter(user_id=from_user_id).values_list('id', flat=True))
+
+        vms = bulk_transfer_vms(vm_ids, new_user_id, request.user)
+        messages.success(request, f'{len(vms)} VM(s) transferred successfully.')
+        return redirect('vm_list')
+
+    vms = VM.objects.select_related('user').order_by('user__username', 'name')
+    users = CustomUser.objects.order_by('username')
+    return render(request, 'vm_management/bulk_transfer_vm_clean.html', {'vms': vms, 'users': users})
+
 @login_required
 @admin_or_standard_user_required
 def payment_page(request):
@@ -621,6 +760,7 @@ def get_all_payments(request):
     return render(request, 'vm_management/admin_payments.html', context)
 
 @login_required
+@user_versioned
 def get_user_payments(request):
     # Get the logged-in user's payment records
     """
@@ -629,7 +769,7 @@ def get_user_payments(request):
     This view is accessible only to authenticated users.
     It renders a template with a list of the user's payment records.
     """
-    user_payments = Payment.objects.filter(user=request.user)
+    user_payments = prefetch_object_versions(Payment.objects.filter(user=request.user))
 
     # Pass the user's payment records to the template or as JSON
     context = {
@@ -734,15 +874,18 @@ def get_logs(request):
     Retrieve all action logs in descending order of timestamp.
 
     This view is accessible only to administrators.
-    It renders a template with a list of all action logs, each represented as a dictionary.
+    It renders a template with a list of all action logs, each row cached as a fragment.
     """
     
-    logs = ActionLog.objects.all().order_by('-timestamp')
+    logs = list(ActionLog.objects.select_related('vm', 'user').order_by('-timestamp'))
 
-    logs_dicts = [log.to_dict() for log in logs]
+    # Rows are cached per log, VM and user version, so load all versions at once
+    prefetch_object_versions(logs)
+    prefetch_object_versions([log.vm for log in logs])
+    prefetch_object_versions([log.user for log in logs])
 
     # Render the logs to the template
-    return render(request, 'vm_management/get_logs_clean.html', {'logs': logs_dicts})
+    return render(request, 'vm_management/get_logs_clean.html', {'logs': logs})
 
 @admin_required
 def deactivate_subscription(request, user_id):
@@ -945,4 +1088,51 @@ def mark_payments_completed(request, payment_id):
 
     return redirect(previous_url)
 
-    # return JsonResponse({"message": f"Payment {payment_id} marked as completed."})
\ No newline at end of file
+    # return JsonResponse({"message": f"Payment {payment_id} marked as completed."})
+
+@admin_required
+def request_profiles(request):
+    """
+    List the stored request profiles, newest first.
+
+    This view is accessible only to administrators.
+    """
+    profiles = RequestProfile.objects.select_related('user').defer('stats', 'summary', 'queries').order_by('-created_at')[:MAX_PROFILES]
+    return render(request, 'vm_management/request_profiles_clean.html', {'profiles': profiles})
+
+@admin_required
+def request_profile_detail(request, profile_id):
+    """
+    Show the slowest functions and the SQL of a stored request profile.
+
+    This view is accessible only to administrators.
+    """
+    profile = get_object_or_404(RequestProfile.objects.defer('stats'), id=profile_id)
+    return render(request, 'vm_management/request_profile_detail_clean.html', {'profile': profile})
+
+@admin_required
+def download_request_profile(request, profile_id):
+    """
+    Download the cProfile stats of a stored request profile.
+
+    The file can be opened with pstats.Stats() or snakeviz.
+    """
+    profile = get_object_or_404(RequestProfile.objects.only('stats'), id=profile_id)
+    response = HttpResponse(bytes(profile.stats), content_type='application/octet-stream')
+    response['Content-Disposition'] = f'attachment; filename="request-{profile.id}.prof"'
+    return response
+
+def metrics(request):
+    """
+    Request metrics in the Prometheus text format.
+
+    Histograms of request, database, hypervisor and template time per URL
+    name, aggregated across workers. The scraper must send METRICS_TOKEN as
+    a bearer token; without a token configured the endpoint is closed, since
+    it names the hypervisor hosts and shows the traffic of every view.
+    """
+    token = settings.METRICS_TOKEN
+    if not token or not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return HttpResponse(status=403)
+
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
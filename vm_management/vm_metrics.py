@@ -0,0 +1,263 @@
+"""
+Guest resource metrics of the VMs.
+
+The collect_vm_metrics command asks the host for the metrics of every VM in
+a single `vboxmanage metrics query` every COLLECT_INTERVAL seconds and
+folds the samples into per-VM ring buffers kept in the shared cache. Each
+VM has three fixed-size tiers: raw samples for the last hour, one-minute
+means for a day and hourly means for a month, so its storage stays around
+70 KB however long the collector runs. vm_details and the API only read
+these buffers; they never call the hypervisor.
+"""
+import time
+from array import array
+
+from django.core.cache import cache
+
+from .agent_client import get_agent
+from .hypervisor import run_vboxmanage_command, host_username, host_password, host_ip
+from .models import VM
+
+BUFFER_KEY = 'vm_management:vm_metrics:{}'
+
+COLLECT_INTERVAL = 10
+
+# (name, seconds per slot, slots)
+TIERS = (
+    ('raw', COLLECT_INTERVAL, 360),  # one hour
+    ('1m', 60, 1440),  # one day
+    ('1h', 3600, 720),  # 30 days
+)
+TIER_NAMES = [name for name, _, _ in TIERS]
+
+# {field: (label, unit)}
+FIELDS = {
+    'cpu': ('CPU', '%'),
+    'ram_used': ('RAM used', 'MB'),
+    'net_rx': ('Network in', 'B/s'),
+    'net_tx': ('Network out', 'B/s'),
+}
+
+# VirtualBox metrics sampled by the collector. Guest/* metrics need the Guest Additions;
+# VirtualBox reports disk usage for the host only, not per VM.
+VBOX_METRICS = (
+    'Guest/CPU/Load/User',
+    'Guest/CPU/Load/Kernel',
+    'Guest/RAM/Usage/Total',
+    'Guest/RAM/Usage/Free',
+    'Net/Rate/Rx',
+    'Net/Rate/Tx',
+)
+SETUP_COMMAND = 'vboxmanage metrics setup --period {} --samples 1 "*" Guest/CPU/Load,Guest/RAM/Usage,Net/Rate'
+QUERY_COMMAND = f'vboxmanage metrics query "*" {",".join(VBOX_METRICS)}'
+
+
+class RingBuffer:
+    """
+    Fixed number of time slots of step seconds, each holding the mean of
+    every sample that fell in it. A new period overwrites the slot of the
+    period `slots` steps before it.
+
+    Stored in arrays (a few bytes per value) rather than Python objects so
+    the buffer pickles to about 28 bytes per slot.
+    """
+    def __init__(self, step, slots):
+        self.step = step
+        self.slots = slots
+        self.periods = array('I', bytes(4 * slots))  # period number of each slot, 0 when empty
+        # Counted per field: the Guest/* metrics are missing while the Guest Additions are not running
+        self.counts = {field: array('H', bytes(2 * slots)) for field in FIELDS}
+        self.sums = {field: array('f', bytes(4 * slots)) for field in FIELDS}
+
+    def add(self, timestamp, values):
+        period = int(timestamp // self.step)
+        index = period % self.slots
+        if self.periods[index] != period:
+            self.periods[index] = period
+            for field in FIELDS:
+                self.counts[field][index] = 0
+                self.sums[field][index] = 0
+        for field, value in values.items():
+            if self.counts[field][index] < 0xFFFF:
+                self.counts[field][index] += 1
+                self.sums[field][index] += value
+
+    def points(self, now=None):
+        """
+        Get the slots of the last `slots` periods that have samples, oldest first.
+
+        Returns:
+            list: [(timestamp of the period start, {field: mean or None})]
+        """
+        current = int((now or time.time()) // self.step)
+        points = []
+        for period in range(current - self.slots + 1, current + 1):
+            index = period % self.slots
+            if self.periods[index] != period:
+                continue
+            points.append((period * self.step, {
+                field: self.sums[field][index] / count if (count := self.counts[field][index]) else None
+                for field in FIELDS
+            }))
+        return points
+
+
+class VMMetrics:
+    """
+    Ring buffers of one VM, one per tier; every sample is added to all of them.
+    """
+    def __init__(self):
+        self.tiers = {name: RingBuffer(step, slots) for name, step, slots in TIERS}
+
+    def add(self, timestamp, values):
+        for buffer in self.tiers.values():
+            buffer.add(timestamp, values)
+
+
+def get_buffer_key(vm_id):
+    return BUFFER_KEY.format(vm_id)
+
+
+def get_buffer_timeout():
+    # A deleted VM's buffers expire once its oldest tier would have been overwritten anyway
+    _, step, slots = TIERS[-1]
+    return step * slots
+
+
+def parse_value(value):
+    """
+    Parse the latest of the values vboxmanage reports for a metric, e.g. '12.00%' or '1048576 kB'.
+    """
+    latest = value.split(',')[-1].strip()
+    return float(latest.split()[0].rstrip('%'))
+
+
+def parse_metrics_query(output):
+    """
+    Parse the output of `vboxmanage metrics query` into samples.
+
+    Returns:
+        dict: {VM name: {field: value}}
+    """
+    raw = {}
+    for line in output.splitlines():
+        parts = line.split(None, 2)
+        if len(parts) != 3 or parts[1] not in VBOX_METRICS:
+            continue
+        try:
+            raw.setdefault(parts[0], {})[parts[1]] = parse_value(parts[2])
+        except (ValueError, IndexError):
+            continue
+    return get_samples(raw)
+
+
+def get_samples(raw):
+    """
+    Turn the latest VirtualBox metric values of each VM into samples.
+
+    Parameters:
+        raw (dict): {VM name: {VirtualBox metric: value}}, as parsed above or returned by the agent.
+
+    Returns:
+        dict: {VM name: {field: value}}
+    """
+    samples = {}
+    for vm_name, metrics in raw.items():
+        if vm_name == 'host':
+            continue
+        sample = {}
+        if 'Guest/CPU/Load/User' in metrics or 'Guest/CPU/Load/Kernel' in metrics:
+            sample['cpu'] = metrics.get('Guest/CPU/Load/User', 0) + metrics.get('Guest/CPU/Load/Kernel', 0)
+        if 'Guest/RAM/Usage/Total' in metrics and 'Guest/RAM/Usage/Free' in metrics:
+            sample['ram_used'] = (metrics['Guest/RAM/Usage/Total'] - metrics['Guest/RAM/Usage/Free']) / 1024
+        if 'Net/Rate/Rx' in metrics:
+            sample['net_rx'] = metrics['Net/Rate/Rx']
+        if 'Net/Rate/Tx' in metrics:
+            sample['net_tx'] = metrics['Net/Rate/Tx']
+        if sample:
+            samples[vm_name] = sample
+    return samples
+
+
+def setup_collection(interval=COLLECT_INTERVAL):
+    """
+    Ask the host to sample the metrics of every VM every interval seconds.
+    """
+    return run_vboxmanage_command(host_ip, host_username, host_password, SETUP_COMMAND.format(interval))
+
+
+def collect(timestamp=None):
+    """
+    Query the metrics of every VM on the host once (from its agent if there
+    is one) and add them to the VMs' buffers.
+
+    Returns:
+        int: Number of VMs updated.
+    """
+    timestamp = timestamp or time.time()
+    agent = get_agent(host_ip)
+    if agent:
+        samples = get_samples(agent.call('metrics', names=list(VBOX_METRICS)))
+    else:
+        samples = parse_metrics_query(run_vboxmanage_command(host_ip, host_username, host_password, QUERY_COMMAND))
+    if not samples:
+        return 0
+
+    vm_ids = dict(VM.objects.filter(name__in=samples).values_list('name', 'id'))
+    keys = {vm_id: get_buffer_key(vm_id) for vm_id in vm_ids.values()}
+    stored = cache.get_many(keys.values())
+
+    updated = {}
+    for vm_name, vm_id in vm_ids.items():
+        buffers = stored.get(keys[vm_id]) or VMMetrics()
+        buffers.add(timestamp, samples[vm_name])
+        updated[keys[vm_id]] = buffers
+    cache.set_many(updated, get_buffer_timeout())
+    return len(updated)
+
+
+def get_series(vm_id, tier='raw', now=None):
+    """
+    Get the time series of a VM at one resolution.
+
+    Returns:
+        dict: {'resolution', 'step', 'fields', 'points': [[timestamp, value per field]]}
+    """
+    buffers = cache.get(get_buffer_key(vm_id))
+    buffer = buffers.tiers[tier] if buffers else None
+    step = dict((name, step) for name, step, _ in TIERS)[tier]
+    return {
+        'resolution': tier,
+        'step': step,
+        'fields': list(FIELDS),
+        'points': [
+            [timestamp, *[None if values[field] is None else round(values[field], 2) for field in FIELDS]]
+            for timestamp, values in (buffer.points(now) if buffer else [])
+        ],
+    }
+
+
+def get_summary(vm_id, now=None):
+    """
+    Summarize the last hour of a VM's metrics for the details page.
+
+    Returns:
+        list: [{'label', 'unit', 'latest', 'mean', 'max'}], empty if nothing was collected.
+    """
+    points = get_series(vm_id, 'raw', now)['points']
+    if not points:
+        return []
+
+    summary = []
+    for position, (field, (label, unit)) in enumerate(FIELDS.items(), start=1):
+        values = [point[position] for point in points if point[position] is not None]
+        if not values:
+            continue
+        summary.append({
+            'label': label,
+            'unit': unit,
+            'latest': values[-1],
+            'mean': round(sum(values) / len(values), 2),
+            'max': max(values),
+        })
+    return summary
@@ -0,0 +1,190 @@
+"""
+Warm pool of pre-provisioned VMs.
+
+Building a VM from scratch takes createvm, modifyvm and createhd on the
+host. The refill_warm_pool command keeps a few VMs of each commonly
+requested (cpu, memory, disk size) shape ready instead, cloned as linked
+clones of a template VM (one per disk size, WARM_POOL_TEMPLATE) so a clone
+costs a differencing disk rather than a full copy. create_vm claims a
+ready VM of the requested shape and only renames it on the host; without
+one it falls back to building the VM.
+
+The pool size of a shape follows demand: enough VMs to cover the VMs of
+that shape created over the last WARM_POOL_COVER_SECONDS at the rate of the
+last WARM_POOL_DEMAND_WINDOW, between WARM_POOL_MIN_PER_SHAPE (for the
+shapes listed in WARM_POOL_SHAPES) and WARM_POOL_MAX_PER_SHAPE.
+"""
+import math
+import uuid
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .hypervisor import arun_vboxmanage_command, run_vboxmanage_command, host_username, host_password, host_ip
+from .metrics import increment
+from .models import VM, WarmVM
+
+CLONE_COMMAND = 'vboxmanage clonevm {template} --snapshot {snapshot} --options link --name {name} --register'
+MODIFY_COMMAND = 'vboxmanage modifyvm {name} --memory {memory} --cpus {cpu} --vram 16 --nic1 nat'
+RENAME_COMMAND = 'vboxmanage modifyvm {name} --name {new_name}'
+DELETE_COMMAND = 'vboxmanage unregistervm {name} --delete'
+
+# A claim loses to a concurrent one at most this many times before building the VM instead
+CLAIM_ATTEMPTS = 3
+
+# Clones stuck in provisioning this long belong to a refill that died
+PROVISIONING_TIMEOUT = timedelta(hours=1)
+
+
+@dataclass
+class RefillReport:
+    host: str
+    targets: dict = field(default_factory=dict)  # {(cpu, memory, disk_size): target}
+    created: list = field(default_factory=list)  # [WarmVM]
+    removed: list = field(default_factory=list)  # [WarmVM]
+    failed: list = field(default_factory=list)  # [(WarmVM, error)]
+
+
+def parse_shapes(value):
+    """
+    Parse WARM_POOL_SHAPES, e.g. '1:256:1024,2:1024:2048' (cpu:memory:disk size).
+    """
+    return [tuple(int(part) for part in shape.split(':')) for shape in value.split(',') if shape.strip()]
+
+
+def get_targets(now=None):
+    """
+    Get the number of ready VMs to keep of each shape.
+
+    Returns:
+        dict: {(cpu, memory, disk_size): target}
+    """
+    now = now or timezone.now()
+    window = settings.WARM_POOL_DEMAND_WINDOW
+    demand = VM.objects.filter(created_at__gte=now - timedelta(seconds=window)).values_list('cpu', 'memory', 'disk_size').annotate(count=Count('id'))
+
+    targets = {shape: settings.WARM_POOL_MIN_PER_SHAPE for shape in parse_shapes(settings.WARM_POOL_SHAPES)}
+    for cpu, memory, disk_size, count in demand:
+        shape = (cpu, memory, disk_size)
+        wanted = math.ceil(count * settings.WARM_POOL_COVER_SECONDS / window)
+        targets[shape] = min(settings.WARM_POOL_MAX_PER_SHAPE, max(targets.get(shape, 0), wanted))
+    return {shape: target for shape, target in targets.items() if target}
+
+
+def get_template(disk_size):
+    return settings.WARM_POOL_TEMPLATE.format(disk_size=disk_size)
+
+
+def _get_candidates(host, cpu, memory, disk_size):
+    return WarmVM.objects.filter(host=host, cpu=cpu, memory=memory, disk_size=disk_size, status='ready').order_by('created_at')
+
+
+def claim(name, cpu, memory, disk_size, host=None):
+    """
+    Take a ready VM of the shape from the pool and rename it on the host to name.
+
+    Returns:
+        bool: Whether a VM was claimed; if not, the caller builds one.
+    """
+    host = host or host_ip
+    for _ in range(CLAIM_ATTEMPTS):
+        warm = _get_candidates(host, cpu, memory, disk_size).first()
+        if warm is None:
+            break
+        # Conditional update, so two requests never get the same VM
+        if WarmVM.objects.filter(id=warm.id, status='ready').update(status='claimed'):
+            try:
+                run_vboxmanage_command(host, host_username, host_password, RENAME_COMMAND.format(name=warm.name, new_name=name))
+            except Exception:
+                WarmVM.objects.filter(id=warm.id).update(status='failed')
+                raise
+            warm.delete()
+            increment('warm_pool_claims_total', {'result': 'hit'})
+            return True
+    increment('warm_pool_claims_total', {'result': 'miss'})
+    return False
+
+
+async def aclaim(name, cpu, memory, disk_size, host=None):
+    """
+    Async version of claim().
+    """
+    host = host or host_ip
+    for _ in range(CLAIM_ATTEMPTS):
+        warm = await _get_candidates(host, cpu, memory, disk_size).afirst()
+        if warm is None:
+            break
+        if await WarmVM.objects.filter(id=warm.id, status='ready').aupdate(status='claimed'):
+            try:
+                await arun_vboxmanage_command(host, host_username, host_password, RENAME_COMMAND.format(name=warm.name, new_name=name))
+            except Exception:
+                await WarmVM.objects.filter(id=warm.id).aupdate(status='failed')
+                raise
+            await warm.adelete()
+            increment('warm_pool_claims_total', {'result': 'hit'})
+            return True
+    increment('warm_pool_claims_total', {'result': 'miss'})
+    return False
+
+
+def _provision(warm):
+    run_vboxmanage_command(warm.host, host_username, host_password, CLONE_COMMAND.format(
+        template=get_template(warm.disk_size), snapshot=settings.WARM_POOL_TEMPLATE_SNAPSHOT, name=warm.name,
+    ))
+    run_vboxmanage_command(warm.host, host_username, host_password, MODIFY_COMMAND.format(
+        name=warm.name, memory=warm.memory, cpu=warm.cpu,
+    ))
+
+
+def _remove(warm):
+    run_vboxmanage_command(warm.host, host_username, host_password, DELETE_COMMAND.format(name=warm.name))
+    warm.delete()
+
+
+def refill(host=None, now=None):
+    """
+    Bring the pool of a host to its targets: clone the missing VMs, remove
+    one surplus VM per shape (so a short dip in demand doesn't empty the
+    pool) and clean up clones that failed or never finished.
+
+    Returns:
+        RefillReport
+    """
+    host = host or host_ip
+    now = now or timezone.now()
+    report = RefillReport(host=host, targets=get_targets(now))
+
+    abandoned = Q(status='failed') | Q(status='provisioning', updated_at__lt=now - PROVISIONING_TIMEOUT)
+    for warm in WarmVM.objects.filter(abandoned, host=host):
+        _remove(warm)
+        report.removed.append(warm)
+
+    pooled = {
+        (cpu, memory, disk_size): count
+        for cpu, memory, disk_size, count in WarmVM.objects.filter(host=host, status__in=['provisioning', 'ready'])
+        .values_list('cpu', 'memory', 'disk_size').annotate(count=Count('id'))
+    }
+
+    for shape, count in pooled.items():
+        if count <= report.targets.get(shape, 0):
+            continue
+        surplus = _get_candidates(host, *shape).last()
+        if surplus is not None and WarmVM.objects.filter(id=surplus.id, status='ready').update(status='claimed'):
+            _remove(surplus)
+            report.removed.append(surplus)
+
+    for (cpu, memory, disk_size), target in report.targets.items():
+        for _ in range(target - pooled.get((cpu, memory, disk_size), 0)):
+            warm = WarmVM.objects.create(host=host, name=f'warm-{uuid.uuid4().hex[:12]}', cpu=cpu, memory=memory, disk_size=disk_size)
+            try:
+                _provision(warm)
+            except Exception as error:
+                WarmVM.objects.filter(id=warm.id).update(status='failed')
+                report.failed.append((warm, error))
+                continue
+            WarmVM.objects.filter(id=warm.id).update(status='ready')
+            report.created.append(warm)
+    return report